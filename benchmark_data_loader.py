@@ -0,0 +1,214 @@
+from __future__ import division, print_function
+
+import torch
+import numpy as np
+
+import util.io as io
+import util.timer as timer
+import data.synthetic as synthetic
+from data.data_loader import CreateDataset
+
+import os
+import sys
+import time
+import argparse
+from collections import OrderedDict
+
+# Per-stage cost of Dataset.__getitem__ for each dataset_mode, on a synthetic dataset with the same on-disk layout as the
+# real ones (see data/synthetic.py). The datasets are created under --data_root on first use:
+#
+#     python benchmark_data_loader.py --modes pose_transfer aligned_gan --n_items 200
+#
+# Stages are measured by wrapping the functions called by __getitem__ (in the dataset module namespace or on the dataset
+# instance), so the dataset code runs unchanged:
+#     decode        cv2.imread
+#     flip          trans_random_horizontal_flip(_pose_c)
+#     pose_map      pose_to_map, landmark_to_heatmap
+#     stickman      pose_to_stickman
+#     limb_crop     get_limb_crop
+#     seg_mask      segmap_to_mask_v2
+#     color_map     cv2.GaussianBlur, get_color_patch
+#     color_jitter  ColorJitter (with PIL conversion)
+#     transform     trans_resize, trans_*_crop, trans_random_affine
+#     to_tensor     to_tensor, tensor_normalize_std
+#     other         remaining time of __getitem__ (array conversion, tensor creation, stage-1 cache, etc.)
+#     total         __getitem__
+
+MODES = OrderedDict([
+    # dataset_mode: (dataset, options)
+    ('pose_transfer', ('DF_Pose', '--which_model_T vunet --use_limb 1')),
+    ('pose_parsing', ('DF_Pose', '')),
+    ('aligned_gan', ('DeepFashion', '')),
+    ('gan_self', ('DeepFashion', '--affine_aug')),
+])
+
+STAGES = OrderedDict([
+    ('module', OrderedDict([
+        ('trans_random_horizontal_flip', 'flip'),
+        ('trans_random_horizontal_flip_pose_c', 'flip'),
+        ('pose_to_map', 'pose_map'),
+        ('landmark_to_heatmap', 'pose_map'),
+        ('pose_to_stickman', 'stickman'),
+        ('segmap_to_mask_v2', 'seg_mask'),
+        ('get_color_patch', 'color_map'),
+        ('trans_resize', 'transform'),
+        ('trans_random_crop', 'transform'),
+        ('trans_center_crop', 'transform'),
+        ('trans_random_affine', 'transform'),
+    ])),
+    ('cv2', OrderedDict([
+        ('imread', 'decode'),
+        ('GaussianBlur', 'color_map'),
+    ])),
+    ('dataset', OrderedDict([
+        ('get_limb_crop', 'limb_crop'),
+        ('color_jitter', 'color_jitter'),
+        ('to_tensor', 'to_tensor'),
+        ('tensor_normalize_std', 'to_tensor'),
+    ])),
+])
+
+
+def create_opt(mode, data_root, size):
+    ord_str = '--gpu_ids -1 --fine_size %d %s' % (size, MODES[mode][1])
+    if mode == 'pose_transfer':
+        from options.pose_transfer_options import TrainPoseTransferOptions
+        opt = TrainPoseTransferOptions().parse(ord_str, save_to_file=False, display=False, set_gpu=False)
+    elif mode == 'pose_parsing':
+        from options.pose_parsing_options import TrainPoseParsingOptions
+        opt = TrainPoseParsingOptions().parse(ord_str, save_to_file=False, display=False, set_gpu=False)
+    elif mode == 'aligned_gan':
+        from options.multimodal_gan_options_v3 import TrainMMGANOptions_V3
+        opt = TrainMMGANOptions_V3().parse(ord_str, save_to_file=False, display=False, set_gpu=False)
+    elif mode == 'gan_self':
+        from options.multimodal_gan_options_v2 import TrainMMGANOptions_V2
+        opt = TrainMMGANOptions_V2().parse(ord_str + ' --benchmark ca_upper --edge_mode cloth', save_to_file=False, display=False, set_gpu=False)
+        # V2 options have no dataset_mode. GANDataset reads files from the paths in index files, which include data_root
+        opt.dataset_mode = 'gan_self'
+    opt.data_root = os.path.join(data_root, MODES[mode][0])
+    opt.load_size = size
+    return opt
+
+
+class _Stage(object):
+    '''
+    call func in profiler.phase(stage). nested stages are counted in the outermost one
+    '''
+    active = [False]
+
+    def __init__(self, func, stage, profiler):
+        self.func = func
+        self.stage = stage
+        self.profiler = profiler
+
+    def __call__(self, *args, **kwargs):
+        if self.active[0]:
+            return self.func(*args, **kwargs)
+        self.active[0] = True
+        try:
+            with self.profiler.phase(self.stage):
+                return self.func(*args, **kwargs)
+        finally:
+            self.active[0] = False
+
+    def __getattr__(self, name):
+        return getattr(self.func, name)
+
+
+class _CV2Proxy(object):
+    def __init__(self, cv2, profiler):
+        self._cv2 = cv2
+        for name, stage in STAGES['cv2'].items():
+            setattr(self, name, _Stage(getattr(cv2, name), stage, profiler))
+
+    def __getattr__(self, name):
+        return getattr(self._cv2, name)
+
+
+def instrument(dataset, profiler):
+    '''
+    wrap the functions of each stage. return a function restoring the original ones
+    '''
+    module = sys.modules[dataset.__class__.__module__]
+    restore = []
+    for name, stage in STAGES['module'].items():
+        if hasattr(module, name):
+            restore.append((module, name, getattr(module, name)))
+            setattr(module, name, _Stage(getattr(module, name), stage, profiler))
+    restore.append((module, 'cv2', module.cv2))
+    module.cv2 = _CV2Proxy(module.cv2, profiler)
+    for name, stage in STAGES['dataset'].items():
+        if hasattr(dataset, name):
+            setattr(dataset, name, _Stage(getattr(dataset, name), stage, profiler))
+
+    def _restore():
+        for m, name, func in restore:
+            setattr(m, name, func)
+    return _restore
+
+
+def benchmark_mode(mode, args):
+    opt = create_opt(mode, args.data_root, args.size)
+    dataset = CreateDataset(opt, args.split)
+    profiler = timer.StepProfiler(enabled=True, sync=False, window=args.n_items)
+    restore = instrument(dataset, profiler)
+    rng = np.random.RandomState(args.seed)
+    np.random.seed(args.seed)
+    try:
+        indices = rng.choice(len(dataset), args.n_items, replace=len(dataset) < args.n_items)
+        for i, index in enumerate(indices):
+            t = time.time()
+            dataset[index]
+            t = time.time() - t
+            if i >= args.n_warmup:
+                profiler.add('other', t - sum(profiler.current.values()))
+                profiler.add('total', t)
+                profiler.step()
+            else:
+                profiler.current.clear()
+    finally:
+        restore()
+    summary = profiler.summary()
+    summary.pop('step', None)
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='per-stage __getitem__ cost of each dataset_mode on synthetic datasets')
+    parser.add_argument('--modes', type=str, nargs='+', default=list(MODES.keys()), choices=list(MODES.keys()))
+    parser.add_argument('--data_root', type=str, default='datasets/synthetic/', help='root of synthetic datasets (DF_Pose/ and DeepFashion/)')
+    parser.add_argument('--create', action='store_true', help='create synthetic datasets even if they exist')
+    parser.add_argument('--num_samples', type=int, default=200, help='number of images in each synthetic dataset')
+    parser.add_argument('--size', type=int, default=256, help='image size')
+    parser.add_argument('--split', type=str, default='train', help='train split enables augmentation')
+    parser.add_argument('--n_items', type=int, default=100, help='number of timed samples')
+    parser.add_argument('--n_warmup', type=int, default=5, help='number of untimed samples')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, default='checkpoints/benchmark/data_loader.json', help='json file of results')
+    args = parser.parse_args()
+    args.n_items += args.n_warmup
+
+    # create synthetic datasets
+    dataset_names = set([MODES[mode][0] for mode in args.modes])
+    if 'DF_Pose' in dataset_names and (args.create or not os.path.isdir(os.path.join(args.data_root, 'DF_Pose'))):
+        synthetic.create_df_pose_dataset(os.path.join(args.data_root, 'DF_Pose'), num_persons=max(2, args.num_samples // 4), poses_per_person=4,
+            size=args.size, seed=args.seed)
+    if 'DeepFashion' in dataset_names and (args.create or not os.path.isdir(os.path.join(args.data_root, 'DeepFashion'))):
+        synthetic.create_deepfashion_dataset(os.path.join(args.data_root, 'DeepFashion'), num_samples=args.num_samples, size=args.size, seed=args.seed)
+
+    results = OrderedDict()
+    for mode in args.modes:
+        results[mode] = benchmark_mode(mode, args)
+
+    for mode, summary in results.items():
+        print('[%s] %d samples, time (ms)' % (mode, args.n_items - args.n_warmup))
+        print('    %-14s %10s %10s %10s %8s' % ('stage', 'mean', 'p50', 'p95', 'share'))
+        total = summary['total']['mean']
+        for stage, s in summary.items():
+            # mean over all samples, including those in which the stage did not occur
+            mean = s['mean'] * s['count'] / summary['total']['count']
+            print('    %-14s %10.2f %10.2f %10.2f %7.1f%%' % (stage, mean, s['p50'], s['p95'], mean / total * 100))
+
+    io.mkdir_if_missing(os.path.dirname(args.output) or '.')
+    io.save_json({'args': vars(args), 'results': results}, args.output)
+    print('results saved to %s' % args.output)
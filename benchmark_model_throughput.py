@@ -0,0 +1,239 @@
+from __future__ import division, print_function
+
+import torch
+import numpy as np
+
+import util.io as io
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import subprocess
+import tempfile
+from collections import OrderedDict
+
+# Throughput benchmark of all model families on synthetic inputs (see data/synthetic.py), so that models can be compared
+# (and regressions detected) without the real datasets. For each model and image size, measure on CPU:
+#     train_sps     training samples/sec (set_input + optimize_parameters)
+#     test_sps      inference samples/sec (set_input + test, in eval mode)
+#     rss_init      resident memory after model creation (MB)
+#     peak_rss      peak resident memory (MB)
+# Each (model, size) runs in a separate process, so that peak memory is not shared between configurations:
+#
+#     python benchmark_model_throughput.py --models vunet 2stage --sizes 128 256 --output checkpoints/benchmark/throughput.json
+#     python benchmark_model_throughput.py --baseline checkpoints/benchmark/throughput.json --tolerance 0.1
+#
+# With --baseline, results are compared with the baseline file by (model, size, batch_size), and the script exits with
+# status 1 if throughput drops or peak memory grows by more than the tolerance.
+#
+# Models are created with default training options and the settings below. Pretrained weights are not needed, except the
+# VGG19 loss network (loaded from the weight registry, see util/weight_registry.py). The stage-1 network of 2stage is a
+# randomly initialized vunet, saved as checkpoints/PoseTransfer_benchmark_s1_[size].
+
+MODELS = OrderedDict([
+    ('vunet', '--which_model_T vunet'),
+    ('2stage', '--which_model_T 2stage --which_model_stage_1 PoseTransfer_benchmark_s1_%(size)d'),
+    ('supervised', '--which_model_T unet'),
+    ('V2', '--pretrain_shape 0 --pretrain_edge 0 --pretrain_color 0 --which_model_init none'),
+    ('V3', '--pretrain_shape 0 --pretrain_edge 0 --pretrain_color 0 --which_model_init none'),
+    ('pose_parsing', ''),
+])
+
+
+def get_rss():
+    '''
+    current and peak resident memory (MB)
+    '''
+    with open('/proc/self/statm') as f:
+        rss = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2.**20
+    # ru_maxrss is in KB on Linux
+    return rss, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2.**10
+
+
+def create_model(name, size, batch_size):
+    '''
+    return (opt, model, create_batch) for a model family. create_batch(opt, batch_size, rng) creates synthetic input
+    '''
+    import data.synthetic as synthetic
+    ord_str = '--id benchmark_%s --gpu_ids -1 --batch_size %d --fine_size %d %s' % (name, batch_size, size, MODELS[name] % {'size': size})
+    if name in {'vunet', '2stage', 'supervised'}:
+        from options.pose_transfer_options import TrainPoseTransferOptions
+        opt = TrainPoseTransferOptions().parse(ord_str, save_to_file=False, display=False, set_gpu=False)
+        if name == 'vunet':
+            from models.vunet_pose_transfer_model import VUnetPoseTransferModel
+            model = VUnetPoseTransferModel()
+        elif name == '2stage':
+            create_stage_1_checkpoint(size, batch_size)
+            from models.two_stage_pose_transfer_model import TwoStagePoseTransferModel
+            model = TwoStagePoseTransferModel()
+        else:
+            from models.supervised_pose_transfer_model import SupervisedPoseTransferModel
+            model = SupervisedPoseTransferModel()
+        create_batch = synthetic.create_pose_transfer_batch
+    elif name == 'V2':
+        from options.multimodal_gan_options_v2 import TrainMMGANOptions_V2
+        from models.multimodal_designer_gan_model_v2 import MultimodalDesignerGAN_V2
+        opt = TrainMMGANOptions_V2().parse(ord_str, save_to_file=False, display=False, set_gpu=False)
+        model = MultimodalDesignerGAN_V2()
+        create_batch = synthetic.create_gan_batch
+    elif name == 'V3':
+        from options.multimodal_gan_options_v3 import TrainMMGANOptions_V3
+        from models.multimodal_designer_gan_model_v3 import MultimodalDesignerGAN_V3
+        opt = TrainMMGANOptions_V3().parse(ord_str, save_to_file=False, display=False, set_gpu=False)
+        model = MultimodalDesignerGAN_V3()
+        create_batch = synthetic.create_aligned_gan_batch
+    elif name == 'pose_parsing':
+        from options.pose_parsing_options import TrainPoseParsingOptions
+        from models.pose_parsing_model import PoseParsingModel
+        opt = TrainPoseParsingOptions().parse(ord_str, save_to_file=False, display=False, set_gpu=False)
+        model = PoseParsingModel()
+        create_batch = synthetic.create_pose_parsing_batch
+    else:
+        raise NotImplementedError(name)
+    model.initialize(opt)
+    return opt, model, create_batch
+
+
+def create_stage_1_checkpoint(size, batch_size):
+    '''
+    randomly initialized vunet used as the stage-1 network of 2stage (train_opt.json and latest_net_netT.pth)
+    '''
+    from options.pose_transfer_options import TrainPoseTransferOptions
+    from models.vunet_pose_transfer_model import VUnetPoseTransferModel
+    opt = TrainPoseTransferOptions().parse('--id benchmark_s1_%d --gpu_ids -1 --batch_size %d --fine_size %d --which_model_T vunet' % (size, batch_size, size),
+        save_to_file=False, display=False, set_gpu=False)
+    if os.path.isfile(os.path.join('checkpoints', opt.id, 'latest_net_netT.pth')):
+        return
+    model = VUnetPoseTransferModel()
+    model.initialize(opt)
+    io.mkdir_if_missing(model.save_dir)
+    io.save_json(vars(opt), os.path.join(model.save_dir, 'train_opt.json'))
+    model.save_network(model.netT, 'netT', 'latest', opt.gpu_ids)
+    model.flush_checkpoints()
+
+
+def time_steps(func, n_warmup, n_iter):
+    for i in range(n_warmup):
+        func()
+    t = time.time()
+    for i in range(n_iter):
+        func()
+    return (time.time() - t) / n_iter
+
+
+def run_config(name, size, args):
+    '''
+    benchmark one (model, size) configuration in the current process
+    '''
+    torch.manual_seed(0)
+    rng = np.random.RandomState(0)
+    opt, model, create_batch = create_model(name, size, args.batch_size)
+    rss_init, _ = get_rss()
+    data = create_batch(opt, args.batch_size, rng)
+
+    def train_step():
+        model.set_input(data)
+        model.optimize_parameters()
+
+    def test_step():
+        model.set_input(data)
+        with torch.no_grad():
+            model.test()
+
+    model.train()
+    t_train = time_steps(train_step, args.n_warmup, args.n_iter)
+    model.eval()
+    t_test = time_steps(test_step, args.n_warmup, args.n_iter)
+    _, peak_rss = get_rss()
+    return OrderedDict([
+        ('model', name),
+        ('size', size),
+        ('batch_size', args.batch_size),
+        ('threads', torch.get_num_threads()),
+        ('train_sps', args.batch_size / t_train),
+        ('test_sps', args.batch_size / t_test),
+        ('rss_init', rss_init),
+        ('peak_rss', peak_rss),
+    ])
+
+
+def run_subprocess(name, size, args):
+    fd, fn_out = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+    cmd = [sys.executable, os.path.abspath(__file__), '--child', name, str(size), fn_out,
+        '--batch_size', str(args.batch_size), '--n_warmup', str(args.n_warmup), '--n_iter', str(args.n_iter), '--threads', str(args.threads)]
+    try:
+        ret = subprocess.call(cmd)
+        if ret != 0:
+            print('[benchmark] %s (size %d) failed with exit code %d' % (name, size, ret))
+            return None
+        return io.load_json(fn_out)
+    finally:
+        os.remove(fn_out)
+
+
+def compare(results, baseline, tolerance):
+    '''
+    return a list of regressions (description strings) w.r.t baseline results
+    '''
+    base = {(r['model'], r['size'], r['batch_size']): r for r in baseline}
+    regressions = []
+    for r in results:
+        b = base.get((r['model'], r['size'], r['batch_size']))
+        if b is None:
+            continue
+        for k in ['train_sps', 'test_sps']:
+            if r[k] < b[k] * (1 - tolerance):
+                regressions.append('%s (size %d): %s %.2f -> %.2f (%+.1f%%)' % (r['model'], r['size'], k, b[k], r[k], (r[k] / b[k] - 1) * 100))
+        if r['peak_rss'] > b['peak_rss'] * (1 + tolerance):
+            regressions.append('%s (size %d): peak_rss %.1f -> %.1f MB (%+.1f%%)' % (r['model'], r['size'], b['peak_rss'], r['peak_rss'], (r['peak_rss'] / b['peak_rss'] - 1) * 100))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='throughput benchmark of model families on synthetic inputs (CPU)')
+    parser.add_argument('--models', type=str, nargs='+', default=list(MODELS.keys()), choices=list(MODELS.keys()))
+    parser.add_argument('--sizes', type=int, nargs='+', default=[256], help='image sizes (fine_size)')
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--n_warmup', type=int, default=2, help='number of untimed steps')
+    parser.add_argument('--n_iter', type=int, default=10, help='number of timed steps')
+    parser.add_argument('--threads', type=int, default=0, help='number of CPU threads (0: torch default)')
+    parser.add_argument('--output', type=str, default='checkpoints/benchmark/throughput.json', help='json file of results')
+    parser.add_argument('--baseline', type=str, default='', help='json file of baseline results to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='relative throughput drop / memory growth reported as regression')
+    parser.add_argument('--child', nargs=3, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    if args.child is not None:
+        name, size, fn_out = args.child
+        io.save_json(run_config(name, int(size), args), fn_out)
+        sys.exit(0)
+
+    results = []
+    for name in args.models:
+        for size in args.sizes:
+            r = run_subprocess(name, size, args)
+            if r is not None:
+                results.append(r)
+
+    print('%-14s %6s %6s %12s %12s %12s %12s' % ('model', 'size', 'batch', 'train (sps)', 'test (sps)', 'RSS (MB)', 'peak (MB)'))
+    for r in results:
+        print('%-14s %6d %6d %12.2f %12.2f %12.1f %12.1f' % (r['model'], r['size'], r['batch_size'], r['train_sps'], r['test_sps'], r['rss_init'], r['peak_rss']))
+
+    io.mkdir_if_missing(os.path.dirname(args.output) or '.')
+    io.save_json({'torch': torch.__version__, 'results': results}, args.output)
+    print('results saved to %s' % args.output)
+
+    if args.baseline:
+        regressions = compare(results, io.load_json(args.baseline)['results'], args.tolerance)
+        if regressions:
+            print('%d regression(s) w.r.t %s (tolerance %.0f%%):' % (len(regressions), args.baseline, args.tolerance * 100))
+            for s in regressions:
+                print('    ' + s)
+            sys.exit(1)
+        print('no regression w.r.t %s' % args.baseline)
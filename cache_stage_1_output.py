@@ -0,0 +1,80 @@
+from __future__ import division, print_function
+
+import torch
+import torch.utils.data
+from options.pose_transfer_options import TrainPoseTransferOptions
+from data.data_loader import CreateDataset
+from data.stage1_cache import Stage1Cache, get_stage1_cache_dir
+from models.two_stage_pose_transfer_model import TwoStagePoseTransferModel
+
+import util.io as io
+import os
+import sys
+import numpy as np
+import tqdm
+
+# Precompute stage-1 (netT_s1) outputs of the 2-stage model for all training pairs, so that stage-2 training can read them
+# from disk instead of running the frozen stage-1 network every step. Use the same options as train_pose_transfer_model.py:
+#
+#     python cache_stage_1_output.py --which_model_T 2stage --which_model_stage_1 PoseTransfer_4.3 --gpu_ids 0 [--s1_cache_flip 0]
+#     python train_pose_transfer_model.py --which_model_T 2stage --which_model_stage_1 PoseTransfer_4.3 --s1_cache 1 ...
+#
+# For each ordered pair (ref, tar), the cache contains the outputs of all flip states (flip_ref, flip_tar) that the training
+# augmentation can produce, so that the cached result is consistent with the augmented input of stage-2. In unsupervised
+# mode (--supervised 0) stage-1 reconstructs the reference, and the cache contains (id, id) entries of both ids of each pair.
+#
+# netT_s1 runs in transfer mode: the cache stores the output decoded from the mean latent code, and the posterior
+# parameters. By default (--s1_cache_sample 0) training reads the cached output and does not run netT_s1 at all. With
+# --s1_cache_sample 1 it samples the latent code from the cached posterior and still runs the decoder of netT_s1 every step,
+# which matches train mode of netT_s1 without a cache, but only saves the cost of the encoder.
+
+opt = TrainPoseTransferOptions().parse(save_to_file=False)
+assert opt.which_model_T == '2stage'
+assert not opt.train_s1, 'stage-1 cache can not be used when jointly training stage-1 network'
+opt.s1_cache = 0 # do not read cache when creating it
+# create stage-1 network
+model = TwoStagePoseTransferModel()
+model.initialize_stage_1(opt)
+# create dataset
+dataset = CreateDataset(opt, 'train')
+cache = Stage1Cache(get_stage1_cache_dir(opt))
+cache.save_meta({
+    'stage_1_id': opt.which_model_stage_1,
+    'flip': opt.s1_cache_flip,
+    'supervised': opt.supervised,
+    'output_type': model.opt_s1.output_type,
+    'n_latent_scales': model.opt_s1.vunet_n_latent_scales,
+    })
+print('stage-1 cache dir: %s' % cache.cache_dir)
+
+# augmentation coins (flip_1, flip_2, swap)
+flip_coins = [0., 1.] if opt.s1_cache_flip else [0.]
+# the dataset swaps the pair at random also in unsupervised mode, where the key is (id_1, id_1) of the swapped pair. both
+# swap states are enumerated so that the cache covers id_2 of each pair too
+swap_coins = [0., 1.]
+aug_list = [(f1, f2, sw) for f1 in flip_coins for f2 in flip_coins for sw in swap_coins]
+
+for aug in aug_list:
+    dataset.fixed_aug = aug
+    loader = torch.utils.data.DataLoader(dataset, batch_size=opt.batch_size, shuffle=False, num_workers=int(opt.nThreads), drop_last=False)
+    for data in tqdm.tqdm(loader, desc='flip_1=%d, flip_2=%d, swap=%d' % aug):
+        if opt.supervised:
+            keys = [Stage1Cache.get_key(id_1, id_2, int(f_1), int(f_2)) for id_1, id_2, f_1, f_2 in zip(data['id_1'], data['id_2'], data['flip_1'], data['flip_2'])]
+        else:
+            keys = [Stage1Cache.get_key(id_1, id_1, int(f_1), int(f_1)) for id_1, f_1 in zip(data['id_1'], data['flip_1'])]
+        if all([cache.exists(k) for k in keys]):
+            continue
+        model.set_input(data)
+        if opt.supervised:
+            ref_idx, tar_idx = '1', '2'
+        else:
+            ref_idx, tar_idx = '1', '1'
+        appr_ref = model.get_appearance(model.opt_s1.appearance_type, index=ref_idx)
+        pose_ref = model.get_pose(model.opt_s1.pose_type, index=ref_idx)
+        pose_tar = model.get_pose(model.opt_s1.pose_type, index=tar_idx)
+        with torch.no_grad():
+            output_s1, ps, qs = model.netT_s1(appr_ref, pose_ref, pose_tar, mode='transfer')
+        output_s1 = output_s1.cpu().numpy()
+        qs = [q.cpu().numpy() for q in qs]
+        for i, k in enumerate(keys):
+            cache.save(k, output_s1[i], [q[i] for q in qs])
@@ -1,6 +1,8 @@
 from __future__ import division, print_function
 
 import torch.utils.data
+from data.resumable_sampler import ResumableSampler
+import util.distributed as distributed
 import copy
 
 # Todo: disentangle data-related parameters from model options
@@ -18,10 +20,22 @@ def CreateDataLoader(opt, split = None):
 
     dataset = CreateDataset(opt, split)
     shuffle = (split == 'train' and opt.is_train)
+    is_distributed = 'distributed' in opt and opt.distributed
+    resumable = ('resume_freq' in opt and opt.resume_freq > 0) or ('resume' in opt and opt.resume)
+    if opt.is_train and (is_distributed or resumable):
+        # each process loads a different shard in distributed training. call dataloader.sampler.set_epoch(epoch) to
+        # reshuffle the training set. the sampler position can be saved and restored (see BaseModel.save_train_state).
+        # distributed processes use the same seed (0, as DistributedSampler), otherwise the seed follows the torch seed
+        sampler = ResumableSampler(dataset, shuffle = shuffle, seed = 0 if is_distributed else None,
+            num_replicas = distributed.get_world_size(), rank = distributed.get_rank())
+        shuffle = False
+    else:
+        sampler = None
     dataloader = torch.utils.data.DataLoader(
         dataset = dataset, 
         batch_size = opt.batch_size,
         shuffle = shuffle, 
+        sampler = sampler,
         num_workers = int(opt.nThreads), 
         drop_last = True, # set this True in both training and testing to avoid bug when using multigpu
         pin_memory = False)
@@ -3,6 +3,7 @@ import torch
 import torchvision.transforms as transforms
 from base_dataset import *
 from misc.pose_util import get_joint_coord
+from stage1_cache import Stage1Cache, get_stage1_cache_dir
 
 import cv2
 import numpy as np
@@ -34,6 +35,29 @@ class PoseTransferDataset(BaseDataset):
         #############################
         # other
         #############################
+        self.initialize_transform(opt)
+        # fixed augmentation coins (flip_1, flip_2, swap). used to enumerate augmentations when precomputing stage-1 cache
+        self.fixed_aug = None
+        self.use_flip = True
+        #############################
+        # stage-1 cache (2-stage model)
+        #############################
+        self.s1_cache = None
+        if 's1_cache' in opt and opt.s1_cache and split == 'train' and opt.is_train:
+            self.s1_cache = Stage1Cache(get_stage1_cache_dir(opt))
+            s1_cache_meta = self.s1_cache.load_meta()
+            assert s1_cache_meta['stage_1_id'] == opt.which_model_stage_1, 'stage-1 cache was created by model %s' % s1_cache_meta['stage_1_id']
+            # the cache key scheme depends on opt.supervised: (id_1, id_2) pairs if supervised, (id_1, id_1) otherwise
+            assert s1_cache_meta['supervised'] == opt.supervised, 'stage-1 cache was created with supervised=%d' % s1_cache_meta['supervised']
+            # flipped samples are only available if they were cached
+            self.use_flip = bool(s1_cache_meta['flip'])
+
+    def initialize_transform(self, opt):
+        '''
+        setup image normalization and body limb definition. this is the only part of initialize() needed by pack_sample(),
+        so that inputs can be created from raw images and poses without loading the dataset (see models/network_loader.py)
+        '''
+        self.opt = opt
         self.tensor_normalize_std = transforms.Normalize([0.5, 0.5, 0.5], [0.5, 0.5, 0.5])
         # self.color_jitter = transforms.ColorJitter(brightness=0.3, contrast=0.3, saturation=0.3, hue=0.3)
         # self.to_pil_image = transforms.ToPILImage()
@@ -207,51 +231,35 @@ class PoseTransferDataset(BaseDataset):
         return joint_c + joint_ext
 
 
-    def __getitem__(self, index):
-        sid_1, sid_2 = self.id_list[index]
-        ######################
-        # load image
-        ######################
-        img_1 = self.read_image(sid_1)
-        img_2 = self.read_image(sid_2)
-        seg_1 = self.read_seg(sid_1)
-        seg_2 = self.read_seg(sid_2)
-        joint_c_1 = self.pose_label[sid_1]
-        joint_c_2 = self.pose_label[sid_2]
-        ######################
-        # augmentation
-        ######################
-        if self.split == 'train' and self.opt.is_train:
-            # flip img_1
-            coin = np.random.rand()
-            img_1 = trans_random_horizontal_flip(img_1, coin)
-            seg_1 = trans_random_horizontal_flip(seg_1, coin)
-            joint_c_1 = trans_random_horizontal_flip_pose_c(joint_c_1, (img_1.shape[1], img_1.shape[0]), coin)
-            # flip img_2
-            coin = np.random.rand()
-            img_2 = trans_random_horizontal_flip(img_2, coin)
-            seg_2 = trans_random_horizontal_flip(seg_2, coin)
-            joint_c_2 = trans_random_horizontal_flip_pose_c(joint_c_2, (img_2.shape[1], img_2.shape[0]), coin)
-            # swap img_1 and img_2
-            coin = np.random.rand()
-            if coin > 0.5:
-                sid_1, sid_2 = sid_2, sid_1
-                img_1, img_2 = img_2, img_1
-                joint_c_1, joint_c_2 = joint_c_2, joint_c_1
-                seg_1, seg_2 = seg_2, seg_1
-        # ####################
-        # extend key points
-        ######################
+    def pack_pose(self, joint_c, img_sz, index='1'):
+        '''
+        create pose inputs (joint_c, joint, stickman) of one sample
+        joint_c: [[x0, y0], ..., [x17, y17]]
+        img_sz: (w, h)
+        '''
         if 'extend_pose' in self.opt and self.opt.extend_pose:
-            joint_c_1 = self.extend_pose(joint_c_1)
-            joint_c_2 = self.extend_pose(joint_c_2)
+            joint_c = self.extend_pose(joint_c)
+        joint = pose_to_map(img_sz=img_sz, label=joint_c, mode=self.opt.joint_mode, radius=self.opt.joint_radius)
+        stickman = pose_to_stickman(img_sz=img_sz, label=joint_c)
+        return {
+            'joint_c_%s'%index: torch.Tensor(joint_c),
+            'joint_%s'%index: self.to_tensor(joint),
+            'stickman_%s'%index: self.to_tensor(stickman),
+        }
+
+    def pack_sample(self, img_1, seg_1, joint_c_1, img_2, seg_2, joint_c_2):
+        '''
+        create network inputs of a (ref, tar) pair from raw data (after augmentation)
+        img: (h, w, 3) np.ndarray, RGB, in range [0, 1]
+        seg: (h, w, 1) np.ndarray
+        joint_c: [[x0, y0], ..., [x17, y17]]
+        '''
         ######################
         # create pose representation
         ######################
-        joint_1 = pose_to_map(img_sz=(img_1.shape[1], img_1.shape[0]), label=joint_c_1, mode=self.opt.joint_mode, radius=self.opt.joint_radius)
-        joint_2 = pose_to_map(img_sz=(img_2.shape[1], img_2.shape[0]), label=joint_c_2, mode=self.opt.joint_mode, radius=self.opt.joint_radius)
-        stickman_1 = pose_to_stickman(img_sz=(img_1.shape[1], img_1.shape[0]), label=joint_c_1)
-        stickman_2 = pose_to_stickman(img_sz=(img_2.shape[1], img_2.shape[0]), label=joint_c_2)
+        data = {}
+        data.update(self.pack_pose(joint_c_1, (img_1.shape[1], img_1.shape[0]), index='1'))
+        data.update(self.pack_pose(joint_c_2, (img_2.shape[1], img_2.shape[0]), index='2'))
         ######################
         # create limb crops
         ######################
@@ -286,27 +294,80 @@ class PoseTransferDataset(BaseDataset):
         ######################
         # output
         ######################
-        data = {
+        data.update({
             'img_1': self.tensor_normalize_std(self.to_tensor(img_1)),
             'img_2': self.tensor_normalize_std(self.to_tensor(img_2)),
-            'joint_c_1': torch.Tensor(joint_c_1),
-            'joint_c_2': torch.Tensor(joint_c_2),
-            'joint_1': self.to_tensor(joint_1),
-            'joint_2': self.to_tensor(joint_2),
-            'stickman_1': self.to_tensor(stickman_1),
-            'stickman_2': self.to_tensor(stickman_2),
             'seg_1': self.to_tensor(seg_1),
             'seg_2': self.to_tensor(seg_2),
             'seg_mask_1': self.to_tensor(segmap_to_mask_v2(seg_1, nc=self.opt.seg_nc, bin_size=self.opt.seg_bin_size)),
             'seg_mask_2': self.to_tensor(segmap_to_mask_v2(seg_2, nc=self.opt.seg_nc, bin_size=self.opt.seg_bin_size)),
-            'id_1': sid_1,
-            'id_2': sid_2
-        }
+        })
         if limb_1 is not None:
             data['limb_1'] = self.to_tensor(limb_1)
         if limb_2 is not None:
             data['limb_2'] = self.to_tensor(limb_2)
         return data
 
+    def __getitem__(self, index):
+        sid_1, sid_2 = self.id_list[index]
+        ######################
+        # load image
+        ######################
+        img_1 = self.read_image(sid_1)
+        img_2 = self.read_image(sid_2)
+        seg_1 = self.read_seg(sid_1)
+        seg_2 = self.read_seg(sid_2)
+        joint_c_1 = self.pose_label[sid_1]
+        joint_c_2 = self.pose_label[sid_2]
+        ######################
+        # augmentation
+        ######################
+        flip_1 = flip_2 = 0
+        if self.split == 'train' and self.opt.is_train:
+            if self.fixed_aug is None:
+                coins = [np.random.rand() for _ in range(3)]
+            else:
+                coins = list(self.fixed_aug)
+            if not self.use_flip:
+                coins[0] = coins[1] = 0
+            # flip img_1
+            coin = coins[0]
+            img_1 = trans_random_horizontal_flip(img_1, coin)
+            seg_1 = trans_random_horizontal_flip(seg_1, coin)
+            joint_c_1 = trans_random_horizontal_flip_pose_c(joint_c_1, (img_1.shape[1], img_1.shape[0]), coin)
+            flip_1 = int(coin >= 0.5)
+            # flip img_2
+            coin = coins[1]
+            img_2 = trans_random_horizontal_flip(img_2, coin)
+            seg_2 = trans_random_horizontal_flip(seg_2, coin)
+            joint_c_2 = trans_random_horizontal_flip_pose_c(joint_c_2, (img_2.shape[1], img_2.shape[0]), coin)
+            flip_2 = int(coin >= 0.5)
+            # swap img_1 and img_2
+            coin = coins[2]
+            if coin > 0.5:
+                sid_1, sid_2 = sid_2, sid_1
+                img_1, img_2 = img_2, img_1
+                joint_c_1, joint_c_2 = joint_c_2, joint_c_1
+                seg_1, seg_2 = seg_2, seg_1
+                flip_1, flip_2 = flip_2, flip_1
+        data = self.pack_sample(img_1, seg_1, joint_c_1, img_2, seg_2, joint_c_2)
+        data['id_1'] = sid_1
+        data['id_2'] = sid_2
+        data['flip_1'] = flip_1
+        data['flip_2'] = flip_2
+        ######################
+        # stage-1 cache
+        ######################
+        if self.s1_cache is not None:
+            if self.opt.supervised:
+                key = Stage1Cache.get_key(sid_1, sid_2, flip_1, flip_2)
+            else:
+                key = Stage1Cache.get_key(sid_1, sid_1, flip_1, flip_1)
+            s1_output, s1_qs = self.s1_cache.load(key)
+            data['s1_output'] = torch.from_numpy(s1_output)
+            for i, q in enumerate(s1_qs):
+                data['s1_q_%d'%i] = torch.from_numpy(q)
+        return data
+
 
 
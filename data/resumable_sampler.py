@@ -0,0 +1,62 @@
+from __future__ import division, print_function
+
+import torch
+import torch.utils.data
+import math
+
+
+class ResumableSampler(torch.utils.data.Sampler):
+    '''
+    Sampler whose order in each epoch is determined by (seed, epoch), and which can start from the middle of an epoch, so
+    that an interrupted training can be resumed at the same position (see BaseModel.save_train_state).
+    In distributed training, each process takes a different shard of the (padded) permutation, in the same way as
+    torch.utils.data.distributed.DistributedSampler.
+    seed: if None, derived from the torch seed of the process (torch.initial_seed()), so that the order differs between
+        runs like shuffle=True. the seed is saved in state_dict. distributed processes should pass the same seed.
+    '''
+    def __init__(self, dataset, shuffle=True, seed=None, num_replicas=1, rank=0):
+        self.dataset = dataset
+        self.shuffle = shuffle
+        self.seed = seed if seed is not None else torch.initial_seed() % 2**31
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self.start = 0
+        self.num_samples = int(math.ceil(len(dataset) / num_replicas))
+        self.total_size = self.num_samples * num_replicas
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def set_start(self, start):
+        '''
+        skip the first "start" samples (of this process) in the next iteration
+        '''
+        self.start = start
+
+    def state_dict(self, start=0):
+        '''
+        start: number of samples of the current epoch that have been consumed
+        '''
+        return {'seed': self.seed, 'epoch': self.epoch, 'start': start}
+
+    def load_state_dict(self, state):
+        self.seed = state['seed']
+        self.epoch = state['epoch']
+        self.start = state['start']
+
+    def __iter__(self):
+        if self.shuffle:
+            g = torch.Generator()
+            g.manual_seed(self.seed + self.epoch)
+            indices = torch.randperm(len(self.dataset), generator=g).tolist()
+        else:
+            indices = list(range(len(self.dataset)))
+        # pad to make the number of samples evenly divisible by num_replicas
+        indices += indices[:(self.total_size - len(indices))]
+        indices = indices[self.rank:self.total_size:self.num_replicas]
+        start, self.start = self.start, 0
+        return iter(indices[start:])
+
+    def __len__(self):
+        return self.num_samples - self.start
@@ -0,0 +1,68 @@
+from __future__ import division, print_function
+
+import numpy as np
+import os
+import util.io as io
+
+class Stage1Cache(object):
+    '''
+    On-disk store of stage-1 (netT_s1) outputs of TwoStagePoseTransferModel, indexed by pair id and flip state.
+    Each entry is an .npz file containing:
+        output: raw netT_s1 output (before tanh), (c, h, w) float16. the "image" and "seg" channels follow
+                the channel order of opt_s1.output_type (see TwoStagePoseTransferModel.parse_output)
+        q_0, q_1, ...: posterior parameters of each latent scale, float16
+    '''
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.fn_meta = os.path.join(cache_dir, 'meta.json')
+
+    @staticmethod
+    def get_key(sid_ref, sid_tar, flip_ref=0, flip_tar=0):
+        return '%s_%s_%d%d' % (sid_ref, sid_tar, flip_ref, flip_tar)
+
+    def get_filename(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    def exists(self, key):
+        return os.path.isfile(self.get_filename(key))
+
+    def save(self, key, output, qs):
+        '''
+        output: np.ndarray (c, h, w)
+        qs: list of np.ndarray
+        '''
+        entry = {'output': output.astype(np.float16)}
+        for i, q in enumerate(qs):
+            entry['q_%d'%i] = q.astype(np.float16)
+        # write to a temp file first, so that an interrupted precompute pass does not leave broken entries
+        fn = self.get_filename(key)
+        fn_tmp = fn[0:-4] + '.tmp.npz'
+        np.savez(fn_tmp, **entry)
+        os.rename(fn_tmp, fn)
+
+    def load(self, key):
+        '''
+        Output:
+            output: np.ndarray (c, h, w), float32
+            qs: list of np.ndarray, float32
+        '''
+        with np.load(self.get_filename(key)) as entry:
+            output = entry['output'].astype(np.float32)
+            n_q = len([k for k in entry.files if k.startswith('q_')])
+            qs = [entry['q_%d'%i].astype(np.float32) for i in range(n_q)]
+        return output, qs
+
+    def save_meta(self, meta):
+        io.mkdir_if_missing(self.cache_dir)
+        io.save_json(meta, self.fn_meta)
+
+    def load_meta(self):
+        if not os.path.isfile(self.fn_meta):
+            raise Exception('stage-1 cache not found in %s. run cache_stage_1_output.py first' % self.cache_dir)
+        return io.load_json(self.fn_meta)
+
+
+def get_stage1_cache_dir(opt):
+    if 's1_cache_dir' in opt and opt.s1_cache_dir:
+        return opt.s1_cache_dir
+    return os.path.join('checkpoints', opt.which_model_stage_1, 's1_cache')
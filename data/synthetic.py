@@ -0,0 +1,373 @@
+from __future__ import division, print_function
+
+import torch
+from torch.utils.data.dataloader import default_collate
+from base_dataset import *
+
+import cv2
+import numpy as np
+import os
+import util.io as io
+
+# Synthetic samples in the format of the real datasets (DF_Pose, DeepFashion), to benchmark and test models and data
+# loaders without the licensed data:
+#   - random_pose / random_seg / random_image / random_edge: raw data as returned by the read_* functions of datasets
+#   - create_*_batch: collated model inputs with the exact format of the dataset used by each model family
+#   - create_*_dataset: fake datasets on disk, with the layout and index files expected by the dataset classes
+#
+# Segmentation label (7 classes): 0-background, 1-hair, 2-face, 3-upper clothes, 4-lower clothes, 5-arm, 6-leg
+# Joint order (18 OpenPose keypoints): see misc/pose_util.py
+
+SEG_LABELS = ['background', 'hair', 'face', 'upper_clothes', 'lower_clothes', 'arm', 'leg']
+
+# normalized (x, y) of a standing person
+JOINT_TEMPLATE = np.array([
+    [0.50, 0.14], # nose
+    [0.50, 0.22], # neck
+    [0.38, 0.23], # rshoulder
+    [0.33, 0.38], # relbow
+    [0.31, 0.52], # rwrist
+    [0.62, 0.23], # lshoulder
+    [0.67, 0.38], # lelbow
+    [0.69, 0.52], # lwrist
+    [0.43, 0.53], # rhip
+    [0.42, 0.72], # rknee
+    [0.42, 0.90], # rankle
+    [0.57, 0.53], # lhip
+    [0.58, 0.72], # lknee
+    [0.58, 0.90], # lankle
+    [0.47, 0.12], # reye
+    [0.53, 0.12], # leye
+    [0.44, 0.13], # rear
+    [0.56, 0.13], # lear
+    ], dtype=np.float32)
+
+LIMBS = {
+    'arm': [(2,3), (3,4), (5,6), (6,7)],
+    'leg': [(8,9), (9,10), (11,12), (12,13)],
+}
+
+
+def random_pose(w, h, p_invalid=0.1, rng=np.random):
+    '''
+    joint coordinates [[x0, y0], ..., [x17, y17]] of a randomly scaled, shifted and perturbed person. joints are invalid
+    ([-1, -1]) with probability p_invalid, or when they fall outside the image.
+    '''
+    scale = rng.uniform(0.8, 1.1)
+    shift = rng.uniform(-0.08, 0.08, size=2)
+    joints = (JOINT_TEMPLATE - 0.5) * scale + 0.5 + shift + rng.normal(0, 0.015, size=JOINT_TEMPLATE.shape)
+    joints = joints * np.array([w, h], dtype=np.float32)
+    joint_c = []
+    for x, y in joints:
+        if rng.rand() < p_invalid or not (0 <= x < w and 0 <= y < h):
+            joint_c.append([-1, -1])
+        else:
+            joint_c.append([float(x), float(y)])
+    return joint_c
+
+
+def random_seg(joint_c, w, h):
+    '''
+    7-class segmentation map (h, w, 1) (float32, same as dataset.read_seg) of a person drawn around the joints
+    '''
+    seg = np.zeros((h, w), np.uint8)
+    joints = np.array(joint_c, dtype=np.float32)
+    valid = (joints >= 0).all(axis=1)
+    pt = lambda i: (int(joints[i][0]), int(joints[i][1]))
+    unit = max(w, h)
+    # legs and lower clothes
+    for i, j in LIMBS['leg']:
+        if valid[i] and valid[j]:
+            cv2.line(seg, pt(i), pt(j), 6, thickness=max(1, int(unit*0.07)))
+    lower = [i for i in [8, 11, 12, 9] if valid[i]]
+    if len(lower) >= 3:
+        cv2.fillConvexPoly(seg, np.int32([pt(i) for i in lower]), 4)
+    # upper clothes
+    upper = [i for i in [2, 5, 11, 8] if valid[i]]
+    if len(upper) >= 3:
+        cv2.fillConvexPoly(seg, np.int32([pt(i) for i in upper]), 3)
+    # arms
+    for i, j in LIMBS['arm']:
+        if valid[i] and valid[j]:
+            cv2.line(seg, pt(i), pt(j), 5, thickness=max(1, int(unit*0.05)))
+    # hair and face
+    if valid[0]:
+        r = max(1, int(unit*0.06))
+        x, y = pt(0)
+        cv2.circle(seg, (x, y - r//2), r, 1, thickness=-1)
+        cv2.circle(seg, (x, y), int(r*0.8), 2, thickness=-1)
+    return seg.astype(np.float32)[:,:,np.newaxis]
+
+
+def random_palette(rng=np.random):
+    return rng.uniform(0, 1, size=(len(SEG_LABELS), 3)).astype(np.float32)
+
+
+def random_image(seg, rng=np.random, palette=None):
+    '''
+    RGB image (h, w, 3) in [0, 1] (float32, same as dataset.read_image) with a random color for each segmentation region.
+    images of the same person (e.g. pairs in DF_Pose) share the same palette
+    '''
+    if palette is None:
+        palette = random_palette(rng)
+    img = palette[seg[:,:,0].astype(np.int64)]
+    img = img + rng.normal(0, 0.05, size=img.shape).astype(np.float32)
+    img = cv2.GaussianBlur(img, (5, 5), 1.)
+    return np.clip(img, 0, 1).astype(np.float32)
+
+
+def random_edge(seg):
+    '''
+    edge map (h, w, 1) in [0, 1] at the boundaries of segmentation regions
+    '''
+    edge = cv2.Canny(seg[:,:,0].astype(np.uint8) * 36, 10, 30)
+    return (edge / 255.).astype(np.float32)[:,:,np.newaxis]
+
+
+def random_person(w, h, p_invalid=0.1, rng=np.random, palette=None):
+    joint_c = random_pose(w, h, p_invalid, rng)
+    seg = random_seg(joint_c, w, h)
+    img = random_image(seg, rng, palette)
+    return img, seg, joint_c
+
+
+def _to_tensor(img):
+    return torch.Tensor(img.transpose((2, 0, 1)))
+
+def _normalize(img):
+    return _to_tensor((img - 0.5) / 0.5)
+
+
+###############################################################################
+# model inputs
+###############################################################################
+def create_pose_transfer_batch(opt, batch_size, rng=np.random):
+    '''
+    input of pose transfer models (PoseTransferDataset), created by PoseTransferDataset.pack_sample
+    '''
+    from pose_transfer_dataset import PoseTransferDataset
+    dataset = PoseTransferDataset()
+    dataset.initialize_transform(opt)
+    samples = []
+    for i in range(batch_size):
+        img_1, seg_1, joint_c_1 = random_person(opt.fine_size, opt.fine_size, rng=rng)
+        img_2, seg_2, joint_c_2 = random_person(opt.fine_size, opt.fine_size, rng=rng)
+        data = dataset.pack_sample(img_1, seg_1, joint_c_1, img_2, seg_2, joint_c_2)
+        data.update({'id_1': 'synthetic_%d_1' % i, 'id_2': 'synthetic_%d_2' % i, 'flip_1': 0, 'flip_2': 0})
+        samples.append(data)
+    return default_collate(samples)
+
+
+def create_pose_parsing_batch(opt, batch_size, rng=np.random):
+    '''
+    input of PoseParsingModel (PoseParsingDataset)
+    '''
+    samples = []
+    for i in range(batch_size):
+        img, seg, joint_c = random_person(opt.fine_size, opt.fine_size, rng=rng)
+        img_sz = (img.shape[1], img.shape[0])
+        samples.append({
+            'img': _normalize(img),
+            'joint_input': _to_tensor(pose_to_map(img_sz=img_sz, label=joint_c, mode='gaussian', radius=8)),
+            'joint_tar': _to_tensor(pose_to_map(img_sz=img_sz, label=joint_c, mode='gaussian', radius=11.3137)),
+            'joint_c': torch.Tensor(joint_c),
+            'seg': _to_tensor(seg),
+            'seg_mask': _to_tensor(segmap_to_mask_v2(seg, nc=opt.seg_nc, bin_size=1)),
+            'id': 'synthetic_%d' % i,
+        })
+    return default_collate(samples)
+
+
+def _color_map(opt, img, seg):
+    color_map = cv2.GaussianBlur(img, (opt.color_gaussian_ksz, opt.color_gaussian_ksz), opt.color_gaussian_sigma)
+    if opt.color_patch:
+        return torch.cat([_to_tensor(p) for p in get_color_patch(color_map, seg, opt.color_patch_mode)], dim=0), _normalize(color_map)
+    else:
+        return _normalize(color_map), _normalize(color_map)
+
+
+def create_aligned_gan_batch(opt, batch_size, rng=np.random):
+    '''
+    input of MultimodalDesignerGAN_V3 (AlignedGANDataset). the flexible seg map is the same as the seg map
+    '''
+    samples = []
+    for i in range(batch_size):
+        img, seg, _ = random_person(opt.fine_size, opt.fine_size, rng=rng)
+        img_edge, seg_edge, _ = random_person(opt.fine_size, opt.fine_size, rng=rng)
+        img_color, seg_color, _ = random_person(opt.fine_size, opt.fine_size, rng=rng)
+        color_map, _ = _color_map(opt, img, seg)
+        color_map_src, _ = _color_map(opt, img_color, seg_color)
+        samples.append({
+            'img': _normalize(img),
+            'seg_map': _to_tensor(seg),
+            'seg_mask': _to_tensor(segmap_to_mask_v2(seg, nc=7)),
+            'flx_seg_mask': _to_tensor(segmap_to_mask_v2(seg, nc=7)),
+            'edge_map': _to_tensor(random_edge(seg)),
+            'color_map': color_map,
+            'img_edge': _normalize(img_edge),
+            'edge_map_src': _to_tensor(random_edge(seg_edge)),
+            'img_color': _normalize(img_color),
+            'color_map_src': color_map_src,
+            'id': ['synthetic_%d' % i, 'synthetic_%d_edge' % i, 'synthetic_%d_color' % i],
+        })
+    return default_collate(samples)
+
+
+def create_gan_batch(opt, batch_size, rng=np.random):
+    '''
+    input of MultimodalDesignerGAN_V2 (GANDataset). the landmark heatmap (18 channels) is created from random joints, and
+    the affine augmented inputs (opt.affine_aug) are copies of the original ones
+    '''
+    samples = []
+    for i in range(batch_size):
+        img, seg, joint_c = random_person(opt.fine_size, opt.fine_size, rng=rng)
+        color_map, color_map_full = _color_map(opt, img, seg)
+        data = {
+            'img': _normalize(img),
+            'lm_map': _to_tensor(pose_to_map(img_sz=(img.shape[1], img.shape[0]), label=joint_c, mode='gaussian', radius=15)),
+            'seg_mask': _to_tensor(segmap_to_mask_v2(seg)),
+            'seg_map': _to_tensor(seg),
+            'flx_seg_mask': _to_tensor(segmap_to_mask_v2(seg)),
+            'edge_map': _to_tensor(random_edge(seg)),
+            'color_map': color_map,
+            'color_map_full': color_map_full,
+            'id': 'synthetic_%d' % i,
+        }
+        if opt.affine_aug:
+            for name in ['img', 'seg_mask', 'flx_seg_mask', 'edge_map', 'color_map', 'lm_map']:
+                data[name + '_aug'] = data[name].clone()
+        samples.append(data)
+    return default_collate(samples)
+
+
+###############################################################################
+# datasets on disk
+###############################################################################
+def _write_image(img, fn):
+    cv2.imwrite(fn, (img[:,:,[2,1,0]] * 255).round().astype(np.uint8))
+
+def _write_map(m, fn):
+    # seg maps (labels) and edge maps (in [0, 255]) are single channel 8-bit images
+    cv2.imwrite(fn, m[:,:,0].round().astype(np.uint8))
+
+def _split_ids(id_list, test_ratio, num_debug=32):
+    num_test = max(1, int(len(id_list) * test_ratio))
+    train, test = id_list[0:-num_test], id_list[-num_test:]
+    return {'train': train, 'test': test, 'debug': train[0:num_debug]}
+
+
+def create_df_pose_dataset(root, num_persons=50, poses_per_person=4, size=256, p_invalid=0.1, test_ratio=0.1, seed=0):
+    '''
+    fake DF_Pose dataset for PoseTransferDataset and PoseParsingDataset (default options):
+        Label/pair_split.json       {split: [[id_1, id_2], ...]}, pairs of images of the same person
+        Label/split.json            {split: [id, ...]}
+        Label/pose_label.pkl        {id: [[x0, y0], ..., [x17, y17]]}
+        Img/img_df/[id].jpg
+        Img/seg_df/[id].bmp
+        Img/seg-lip_df_revised/[id].bmp
+    persons are split into train/test (debug is a subset of train).
+    '''
+    rng = np.random.RandomState(seed)
+    dirs = {k: os.path.join(root, d) for k, d in [('img', 'Img/img_df/'), ('seg', 'Img/seg_df/'), ('seg_lip', 'Img/seg-lip_df_revised/'), ('label', 'Label/')]}
+    for d in dirs.values():
+        io.mkdir_if_missing(d)
+
+    pose_label = {}
+    persons = []
+    for p in range(num_persons):
+        palette = random_palette(rng)
+        sids = []
+        for i in range(poses_per_person):
+            sid = 'synthetic_%05d_%d' % (p, i)
+            img, seg, joint_c = random_person(size, size, p_invalid, rng, palette)
+            _write_image(img, os.path.join(dirs['img'], sid + '.jpg'))
+            _write_map(seg, os.path.join(dirs['seg'], sid + '.bmp'))
+            _write_map(seg, os.path.join(dirs['seg_lip'], sid + '.bmp'))
+            pose_label[sid] = joint_c
+            sids.append(sid)
+        persons.append(sids)
+
+    person_split = _split_ids(persons, test_ratio, num_debug=len(persons))
+    split = {k: [sid for sids in v for sid in sids] for k, v in person_split.items()}
+    pair_split = {k: [[s1, s2] for sids in v for s1 in sids for s2 in sids if s1 != s2] for k, v in person_split.items()}
+    split['debug'] = split['debug'][0:32]
+    pair_split['debug'] = pair_split['debug'][0:32]
+    io.save_data(pose_label, os.path.join(dirs['label'], 'pose_label.pkl'))
+    io.save_json(split, os.path.join(dirs['label'], 'split.json'))
+    io.save_json(pair_split, os.path.join(dirs['label'], 'pair_split.json'))
+    print('synthetic DF_Pose dataset created in %s (%d images, %d/%d train/test pairs)' % (root, len(pose_label), len(pair_split['train']), len(pair_split['test'])))
+
+
+def random_cloth_landmark(joint_c):
+    '''
+    6 upper-body cloth landmarks [[x, y, v], ...] (collar, sleeve and hem, left and right) placed at shoulders, elbows and
+    hips. v=2 if the landmark is invalid (same as DeepFashion landmark labels)
+    '''
+    lm = []
+    for i in [5, 2, 6, 3, 11, 8]:
+        x, y = joint_c[i]
+        lm.append([x, y, 0] if x >= 0 and y >= 0 else [0, 0, 2])
+    return lm
+
+
+def create_deepfashion_dataset(root, num_samples=200, size=256, num_aligned=2, p_invalid=0.1, test_ratio=0.1, seed=0):
+    '''
+    fake DeepFashion Category-and-Attribute subset (upper clothes) for AlignedGANDataset and GANDataset (default options
+    with --benchmark ca_upper --edge_mode cloth):
+        Split/ca_gan_split_trainval_upper.json              {split: [id, ...]}
+        Label/ca_gan_trainval_upper_aligned_index.json      {id: {'edge_ids': [...], 'color_ids': [...]}}
+        Label/ca_samples.json                               {id: {'img_path', 'cloth_type'}}
+        Label/ca_landmark_label_256.pkl                     {id: [[x, y, v], ...]}
+        Label/ca_syn_seg_paths.json, ca_gan_flx_seg_paths.json, ca_edge_cloth_paths.json
+        Img/img_ca_256/[id].jpg
+        Img/seg_ca_syn_256/[id].bmp
+        Img/seg_ca_syn_256_flexible/[id].bmp                upper clothes region dilated
+        Img/edge_ca_256_cloth/[id].jpg                      edges inside the clothes region
+        Img/edge_ca_256_cloth_tps/[id]_[edge_id].jpg        edge map of edge_id warped to id (here: edge map of id)
+    each anchor id is aligned with num_aligned edge and color sources of the same split.
+    '''
+    rng = np.random.RandomState(seed)
+    dirs = {k: os.path.join(root, d) for k, d in [('img', 'Img/img_ca_256/'), ('seg', 'Img/seg_ca_syn_256/'), ('flx_seg', 'Img/seg_ca_syn_256_flexible/'),
+        ('edge', 'Img/edge_ca_256_cloth/'), ('edge_warp', 'Img/edge_ca_256_cloth_tps/'), ('label', 'Label/'), ('split', 'Split/')]}
+    for d in dirs.values():
+        io.mkdir_if_missing(d)
+
+    id_list = ['synthetic_%06d' % i for i in range(num_samples)]
+    samples, lm_label, seg_paths, flx_seg_paths, edge_paths, edge_maps = {}, {}, {}, {}, {}, {}
+    kernel = np.ones((7, 7), np.uint8)
+    for sid in id_list:
+        img, seg, joint_c = random_person(size, size, p_invalid, rng)
+        flx_seg = seg.copy()
+        flx_seg[cv2.dilate((seg == 3).astype(np.uint8), kernel)[:,:,np.newaxis] > 0] = 3
+        cloth = cv2.dilate(((seg == 3) | (seg == 4)).astype(np.uint8), kernel)[:,:,np.newaxis]
+        edge_maps[sid] = random_edge(seg) * cloth * 255
+        samples[sid] = {'img_path': os.path.join(dirs['img'], sid + '.jpg'), 'cloth_type': 1}
+        lm_label[sid] = random_cloth_landmark(joint_c)
+        seg_paths[sid] = os.path.join(dirs['seg'], sid + '.bmp')
+        flx_seg_paths[sid] = os.path.join(dirs['flx_seg'], sid + '.bmp')
+        edge_paths[sid] = os.path.join(dirs['edge'], sid + '.jpg')
+        _write_image(img, samples[sid]['img_path'])
+        _write_map(seg, seg_paths[sid])
+        _write_map(flx_seg, flx_seg_paths[sid])
+        _write_map(edge_maps[sid], edge_paths[sid])
+
+    split = _split_ids(id_list, test_ratio)
+    aligned_index = {}
+    for ids in [split['train'], split['test']]:
+        for sid in ids:
+            aligned_index[sid] = {
+                'edge_ids': [ids[j] for j in rng.choice(len(ids), num_aligned)],
+                'color_ids': [ids[j] for j in rng.choice(len(ids), num_aligned)],
+            }
+            for edge_id in aligned_index[sid]['edge_ids']:
+                if edge_id != sid:
+                    _write_map(edge_maps[sid], os.path.join(dirs['edge_warp'], '%s_%s.jpg' % (sid, edge_id)))
+
+    io.save_json(split, os.path.join(dirs['split'], 'ca_gan_split_trainval_upper.json'))
+    io.save_json(aligned_index, os.path.join(dirs['label'], 'ca_gan_trainval_upper_aligned_index.json'))
+    io.save_json(samples, os.path.join(dirs['label'], 'ca_samples.json'))
+    io.save_data(lm_label, os.path.join(dirs['label'], 'ca_landmark_label_256.pkl'))
+    io.save_json(seg_paths, os.path.join(dirs['label'], 'ca_syn_seg_paths.json'))
+    io.save_json(flx_seg_paths, os.path.join(dirs['label'], 'ca_gan_flx_seg_paths.json'))
+    io.save_json(edge_paths, os.path.join(dirs['label'], 'ca_edge_cloth_paths.json'))
+    print('synthetic DeepFashion dataset created in %s (%d/%d train/test images)' % (root, len(split['train']), len(split['test'])))
@@ -0,0 +1,88 @@
+from __future__ import division, print_function
+
+import torch
+from torch.utils.data.dataloader import default_collate
+from options.pose_transfer_options import ExportPoseTransferOptions
+from models.network_loader import load_pose_transfer_model
+from models.traceable_networks import create_traceable_model, run_eager_transfer, max_output_diff
+from data.data_loader import CreateDataset
+
+import util.io as io
+import os
+
+# Export the generator of a trained pose transfer model (vunet or 2stage) to TorchScript and/or ONNX.
+#
+#     python export_pose_transfer_model.py --id PoseTransfer_2s_7.5 --gpu_ids -1 [--format torchscript onnx] [--deterministic 1]
+#
+# Outputs are saved in checkpoints/id/export/, together with a json file describing the inputs. Input tensors are created
+# the same way as in the model (see TraceableVUnetPoseTransfer.get_inputs and TraceableTwoStagePoseTransfer.get_inputs).
+# Parity with the eager model is checked on samples from the test set.
+
+opt = ExportPoseTransferOptions().parse(save_to_file=False)
+model, model_opt = load_pose_transfer_model(opt.id, opt.gpu_ids, opt.which_epoch)
+# example inputs
+dataset = CreateDataset(model_opt, 'test')
+data = default_collate([dataset[i] for i in range(opt.batch_size)])
+model.set_input(data)
+net = create_traceable_model(model, deterministic=bool(opt.deterministic))
+inputs = net.get_inputs(model)
+# parity check: traceable network vs. eager model
+if opt.deterministic:
+    net_ref = create_traceable_model(model, deterministic=False)
+else:
+    net_ref = net
+diff = max_output_diff(lambda: run_eager_transfer(model), lambda: net_ref(*inputs))
+print('traceable network vs. eager model: max abs diff = %e' % diff)
+assert diff < opt.tolerance, 'parity check failed'
+
+export_dir = os.path.join('checkpoints', model_opt.id, 'export')
+io.mkdir_if_missing(export_dir)
+fn_prefix = os.path.join(export_dir, '%s_netT' % opt.which_epoch)
+info = {
+    'id': model_opt.id,
+    'which_epoch': opt.which_epoch,
+    'which_model_T': model_opt.which_model_T,
+    'deterministic': opt.deterministic,
+    'input_names': net.input_names,
+    'input_sizes': [list(x.size()) for x in inputs],
+    'output_names': ['img_out'],
+}
+
+if 'torchscript' in opt.format:
+    with torch.no_grad():
+        # trace checking re-runs the module and compares outputs, which fails with random ops
+        traced = torch.jit.trace(net, inputs, check_trace=bool(opt.deterministic))
+    fn_ts = fn_prefix + '.pt'
+    traced.save(fn_ts)
+    traced = torch.jit.load(fn_ts, map_location=inputs[0].device)
+    diff = max_output_diff(lambda: net(*inputs), lambda: traced(*inputs))
+    print('TorchScript module saved to %s. max abs diff = %e' % (fn_ts, diff))
+    assert diff < opt.tolerance, 'parity check failed'
+    info['torchscript'] = os.path.basename(fn_ts)
+
+if 'onnx' in opt.format:
+    fn_onnx = fn_prefix + '.onnx'
+    dynamic_axes = {name: {0: 'batch'} for name in net.input_names + info['output_names']}
+    with torch.no_grad():
+        torch.onnx.export(net, inputs, fn_onnx, input_names=net.input_names, output_names=info['output_names'],
+            dynamic_axes=dynamic_axes, opset_version=opt.onnx_opset)
+    print('ONNX model saved to %s' % fn_onnx)
+    info['onnx'] = os.path.basename(fn_onnx)
+    try:
+        import onnxruntime
+    except ImportError:
+        onnxruntime = None
+        print('onnxruntime not found. skip ONNX parity check')
+    if onnxruntime is not None:
+        if not opt.deterministic:
+            print('ONNX random ops do not follow the pytorch random seed. skip ONNX parity check (use --deterministic 1)')
+        else:
+            sess = onnxruntime.InferenceSession(fn_onnx)
+            img_onnx = sess.run(None, {name: x.cpu().numpy() for name, x in zip(net.input_names, inputs)})[0]
+            with torch.no_grad():
+                img_out = net(*inputs).cpu().numpy()
+            diff = float(abs(img_onnx - img_out).max())
+            print('ONNX model: max abs diff = %e' % diff)
+            assert diff < opt.tolerance, 'parity check failed'
+
+io.save_json(info, fn_prefix + '.json')
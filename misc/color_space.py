@@ -3,6 +3,126 @@ from __future__ import division
 import torch
 import numpy
 
+# rgb2lab: linear RGB -> XYZ (normalized by the D65 white point)
+M_RGB2XYZ = [[0.4124/0.95047, 0.3576/0.95047, 0.1805/0.95047],
+             [0.2126, 0.7152, 0.0722],
+             [0.0193/1.08883, 0.1192/1.08883, 0.9505/1.08883]]
+# rgb2lab: f(XYZ) -> Lab (without the -16 offset of L)
+M_F2LAB = [[0., 116., 0.],
+           [500., -500., 0.],
+           [0., 200., -200.]]
+# lab2rgb: Lab (with +16 added to L) -> f(XYZ)
+M_LAB2F = [[1./116, 1./500, 0.],
+           [1./116, 0., 0.],
+           [1./116, 0., -1./200]]
+# lab2rgb: XYZ (normalized by the D65 white point) -> linear RGB
+M_XYZ2RGB = [[3.2406*0.95047, -1.5372, -0.4986*1.08883],
+             [-0.9689*0.95047, 1.8758, 0.0415*1.08883],
+             [0.0557*0.95047, -0.2040, 1.0570*1.08883]]
+
+
+def _color_matmul(M, x):
+    '''
+    apply a 3x3 color matrix M (list) to a (bsz, 3, h, w) tensor
+    '''
+    bsz, c, h, w = x.size()
+    return torch.matmul(x.new(M).view(1,3,3), x.contiguous().view(bsz, c, h*w)).view(bsz, c, h, w)
+
+
+def _color_matmul_T(M, x):
+    return _color_matmul([list(r) for r in zip(*M)], x)
+
+
+class RGB2Lab(torch.autograd.Function):
+    '''
+    rgb2lab with a hand-written backward. only the input is saved for backward, and the intermediate (linear RGB, XYZ)
+    values are recomputed there, instead of keeping the masks and pow results of each step in the graph.
+    '''
+    @staticmethod
+    def forward(ctx, img_in):
+        ctx.save_for_backward(img_in)
+        rgb = (img_in + 1 + 1e-5) * 0.5
+        # convert to XYZ space
+        rgb = torch.where(rgb > 0.04045, ((rgb + 0.055) / 1.055).pow_(2.4), rgb / 12.92)
+        xyz = _color_matmul(M_RGB2XYZ, rgb)
+        del rgb
+        xyz = torch.where(xyz > 0.008856, xyz.clamp(min=0.008856).pow_(1./3), xyz * 7.787 + 16./116)
+        # convert to Lab space
+        lab = _color_matmul(M_F2LAB, xyz)
+        lab[:,0] -= 16
+        return lab
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        img_in, = ctx.saved_tensors
+        rgb = (img_in + 1 + 1e-5) * 0.5
+        m1 = rgb > 0.04045
+        # d(linear rgb)/d(rgb)
+        d_rgb = torch.where(m1, ((rgb + 0.055) / 1.055).pow_(1.4).mul_(2.4 / 1.055), rgb.new_full([1], 1. / 12.92).expand_as(rgb))
+        rgb = torch.where(m1, ((rgb + 0.055) / 1.055).pow_(2.4), rgb / 12.92)
+        del m1
+        xyz = _color_matmul(M_RGB2XYZ, rgb)
+        del rgb
+        # d(f(xyz))/d(xyz)
+        d_xyz = torch.where(xyz > 0.008856, xyz.clamp(min=0.008856).pow_(-2./3).div_(3), xyz.new_full([1], 7.787).expand_as(xyz))
+        del xyz
+        grad = _color_matmul_T(M_F2LAB, grad_out).mul_(d_xyz)
+        del d_xyz
+        grad = _color_matmul_T(M_RGB2XYZ, grad).mul_(d_rgb)
+        return grad * 0.5
+
+
+class Lab2RGB(torch.autograd.Function):
+    '''
+    lab2rgb with a hand-written backward (see RGB2Lab). the branches of torch.where are clamped, so that no NaN gradient
+    comes from the pow of the unused branch.
+    '''
+    @staticmethod
+    def forward(ctx, img_in):
+        ctx.save_for_backward(img_in)
+        lab = img_in.clone()
+        lab[:,0] += 16
+        # convert to XYZ space
+        f = _color_matmul(M_LAB2F, lab)
+        del lab
+        f_pow_3 = f.pow(3)
+        xyz = torch.where(f_pow_3 > 0.008856, f_pow_3, (f - 16./116) / 7.787)
+        del f, f_pow_3
+        # convert to RGB space
+        rgb = _color_matmul(M_XYZ2RGB, xyz)
+        rgb = torch.where(rgb > 0.0031308, rgb.clamp(min=0.0031308).pow(1./2.4).mul_(1.055).sub_(0.055), rgb * 12.92)
+        return ((rgb - 0.5) / 0.5).clamp_(-1, 1)
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        img_in, = ctx.saved_tensors
+        lab = img_in.clone()
+        lab[:,0] += 16
+        f = _color_matmul(M_LAB2F, lab)
+        del lab
+        f_pow_3 = f.pow(3)
+        m1 = f_pow_3 > 0.008856
+        # d(xyz)/d(f)
+        d_f = torch.where(m1, f.pow(2).mul_(3), f.new_full([1], 1. / 7.787).expand_as(f))
+        xyz = torch.where(m1, f_pow_3, (f - 16./116) / 7.787)
+        del f, f_pow_3, m1
+        lin = _color_matmul(M_XYZ2RGB, xyz)
+        del xyz
+        m2 = lin > 0.0031308
+        # d(rgb)/d(linear rgb)
+        d_lin = torch.where(m2, lin.clamp(min=0.0031308).pow(1./2.4 - 1).mul_(1.055 / 2.4), lin.new_full([1], 12.92).expand_as(lin))
+        rgb = torch.where(m2, lin.clamp(min=0.0031308).pow(1./2.4).mul_(1.055).sub_(0.055), lin * 12.92)
+        del lin, m2
+        # gradient of clamp(2*rgb-1, -1, 1)
+        out = rgb * 2 - 1
+        grad = grad_out * 2 * ((out >= -1) & (out <= 1)).type_as(grad_out)
+        del rgb, out
+        grad = _color_matmul_T(M_XYZ2RGB, grad.mul_(d_lin))
+        del d_lin
+        grad = _color_matmul_T(M_LAB2F, grad.mul_(d_f))
+        return grad
+
+
 def rgb2lab(img_in):
     '''
     transformation froim RGB to Lab.
@@ -11,56 +131,15 @@ def rgb2lab(img_in):
     Output:
         img_out: (bsz, c, h, w) tensof of Lab image batch.
     '''
-    bsz, c, h, w = img_in.size()
-    # convert value to [0,1]
-    rgb = (img_in + 1 + 1e-5) * 0.5
-    # convert to XYZ space
-    # rgb = torch.where(rgb>0.04045, torch.pow((rgb+0.055)/1.055, 2.4), rgb/12.92)
-    # x = (rgb[:,0]*0.4124 + rgb[:,1]*0.3576 + rgb[:,2]*0.1805) / 0.95047
-    # y = (rgb[:,0]*0.2126 + rgb[:,1]*0.7152 + rgb[:,2]*0.0722) / 1.
-    # z = (rgb[:,0]*0.0193 + rgb[:,1]*0.1192 + rgb[:,2]*0.9505) / 1.08883
-    # xyz = torch.stack([x,y,z], dim=1)
-    # xyz = torch.where(xyz>0.008856, torch.pow(xyz, 1./3), 7.787*xyz + 16./116)
-    m1 = (rgb > 0.04045).float()
-    rgb = torch.pow((rgb+0.055)/1.055, 2.4) * m1 + rgb/12.92*(1-m1)
-    M1 = [[0.4124/0.95047, 0.3576/0.95047, 0.1805/0.95047], \
-          [0.2126, 0.7152, 0.0722],\
-          [0.0193/1.08883, 0.1192/1.08883, 0.9505/1.08883]]
-    M1 = rgb.new(M1).view(1,3,3)
-    xyz = torch.matmul(M1, rgb.view(bsz, c, h*w)).view(bsz, c, h, w)
-    m2 = (xyz>0.008856).float()
-    xyz = torch.pow(xyz, 1./3)*m2 + (xyz*7.787+16./116)*(1-m2)
-    # convert to Lab space
-    l = 116. * xyz[:,1] - 16
-    a = 500. * (xyz[:,0] - xyz[:,1])
-    b = 200. * (xyz[:,1] - xyz[:,2])
-
-    return torch.stack([l,a,b], dim=1)
+    return RGB2Lab.apply(img_in)
 
 
 def lab2rgb(img_in):
     '''
     transformation from Lab to RGB
     Input:
-        img_in: (bsz, c, h, w) tensor of Lab image batch 
+        img_in: (bsz, c, h, w) tensor of Lab image batch
     Output:
         img_out: (bsz, c, h, w) tensof of rgb image batch with value range (-1, 1)
     '''
-    # convert to XYZ space
-    y = (img_in[:,0] + 16.) / 116
-    x = img_in[:,1] / 500. + y
-    z = y - img_in[:,2] / 200.
-    xyz = torch.stack([x,y,z], dim=1)
-    xyz_pow_3 = xyz.pow(3)
-    xyz = torch.where(xyz_pow_3>0.008856, xyz_pow_3, (xyz-16./116)/7.787)
-    xyz = xyz * xyz.new([0.95047, 1.0, 1.08883]).view(1,3,1,1)
-    # convert to RGB space
-    r = xyz[:,0]*  3.2406 + xyz[:,1]* -1.5372 + xyz[:,2]* -0.4986
-    g = xyz[:,0]* -0.9689 + xyz[:,1]*  1.8758 + xyz[:,2]*  0.0415
-    b = xyz[:,0]*  0.0557 + xyz[:,1]* -0.2040 + xyz[:,2]*  1.0570
-
-    rgb = torch.stack([r,g,b], dim=1)
-    rgb = torch.where(rgb>0.0031308, 1.055*rgb.pow(1./2.4)-0.055, rgb*12.92)
-
-    return torch.clamp((rgb-0.5)/0.5, -1, 1)
-
+    return Lab2RGB.apply(img_in)
@@ -31,4 +31,15 @@ class ImagePool():
                 else:
                     return_images.append(image)
         return_images = Variable(torch.cat(return_images, 0))
-        return return_images
\ No newline at end of file
+        return return_images
+
+    def state_dict(self):
+        if self.pool_size == 0:
+            return {'pool_size': 0}
+        return {'pool_size': self.pool_size, 'num_imgs': self.num_imgs, 'images': list(self.images)}
+
+    def load_state_dict(self, state, cuda=False):
+        assert state['pool_size'] == self.pool_size, 'pool size does not match: %d vs %d' % (state['pool_size'], self.pool_size)
+        if self.pool_size > 0:
+            self.num_imgs = state['num_imgs']
+            self.images = [img.cuda() if cuda else img for img in state['images']]
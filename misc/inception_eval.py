@@ -0,0 +1,351 @@
+from __future__ import division, print_function
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import numpy as np
+import cv2
+
+import os
+import sys
+import glob
+import json
+import hashlib
+from multiprocessing.pool import ThreadPool
+
+# Inception Score and FID with a PyTorch Inception-v3 (torchvision architecture), streaming images in batches so that
+# memory does not grow with the number of images. Runs on CPU by default:
+#
+#     python -m misc.inception_eval PoseTransfer_7.5                      # IS of checkpoints/PoseTransfer_7.5/test/
+#     python -m misc.inception_eval PoseTransfer_7.5 --real_dir datasets/DF_Pose/Img/img_df/ --gpu 0
+#
+# Image directories can also be image archives written by test_pose_transfer_model.py --output_archive.
+#
+# Weights are read from a local state dict file (--weights), or from the weight registry ("inception_v3", see
+# util/weight_registry.py). Scores use ImageNet torchvision weights, so they are comparable between models evaluated by
+# this script, but not with numbers computed by the TensorFlow Inception graph (misc/inception_score.py).
+#
+# In-memory model outputs can be evaluated without writing images:
+#
+#     evaluator = InceptionEvaluator(gpu_ids=opt.gpu_ids)
+#     for data in loader:
+#         model.set_input(data)
+#         model.test()
+#         evaluator.add(model.output['img_out'])
+#     is_mean, is_std = evaluator.inception_score()
+#     fid = evaluator.fid(*load_stats(fn_real_stats))
+#
+# Statistics are accumulated on the fly: sum and sum of outer products of pool3 features (FID), and per-split sums of
+# class probabilities and of sum(p*log(p)) (IS). Samples are assigned to IS splits round-robin.
+#
+# Statistics of real images of a dataset split are cached next to the dataset (see get_real_stats):
+#
+#     datasets/DF_Pose/Stats/inception_pair_split_test.npz     mu, sigma, count, fingerprint
+#
+# The fingerprint is a hash of the image list and the preprocessing (Inception weights, input size, normalization), and
+# the statistics are recomputed when it changes. For a model id, the dataset settings (data_root, fn_split, img_dir) are
+# read from checkpoints/[id]/train_opt.json:
+#
+#     python -m misc.inception_eval PoseTransfer_7.5 --fid
+
+
+def decode_cv2(path):
+    '''
+    default decoder: image file (or sample of an image archive, see util/image_archive.py) -> RGB uint8 array (h, w, 3)
+    '''
+    import util.image_archive as image_archive
+    if image_archive.is_archive(os.path.dirname(path)):
+        return image_archive.imread(path)
+    img = cv2.imread(path)
+    if img is None:
+        raise IOError('cannot read image %s' % path)
+    return img[:,:,[2,1,0]]
+
+
+def list_images(image_dir):
+    '''
+    image files in image_dir, or sample paths if image_dir is an image archive
+    '''
+    import util.image_archive as image_archive
+    if image_archive.is_archive(image_dir):
+        return sorted(image_archive.list_paths(image_dir))
+    return sorted(glob.glob(os.path.join(image_dir, '*.jpg')) + glob.glob(os.path.join(image_dir, '*.png')))
+
+
+def iterate_images(file_list, batch_size=50, decoder=decode_cv2, num_threads=4):
+    '''
+    yield batches (lists) of decoded images. images are decoded by a pool of num_threads threads (decoder: path -> RGB
+    uint8 array), and the next batch is decoded while the current one is processed, so at most two batches are in memory.
+    '''
+    batches = [file_list[i:(i+batch_size)] for i in range(0, len(file_list), batch_size)]
+    if not batches:
+        return
+    pool = ThreadPool(num_threads)
+    try:
+        pending = pool.map_async(decoder, batches[0])
+        for i in range(len(batches)):
+            images = pending.get()
+            if i + 1 < len(batches):
+                pending = pool.map_async(decoder, batches[i+1])
+            yield images
+    finally:
+        pool.terminate()
+
+
+def load_inception(weights=''):
+    '''
+    torchvision Inception-v3 (without aux classifier) with weights from a state dict file, or from the weight registry
+    '''
+    import torchvision
+    try:
+        net = torchvision.models.Inception3(aux_logits=False, transform_input=False, init_weights=False)
+    except TypeError:
+        # torchvision < 0.8
+        net = torchvision.models.Inception3(aux_logits=False, transform_input=False)
+    if weights:
+        state_dict = torch.load(weights, map_location='cpu')
+    else:
+        import util.weight_registry as weight_registry
+        state_dict = weight_registry.load_state_dict('inception_v3')
+    net.load_state_dict({k: v for k, v in state_dict.items() if not k.startswith('AuxLogits.')})
+    return net
+
+
+class InceptionFeature(nn.Module):
+    '''
+    (pool3 feature, class probability) of RGB images in (-1, 1)
+    '''
+    def __init__(self, weights=''):
+        super(InceptionFeature, self).__init__()
+        self.net = load_inception(weights)
+        self.fc = self.net.fc
+        # the network outputs pool3 features, and logits are computed by self.fc
+        self.net.fc = nn.Sequential()
+        self.register_buffer('mean', torch.Tensor([0.485, 0.456, 0.406]).view(1,3,1,1))
+        self.register_buffer('std', torch.Tensor([0.229, 0.224, 0.225]).view(1,3,1,1))
+        self.eval()
+
+    def forward(self, x):
+        if x.size(2) != 299 or x.size(3) != 299:
+            x = F.interpolate(x, size=(299, 299), mode='bilinear', align_corners=False)
+        x = ((x + 1) * 0.5 - self.mean) / self.std
+        feat = self.net(x).view(x.size(0), -1)
+        prob = F.softmax(self.fc(feat), dim=1)
+        return feat, prob
+
+
+class InceptionEvaluator(object):
+    '''
+    accumulate Inception statistics of image batches for IS and FID
+    '''
+    def __init__(self, weights='', batch_size=50, splits=10, gpu_ids=[]):
+        self.batch_size = batch_size
+        self.splits = splits
+        self.device = torch.device('cuda', gpu_ids[0]) if len(gpu_ids) > 0 else torch.device('cpu')
+        self.net = InceptionFeature(weights).to(self.device)
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.feat_sum = None
+        self.feat_outer_sum = None
+        self.prob_sum = None
+        self.plogp_sum = torch.zeros(self.splits, dtype=torch.float64)
+        self.split_count = torch.zeros(self.splits, dtype=torch.float64)
+
+    def add(self, images):
+        '''
+        images: (bsz, 3, h, w) RGB tensor in (-1, 1), e.g. model.output['img_out']
+        '''
+        with torch.no_grad():
+            for i in range(0, images.size(0), self.batch_size):
+                feat, prob = self.net(images[i:(i+self.batch_size)].to(self.device).float())
+                self._accumulate(feat.double().cpu(), prob.double().cpu())
+
+    def add_uint8(self, images):
+        '''
+        images: list of RGB uint8 arrays (h, w, 3), e.g. a batch from iterate_images
+        '''
+        if len(set([img.shape for img in images])) > 1:
+            for img in images:
+                self.add_uint8([img])
+            return
+        x = torch.from_numpy(np.stack(images)).to(self.device).permute(0,3,1,2).float() / 127.5 - 1
+        self.add(x)
+
+    def add_files(self, file_list, decoder=decode_cv2, num_threads=4, verbose=True):
+        for i, images in enumerate(iterate_images(file_list, self.batch_size, decoder, num_threads)):
+            self.add_uint8(images)
+            if verbose:
+                print('\r[InceptionEvaluator] %d/%d' % (min((i+1)*self.batch_size, len(file_list)), len(file_list)), end='')
+                sys.stdout.flush()
+        if verbose:
+            print('')
+
+    def _accumulate(self, feat, prob):
+        n = feat.size(0)
+        if self.feat_sum is None:
+            self.feat_sum = feat.new_zeros(feat.size(1))
+            self.feat_outer_sum = feat.new_zeros(feat.size(1), feat.size(1))
+            self.prob_sum = prob.new_zeros(self.splits, prob.size(1))
+        self.feat_sum += feat.sum(dim=0)
+        self.feat_outer_sum += feat.t().mm(feat)
+        # round-robin assignment of samples to IS splits
+        split = torch.arange(self.count, self.count + n, dtype=torch.int64) % self.splits
+        self.prob_sum.index_add_(0, split, prob)
+        self.plogp_sum.index_add_(0, split, (prob * prob.clamp(min=1e-12).log()).sum(dim=1))
+        self.split_count.index_add_(0, split, torch.ones(n, dtype=torch.float64))
+        self.count += n
+
+    def feature_stats(self):
+        '''
+        mean and (unbiased) covariance of pool3 features, as float64 numpy arrays
+        '''
+        assert self.count > 1, 'at least 2 images are needed'
+        mu = self.feat_sum / self.count
+        sigma = (self.feat_outer_sum - self.count * torch.ger(mu, mu)) / (self.count - 1)
+        return mu.numpy(), sigma.numpy()
+
+    def inception_score(self):
+        '''
+        mean and std of exp(E[KL(p(y|x) || p(y))]) over splits
+        '''
+        scores = []
+        for i in range(self.splits):
+            if self.split_count[i] == 0:
+                continue
+            p_y = self.prob_sum[i] / self.split_count[i]
+            kl = self.plogp_sum[i] / self.split_count[i] - (p_y * p_y.clamp(min=1e-12).log()).sum()
+            scores.append(float(kl.exp()))
+        return np.mean(scores), np.std(scores)
+
+    def fid(self, mu_real, sigma_real):
+        mu, sigma = self.feature_stats()
+        return frechet_distance(mu, sigma, mu_real, sigma_real)
+
+
+def frechet_distance(mu1, sigma1, mu2, sigma2):
+    '''
+    |mu1-mu2|^2 + tr(sigma1 + sigma2 - 2*sqrt(sigma1*sigma2)). tr(sqrt(sigma1*sigma2)) is computed from the eigenvalues of
+    the symmetric matrix sqrt(sigma1)*sigma2*sqrt(sigma1), which avoids the complex results of a general matrix sqrt
+    '''
+    w, v = np.linalg.eigh(sigma1)
+    sqrt_sigma1 = (v * np.sqrt(np.clip(w, 0, None))).dot(v.T)
+    m = sqrt_sigma1.dot(sigma2).dot(sqrt_sigma1)
+    tr_covmean = np.sqrt(np.clip(np.linalg.eigvalsh((m + m.T) / 2), 0, None)).sum()
+    diff = mu1 - mu2
+    return float(diff.dot(diff) + np.trace(sigma1) + np.trace(sigma2) - 2 * tr_covmean)
+
+
+def save_stats(mu, sigma, filename, **kwargs):
+    # write to a temporary file first, so that an interrupted evaluation does not leave a broken cache
+    with open(filename + '.tmp', 'wb') as f:
+        np.savez(f, mu=mu, sigma=sigma, **kwargs)
+    os.rename(filename + '.tmp', filename)
+
+
+def load_stats(filename):
+    with np.load(filename) as f:
+        return f['mu'], f['sigma']
+
+
+def get_split_images(data_root, fn_split, img_dir, split='test'):
+    '''
+    real image files of a dataset split. for pair splits (DF_Pose pair_split.json: [(id_1, id_2), ...]), the target
+    images id_2, which are the ground truth of generated images
+    '''
+    id_list = json.load(open(os.path.join(data_root, fn_split)))[split]
+    id_list = sorted(set([s_id[1] if isinstance(s_id, (list, tuple)) else s_id for s_id in id_list]))
+    return [os.path.join(data_root, img_dir, s_id + '.jpg') for s_id in id_list]
+
+
+def _weights_id(weights):
+    if weights:
+        return '%s:%d' % (os.path.basename(weights), os.path.getsize(weights))
+    import util.weight_registry as weight_registry
+    fn_index = os.path.join(weight_registry.get_registry_dir(), 'index.json')
+    index = json.load(open(fn_index)) if os.path.isfile(fn_index) else {}
+    return 'registry:inception_v3:%s' % index.get('inception_v3', {}).get('sha256', '')
+
+
+def get_fingerprint(file_list, weights=''):
+    '''
+    hash of the image list (relative to the dataset, so that moving the dataset keeps the cache valid) and of the
+    preprocessing of InceptionFeature
+    '''
+    preprocess = {'weights': _weights_id(weights), 'input_size': 299, 'resize': 'bilinear', 'range': '(-1,1)->imagenet_mean_std', 'decoder': 'rgb_uint8'}
+    content = json.dumps({'images': [os.path.basename(fn) for fn in file_list], 'preprocess': preprocess}, sort_keys=True)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+def get_real_stats(data_root, fn_split, img_dir, split='test', evaluator=None, weights='', num_threads=4, gpu_ids=[]):
+    '''
+    (mu, sigma) of real images of a dataset split, loaded from [data_root]/Stats/inception_[split file]_[split].npz if its
+    fingerprint matches, otherwise computed (with evaluator, or a new InceptionEvaluator) and saved there
+    '''
+    file_list = get_split_images(data_root, fn_split, img_dir, split)
+    fingerprint = get_fingerprint(file_list, weights)
+    stats_dir = os.path.join(data_root, 'Stats')
+    fn_stats = os.path.join(stats_dir, 'inception_%s_%s.npz' % (os.path.splitext(os.path.basename(fn_split))[0], split))
+    if os.path.isfile(fn_stats):
+        with np.load(fn_stats) as f:
+            if str(f['fingerprint']) == fingerprint:
+                print('[InceptionEvaluator] load real image statistics from %s (%d images)' % (fn_stats, int(f['count'])))
+                return f['mu'], f['sigma']
+        print('[InceptionEvaluator] %s is outdated (image list or preprocessing changed)' % fn_stats)
+    if evaluator is None:
+        evaluator = InceptionEvaluator(weights, gpu_ids=gpu_ids)
+    else:
+        evaluator.reset()
+    print('[InceptionEvaluator] compute real image statistics of %s (%s, %d images)' % (data_root, split, len(file_list)))
+    evaluator.add_files(file_list, num_threads=num_threads)
+    mu, sigma = evaluator.feature_stats()
+    if not os.path.isdir(stats_dir):
+        os.makedirs(stats_dir)
+    save_stats(mu, sigma, fn_stats, count=evaluator.count, fingerprint=fingerprint)
+    print('[InceptionEvaluator] real image statistics saved to %s' % fn_stats)
+    return mu, sigma
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Inception Score and FID of generated images (PyTorch Inception-v3)')
+    parser.add_argument('id', type=str, help='model id (images in checkpoints/[id]/test/) or image directory')
+    parser.add_argument('--real_dir', type=str, default='', help='directory of real images for FID')
+    parser.add_argument('--real_stats', type=str, default='', help='.npz file of real image statistics for FID (see save_stats)')
+    parser.add_argument('--fid', action='store_true', help='FID w.r.t. cached statistics of real images of a dataset split (see get_real_stats)')
+    parser.add_argument('--data_root', type=str, default='', help='dataset for --fid. default: data_root in checkpoints/[id]/train_opt.json')
+    parser.add_argument('--fn_split', type=str, default='', help='split file for --fid. default: from train_opt.json')
+    parser.add_argument('--img_dir', type=str, default='', help='image dir for --fid. default: from train_opt.json')
+    parser.add_argument('--split', type=str, default='test')
+    parser.add_argument('--weights', type=str, default='', help='Inception-v3 state dict file. default: "inception_v3" in the weight registry')
+    parser.add_argument('--batch_size', type=int, default=50)
+    parser.add_argument('--num_threads', type=int, default=4, help='number of image decoding threads')
+    parser.add_argument('--splits', type=int, default=10, help='number of IS splits')
+    parser.add_argument('--gpu', type=int, default=-1, help='gpu id. -1 for CPU')
+    args = parser.parse_args()
+
+    test_dir = args.id if os.path.isdir(args.id) else os.path.join('checkpoints', args.id, 'test')
+    gpu_ids = [args.gpu] if args.gpu >= 0 else []
+    evaluator = InceptionEvaluator(args.weights, args.batch_size, args.splits, gpu_ids)
+    print('[InceptionEvaluator] test dir: %s' % test_dir)
+    evaluator.add_files(list_images(test_dir), num_threads=args.num_threads)
+    is_mean, is_std = evaluator.inception_score()
+    print('[InceptionEvaluator] inception_score: %.3f (std: %.3f)' % (is_mean, is_std))
+
+    if args.real_dir or args.real_stats or args.fid:
+        mu, sigma = evaluator.feature_stats()
+        if args.real_stats:
+            mu_real, sigma_real = load_stats(args.real_stats)
+        elif args.fid:
+            fn_opt = os.path.join('checkpoints', args.id, 'train_opt.json')
+            train_opt = json.load(open(fn_opt)) if os.path.isfile(fn_opt) else {}
+            data_root, fn_split, img_dir = [getattr(args, k) or train_opt.get(k) for k in ['data_root', 'fn_split', 'img_dir']]
+            assert data_root and fn_split and img_dir, 'set --data_root, --fn_split and --img_dir, or use a model id with train_opt.json'
+            mu_real, sigma_real = get_real_stats(data_root, fn_split, img_dir, args.split, evaluator, args.weights, args.num_threads)
+        else:
+            evaluator.reset()
+            print('[InceptionEvaluator] real dir: %s' % args.real_dir)
+            evaluator.add_files(list_images(args.real_dir), num_threads=args.num_threads)
+            mu_real, sigma_real = evaluator.feature_stats()
+        print('[InceptionEvaluator] FID: %.3f' % frechet_distance(mu, sigma, mu_real, sigma_real))
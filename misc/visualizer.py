@@ -79,7 +79,7 @@ class BaseVisualizer(object):
         log = 'pytorch version: %s\n' % torch.__version__
         print(log, file = self.f_log)
 
-    def print_train_error(self, iter_num, epoch, num_batch, lr, errors):
+    def print_train_error(self, iter_num, epoch, num_batch, lr, errors, profile=None):
         '''
         Display training log information on screen and output it to log file.
 
@@ -89,6 +89,7 @@ class BaseVisualizer(object):
             num_batch: number of minibatch in each epoch
             lr:         current learning rate
             errors:      error information
+            profile:    (optional) step timing summary printed in the next line (see util/timer.StepProfiler.format)
         '''
 
         if self.f_log is None:
@@ -103,6 +104,8 @@ class BaseVisualizer(object):
         log = '[%s] Train [Iter: %d, Epoch: %d, Prog: %d/%d (%.2f%%), t_cost: %.2f, ETA: %.1fh, lr: %.3e]  ' % \
             (self.opt.id, iter_num, epoch, epoch_step, num_batch, 100.*epoch_step/num_batch, t_per_step, eta, lr)
         log += '  '.join(['%s: %.6f' % (k,v) for k,v in errors.iteritems()])
+        if profile:
+            log += '\n[%s] %s' % (self.opt.id, profile)
 
         print(log)
         print(log, file = self.f_log)
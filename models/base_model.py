@@ -2,6 +2,11 @@ from __future__ import division, print_function
 
 import torch
 import os
+import util.distributed as distributed
+import util.checkpoint as checkpoint
+import util.timer as timer
+from misc.image_pool import ImagePool
+from misc.color_space import rgb2lab
 
 class BaseModel(object):
     def name(self):
@@ -16,6 +21,10 @@ class BaseModel(object):
 
         self.input = {}
         self.output = {}
+        # number of micro-batches processed by optimize_parameters (see start_accumulation)
+        self.accum_count = 0
+        # per-phase step timing (see util/timer.StepProfiler). a no-op unless opt.profile
+        self.profiler = timer.StepProfiler(enabled=bool('profile' in opt and opt.profile), sync=len(self.gpu_ids) > 0)
 
     def set_input(self, data):
         self.input = data
@@ -47,14 +56,284 @@ class BaseModel(object):
     def save(self, label):
         pass
 
+    ###################################
+    # gradient accumulation
+    ###################################
+    def start_accumulation(self):
+        '''
+        accumulate gradients over opt.accum_steps micro-batches (calls of optimize_parameters) before each optimizer step.
+        call at the beginning of optimize_parameters. return (zero_grad, step):
+            zero_grad: current micro-batch is the first one of an accumulation cycle. clear gradients before backward
+            step: current micro-batch is the last one. call step_optimizer after backward
+        gradient synchronization of DistributedDataParallel networks is only done in the last micro-batch.
+        '''
+        accum_steps = self.opt.accum_steps if 'accum_steps' in self.opt else 1
+        i = self.accum_count % accum_steps
+        self.accum_count += 1
+        zero_grad, step = (i == 0), (i == accum_steps - 1)
+        for net in vars(self).values():
+            distributed.set_grad_sync(net, step)
+        return zero_grad, step
+
+    def step_optimizer(self, optim):
+        '''
+        average accumulated gradients over micro-batches, then update parameters. losses (and gradients in check_grad
+        logging) are not scaled, so they are comparable with the setting without accumulation.
+        '''
+        accum_steps = self.opt.accum_steps if 'accum_steps' in self.opt else 1
+        with self.profiler.phase('optim_step'):
+            if accum_steps > 1:
+                for group in optim.param_groups:
+                    for p in group['params']:
+                        if p.grad is not None:
+                            p.grad.data.div_(accum_steps)
+            optim.step()
+
+    def get_grad(self, network):
+        return [None if p.grad is None else p.grad.data.clone() for p in network.parameters()]
+
+    def set_grad(self, network, grads):
+        '''
+        restore gradients saved by get_grad. used to discard the gradients of netD computed in the backward pass of the
+        generator when netD gradients are being accumulated.
+        '''
+        for p, g in zip(network.parameters(), grads):
+            if g is None:
+                p.grad = None
+            else:
+                p.grad.data.copy_(g)
+
+    def compute_output_grad_norms(self, output, terms):
+        '''
+        gradient norm of each weighted loss term w.r.t. a network output (e.g. img_out), saved as self.output[grad_name].
+        terms: [(grad_name, loss_name, loss_weight), ...]. terms whose loss is not in self.output are skipped.
+        gradients are computed by autograd.grad from each loss to output only (not through the network producing output),
+        and parameter gradients are not changed. call before the backward pass of the total loss.
+        '''
+        with self.profiler.phase('check_grad'):
+            for grad_name, loss_name, weight in terms:
+                if loss_name not in self.output:
+                    continue
+                grad, = torch.autograd.grad(self.output[loss_name] * weight, output, retain_graph=True, allow_unused=True)
+                self.output[grad_name] = grad.norm() if grad is not None else output.new_zeros([])
+
+    def get_lab(self, name):
+        '''
+        (L, ab) of the (-1, 1) rgb image self.output[name] for losses in Lab space: L scaled to (-1, 1) and repeated to 3
+        channels, ab scaled by 1/100. the conversion is cached per output name and reused while self.output[name] is the
+        same tensor, so that backward_D and compute_loss share the Lab images of img_out and img_tar. the cache holds at
+        most one tensor per name, also in test() and validation, which do not clear self.output.
+        '''
+        img = self.output[name]
+        cache = self.output.setdefault('lab_cache', {})
+        if name in cache and cache[name][0] is img:
+            return cache[name][1]
+        lab = rgb2lab(img)
+        rst = (((lab[:,0:1]-50.)/50.).repeat(1,3,1,1), lab[:,1:]/100.)
+        cache[name] = (img, rst)
+        return rst
+
+    ###################################
+    # discriminator
+    ###################################
+    def can_fuse_D(self, netD):
+        '''
+        whether netD gives the same output for a sample in a concatenated batch as in a separate batch. false if netD has
+        BatchNorm layers, whose training-mode statistics mix the samples of a batch (InstanceNorm or no norm is exact)
+        '''
+        return not any([isinstance(m, torch.nn.modules.batchnorm._BatchNorm) for m in netD.modules()])
+
+    def discriminate(self, netD, inputs):
+        '''
+        run netD on each tensor in inputs and return the list of outputs. if can_fuse_D(netD), inputs of the same size
+        are concatenated along the batch dimension and processed in one forward pass
+        '''
+        if len(inputs) > 1 and self.can_fuse_D(netD) and len(set([x.size()[1:] for x in inputs])) == 1:
+            return list(netD(torch.cat(inputs, dim=0)).split([x.size(0) for x in inputs], dim=0))
+        return [netD(x) for x in inputs]
+
+    def can_reuse_D_fake(self, netD, update_D, pool=None):
+        '''
+        whether the netD output on (non-detached) fake samples in backward_D can be reused for the generator GAN loss
+        instead of another netD forward pass. this is valid if
+            - netD is not updated between the two losses (update_D: optimizer step of netD before the generator backward)
+            - the fake pool returns the current fake samples (pool_size 0)
+            - netD is not wrapped by DistributedDataParallel (backward_D_params uses autograd.grad)
+        '''
+        return (not update_D) and (pool is None or pool.pool_size == 0) and distributed.unwrap_network(netD) is netD
+
+    def backward_D_params(self, netD, loss):
+        '''
+        accumulate the gradients of loss w.r.t netD parameters only, keeping the graph. used instead of loss.backward()
+        when the netD output is reused for the generator loss (see can_reuse_D_fake), so that the D loss does not
+        propagate into the generator
+        '''
+        params = [p for p in netD.parameters() if p.requires_grad]
+        grads = torch.autograd.grad(loss, params, retain_graph=True, allow_unused=True)
+        for p, g in zip(params, grads):
+            if g is None:
+                continue
+            if p.grad is None:
+                p.grad = g.detach()
+            else:
+                p.grad.data.add_(g.data)
+
+    def wrap_distributed(self):
+        '''
+        wrap networks that are updated by self.optimizers with DistributedDataParallel (see util/distributed.py). call after
+        initialize(). frozen networks and loss networks are not wrapped.
+        '''
+        optim_params = set([id(p) for optim in self.optimizers for group in optim.param_groups for p in group['params']])
+        wrapped = {} # id(network) -> wrapped network
+        names = []
+        for name, net in list(vars(self).items()):
+            if isinstance(net, torch.nn.Module) and any([id(p) in optim_params for p in net.parameters()]):
+                if id(net) not in wrapped:
+                    wrapped[id(net)] = distributed.wrap_network(net, self.gpu_ids, bool(self.opt.ddp_find_unused))
+                setattr(self, name, wrapped[id(net)])
+                names.append(name)
+        # some models also keep networks in a dict (e.g. MultimodalDesignerGAN_V3.modules)
+        for d in vars(self).values():
+            if isinstance(d, dict):
+                for k, net in d.items():
+                    if id(net) in wrapped:
+                        d[k] = wrapped[id(net)]
+        return sorted(names)
+
+    ###################################
+    # checkpoint saving
+    ###################################
+    def get_checkpoint_writer(self):
+        '''
+        with opt.async_save, checkpoints are written by a background thread (see util/checkpoint.py). return None for
+        synchronous saving.
+        '''
+        if not ('async_save' in self.opt and self.opt.async_save):
+            return None
+        if getattr(self, 'checkpoint_writer', None) is None:
+            self.checkpoint_writer = checkpoint.CheckpointWriter(keep_last=self.opt.keep_last_epochs if self.is_train else 0)
+        return self.checkpoint_writer
+
+    def flush_checkpoints(self):
+        '''
+        block until all checkpoints are written to disk
+        '''
+        if getattr(self, 'checkpoint_writer', None) is not None:
+            self.checkpoint_writer.flush()
+
+    def _write_checkpoint(self, obj, save_path):
+        writer = self.get_checkpoint_writer()
+        if writer is None:
+            checkpoint.atomic_save(obj, save_path)
+            self._prune_checkpoints(save_path)
+        else:
+            writer.save(obj, save_path)
+
+    def _prune_checkpoints(self, save_path):
+        '''
+        remove old epochs of the network/optimizer of save_path after a synchronous write (CheckpointWriter does this in its
+        thread with async_save). only done in training, so that files saved by other scripts (e.g. int8 weights) do not
+        remove checkpoints
+        '''
+        if self.is_train and 'keep_last_epochs' in self.opt:
+            checkpoint.prune_old_epochs(save_path, self.opt.keep_last_epochs)
+
+    def is_frozen_network(self, network):
+        '''
+        a network is frozen if none of its parameters is updated by self.optimizers
+        '''
+        if not getattr(self, 'optimizers', None):
+            return False
+        optim_params = set([id(p) for optim in self.optimizers for group in optim.param_groups for p in group['params']])
+        return not any([id(p) in optim_params for p in network.parameters()])
+
+    ###################################
+    # resumable training state
+    ###################################
+    def get_train_state(self):
+        '''
+        all model states needed to resume training: networks (attributes named "net*" and networks updated by optimizers),
+        optimizers, schedulers, image pools and the gradient accumulation counter. tensors are not copied.
+        '''
+        optim_params = set([id(p) for optim in self.optimizers for group in optim.param_groups for p in group['params']])
+        state = {'networks': {}, 'image_pools': {}, 'accum_count': self.accum_count}
+        for name, item in vars(self).items():
+            if isinstance(item, torch.nn.Module):
+                if name.startswith('net') or any([id(p) in optim_params for p in item.parameters()]):
+                    state['networks'][name] = distributed.unwrap_network(item).state_dict()
+            elif isinstance(item, ImagePool):
+                state['image_pools'][name] = item.state_dict()
+        state['optimizers'] = [optim.state_dict() for optim in self.optimizers]
+        state['schedulers'] = [scheduler.state_dict() for scheduler in self.schedulers]
+        return state
+
+    def save_train_state(self, loop_state, save_path=None):
+        '''
+        save model states (see get_train_state), loop_state of the training script (epoch, step, sampler state, etc.) and
+        random states to one file (default: checkpoints/id/train_state.pth). written in background if opt.async_save.
+        the state should be saved when no gradient accumulation is pending.
+        '''
+        if save_path is None:
+            save_path = os.path.join(self.save_dir, 'train_state.pth')
+        state = checkpoint.snapshot(self.get_train_state())
+        state['loop'] = loop_state
+        state['rng'] = checkpoint.snapshot(checkpoint.get_rng_state())
+        writer = self.get_checkpoint_writer()
+        if writer is None:
+            checkpoint.atomic_save(state, save_path)
+        else:
+            writer.save(state, save_path, replace_pending=True)
+
+    def load_train_state(self, save_path=None):
+        '''
+        restore states saved by save_train_state. return loop_state. random states should be restored by the training script
+        (checkpoint.set_rng_state(loop_state['rng'])) after creating data loaders.
+        '''
+        if save_path is None:
+            save_path = os.path.join(self.save_dir, 'train_state.pth')
+        state = checkpoint.load(save_path)
+        for name, state_dict in state['networks'].items():
+            distributed.unwrap_network(getattr(self, name)).load_state_dict(state_dict)
+        for name, pool_state in state['image_pools'].items():
+            getattr(self, name).load_state_dict(pool_state, cuda=len(self.gpu_ids) > 0)
+        for optim, optim_state in zip(self.optimizers, state['optimizers']):
+            optim.load_state_dict(optim_state)
+        for scheduler, scheduler_state in zip(self.schedulers, state['schedulers']):
+            scheduler.load_state_dict(scheduler_state)
+        self.accum_count = state['accum_count']
+        print('[%s] load training state from %s' % (self.name(), save_path))
+        loop_state = state['loop']
+        loop_state['rng'] = state['rng']
+        return loop_state
+
     # helper loading function that can be used by subclasses
     def save_network(self, network, network_label, epoch_label, gpu_ids):
+        '''
+        state dict is copied to host memory without moving the network (see util/checkpoint.py). a frozen network
+        (e.g. netT_s1 of TwoStagePoseTransferModel when train_s1 == 0) is only written once: later checkpoints are linked to
+        the first file, unless its buffers (e.g. BatchNorm running statistics) have changed.
+        '''
         save_filename = '%s_net_%s.pth' % (epoch_label, network_label)
         save_path = os.path.join(self.save_dir, save_filename)
-        torch.save(network.cpu().state_dict(), save_path)
-
-        if len(gpu_ids) and torch.cuda.is_available():
-            network.cuda(gpu_ids[0])
+        network = distributed.unwrap_network(network)
+        if self.is_frozen_network(network):
+            if not hasattr(self, 'frozen_checkpoints'):
+                self.frozen_checkpoints = {}
+            buffers = [b.detach().cpu() for b in network.buffers()]
+            if network_label in self.frozen_checkpoints:
+                last_buffers, last_path = self.frozen_checkpoints[network_label]
+                if all([torch.equal(b1, b2) for b1, b2 in zip(buffers, last_buffers)]):
+                    if last_path != save_path:
+                        writer = self.get_checkpoint_writer()
+                        if writer is None:
+                            checkpoint.atomic_link(last_path, save_path)
+                            self._prune_checkpoints(save_path)
+                        else:
+                            writer.link(last_path, save_path)
+                        self.frozen_checkpoints[network_label] = (buffers, save_path)
+                    return
+            self.frozen_checkpoints[network_label] = (buffers, save_path)
+        self._write_checkpoint(checkpoint.snapshot(network.state_dict()), save_path)
 
     def load_network(self, network, network_label, epoch_label, model_id = None, forced = True):
         save_filename = '%s_net_%s.pth' % (epoch_label, network_label)
@@ -68,13 +347,43 @@ class BaseModel(object):
         if (not forced) and (not os.path.isfile(save_path)):
             print('[%s] FAIL to load [%s] parameters from %s' % (self.name(), network_label, save_path))
         else:
-            network.load_state_dict(torch.load(save_path))
+            distributed.unwrap_network(network).load_state_dict(torch.load(save_path))
             print('[%s] load [%s] parameters from %s' % (self.name(), network_label, save_path))
 
+    def load_int8_network(self, network, network_label, epoch_label, model_id = None):
+        '''
+        load int8 weights created by quantize_pose_transfer_model.py (saved as "[epoch]_net_[label]_int8.pth"). network is
+        converted to int8 in place. networks that are not supported by int8_quantization are loaded in fp32.
+        '''
+        import int8_quantization
+        if not int8_quantization.is_quantizable(network):
+            print('[%s] [%s] (%s) does not support int8, load fp32 parameters' % (self.name(), network_label, network.__class__.__name__))
+            self.load_network(network, network_label, epoch_label, model_id)
+            return
+        assert not self.gpu_ids, 'int8 network only runs on cpu'
+        int8_quantization.create_int8_network(network, input_size=self.opt.fine_size)
+        self.load_network(network, network_label + '_int8', epoch_label, model_id)
+
+    def reload_networks(self, epoch_label):
+        '''
+        load the weights of epoch_label into all networks (attributes "net*") having a checkpoint of that epoch in
+        save_dir, so that several epochs of a model can be evaluated by one model instance (see sweep_pose_transfer_model.py).
+        return names of the loaded networks.
+        '''
+        loaded = []
+        for name, network in sorted(vars(self).items()):
+            if name.startswith('net') and isinstance(network, torch.nn.Module):
+                if os.path.isfile(os.path.join(self.save_dir, '%s_net_%s.pth' % (epoch_label, name))):
+                    self.load_network(network, name, epoch_label)
+                    loaded.append(name)
+        assert loaded, 'no network checkpoint of epoch %s in %s' % (epoch_label, self.save_dir)
+        self.opt.which_epoch = epoch_label
+        return loaded
+
     def save_optim(self, optim, optim_label, epoch_label):
         save_filename = '%s_optim_%s.pth'%(epoch_label, optim_label)
         save_path = os.path.join(self.save_dir, save_filename)
-        torch.save(optim.state_dict(), save_path)
+        self._write_checkpoint(checkpoint.snapshot(optim.state_dict()), save_path)
         
     def load_optim(self, optim, optim_label, epoch_label):
         save_filename = '%s_optim_%s.pth'%(epoch_label, optim_label)
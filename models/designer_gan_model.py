@@ -153,22 +153,32 @@ class DesignerGAN(BaseModel):
             self.forward()
 
 
-    def backward_D(self):
+    def backward_D(self, reuse_fake=False):
+        '''
+        reuse_fake: keep the netD output on the current (non-detached) fake samples for the GAN loss in backward_G.
+        see BaseModel.can_reuse_D_fake
+        '''
         # fake
         # here we use masked images
-        repr_fake = self.encode_shape(self.input['lm_map'], self.input['seg_mask'], self.input['edge_map'], self.output['img_fake'].detach())
-        repr_fake = self.fake_pool.query(repr_fake.data)
-        pred_fake = self.netD(repr_fake)
-        self.output['loss_D_fake'] = self.crit_GAN(pred_fake, False)
-        
+        if reuse_fake:
+            repr_fake = self.encode_shape(self.input['lm_map'], self.input['seg_mask'], self.input['edge_map'], self.output['img_fake'])
+        else:
+            repr_fake = self.encode_shape(self.input['lm_map'], self.input['seg_mask'], self.input['edge_map'], self.output['img_fake'].detach())
+            repr_fake = self.fake_pool.query(repr_fake.data)
         # real
         repr_real = self.encode_shape(self.input['lm_map'], self.input['seg_mask'], self.input['edge_map'], self.output['img_real'])
-        pred_real = self.netD(repr_real)
+        # real and fake samples in one netD pass if the norm layer permits (see BaseModel.discriminate)
+        pred_fake, pred_real = self.discriminate(self.netD, [repr_fake, repr_real])
+        self.output['loss_D_fake'] = self.crit_GAN(pred_fake, False)
         self.output['loss_D_real'] = self.crit_GAN(pred_real, True)
 
         # combined loss
         self.output['loss_D'] = (self.output['loss_D_real'] + self.output['loss_D_fake']) * 0.5
-        self.output['loss_D'].backward()
+        if reuse_fake:
+            self.output['D_pred_fake'] = pred_fake
+            self.backward_D_params(self.netD, self.output['loss_D'])
+        else:
+            self.output['loss_D'].backward()
 
     def backward_D_wgangp(self):
         # optimize netD using wasserstein gan loss with gradient penalty. 
@@ -207,13 +217,16 @@ class DesignerGAN(BaseModel):
         # print('D_fake: %f, D_real: %f, gp: %f' %(self.output['loss_D_fake'].data[0], self.output['loss_D_real'].data[0], self.output['loss_gp'].data[0]))
 
     def backward_G(self):
-        repr_fake = self.encode_shape(self.input['lm_map'], self.input['seg_mask'], self.input['edge_map'], self.output['img_fake'])
         self.output['loss_G'] = 0
         # GAN Loss
         if self.opt.which_gan == 'wgan':
+            repr_fake = self.encode_shape(self.input['lm_map'], self.input['seg_mask'], self.input['edge_map'], self.output['img_fake'])
             disc_fake = self.netD(repr_fake)
             self.output['loss_G_GAN'] = -disc_fake.mean()
+        elif 'D_pred_fake' in self.output:
+            self.output['loss_G_GAN'] = self.crit_GAN(self.output['D_pred_fake'], True)
         else:
+            repr_fake = self.encode_shape(self.input['lm_map'], self.input['seg_mask'], self.input['edge_map'], self.output['img_fake'])
             pred_fake = self.netD(repr_fake)
             self.output['loss_G_GAN'] = self.crit_GAN(pred_fake, True)
         self.output['loss_G'] += self.output['loss_G_GAN'] * self.opt.loss_weight_GAN
@@ -303,7 +316,7 @@ class DesignerGAN(BaseModel):
         if self.opt.which_gan == 'wgan':
             self.backward_D_wgangp()
         else:
-            self.backward_D()
+            self.backward_D(reuse_fake=self.can_reuse_D_fake(self.netD, train_D, self.fake_pool))
 
         if train_D:
             self.optim_D.step()
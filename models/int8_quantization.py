@@ -0,0 +1,214 @@
+from __future__ import division, print_function
+
+import torch
+import torch.nn as nn
+import networks
+
+import copy
+import functools
+
+###############################################################################
+# Post-training int8 quantization of pose transfer generators (CPU inference)
+# Workflow (see quantize_pose_transfer_model.py):
+#   1. prepare_int8(net): fold BatchNorm into convolutions, and replace the
+#      quantizable submodules of net with observed FX graph modules
+#   2. run net on calibration data
+#   3. convert_int8(net): convert observed modules to int8 modules
+# Quantized submodules take and return fp32 tensors, so the network keeps its
+# original interface. create_int8_network(net) builds the same structure without
+# calibration, which is used to load saved int8 weights (BaseModel.load_int8_network).
+###############################################################################
+
+class _SingleInputBlock(nn.Module):
+    '''
+    VUnetResidualBlock called without the skip input "a". FX tracing treats all forward arguments as inputs, so the
+    branch on "a is None" has to be resolved outside.
+    '''
+    def __init__(self, block):
+        super(_SingleInputBlock, self).__init__()
+        self.block = block
+
+    def forward(self, x):
+        return self.block(x)
+
+
+def _is_foldable_bn(m, num_features):
+    return isinstance(m, nn.BatchNorm2d) and m.track_running_stats and m.num_features == num_features
+
+
+def _fold_conv_bn(conv, bn, upscale=1):
+    '''
+    return a copy of conv with bn folded into it.
+    upscale: upscale factor of a PixelShuffle layer between conv and bn
+    '''
+    transposed = isinstance(conv, nn.ConvTranspose2d)
+    std = (bn.running_var + bn.eps).sqrt()
+    if bn.affine:
+        scale = bn.weight.data / std
+        shift = bn.bias.data - bn.running_mean * scale
+    else:
+        scale = 1. / std
+        shift = -bn.running_mean * scale
+    if upscale > 1:
+        # PixelShuffle maps channel c*r^2+k of conv output to channel c
+        scale = scale.repeat_interleave(upscale**2)
+        shift = shift.repeat_interleave(upscale**2)
+    conv_fold = copy.deepcopy(conv)
+    if transposed:
+        conv_fold.weight.data = conv.weight.data * scale.view(1, -1, 1, 1)
+    else:
+        conv_fold.weight.data = conv.weight.data * scale.view(-1, 1, 1, 1)
+    bias = conv.bias.data if conv.bias is not None else torch.zeros_like(scale)
+    conv_fold.bias = nn.Parameter(bias * scale + shift)
+    return conv_fold
+
+
+def fold_batch_norm(net):
+    '''
+    fold BatchNorm layers into preceding convolutions (using running statistics), in place. supported patterns:
+        Sequential: Conv2d/ConvTranspose2d -> [PixelShuffle ->] BatchNorm2d
+        VUnetResidualBlock: conv -> norm_layer
+    folded BatchNorm layers are replaced by networks.Identity. return number of folded layers
+    '''
+    count = 0
+    for module in list(net.modules()):
+        if isinstance(module, nn.Sequential):
+            layers = list(module._modules.items())
+            for i, (name, m) in enumerate(layers):
+                if not isinstance(m, (nn.Conv2d, nn.ConvTranspose2d)):
+                    continue
+                j = i + 1
+                upscale = 1
+                if j < len(layers) and isinstance(layers[j][1], nn.PixelShuffle):
+                    upscale = layers[j][1].upscale_factor
+                    j += 1
+                if j < len(layers) and _is_foldable_bn(layers[j][1], m.out_channels // upscale**2):
+                    module._modules[name] = _fold_conv_bn(m, layers[j][1], upscale)
+                    module._modules[layers[j][0]] = networks.Identity()
+                    count += 1
+        elif isinstance(module, networks.VUnetResidualBlock):
+            if _is_foldable_bn(module.norm_layer, module.conv.out_channels):
+                module.conv = _fold_conv_bn(module.conv, module.norm_layer)
+                module.norm_layer = None
+                count += 1
+    return count
+
+
+def get_quantizable_modules(net):
+    '''
+    names of the submodules (direct children) of net which will be quantized
+    '''
+    if isinstance(net, networks.VariationalUnet):
+        return [name for name, _ in net.named_children()]
+    elif isinstance(net, (networks.ResnetGenerator, networks.UnetGenerator_v2)):
+        return ['model']
+    elif isinstance(net, networks.LocalPatchEncoder):
+        return ['encoder', 'reducer']
+    else:
+        return []
+
+
+def is_quantizable(net):
+    return len(get_quantizable_modules(net)) > 0
+
+
+def example_forward(net, input_size=256):
+    '''
+    run net on zero inputs (in the way it is called at test time)
+    '''
+    if isinstance(net, networks.VariationalUnet):
+        x = torch.zeros(1, net.input_nc_enc, net.input_size_dec, net.input_size_dec)
+        c = torch.zeros(1, net.input_nc_dec, net.input_size_dec, net.input_size_dec)
+        return net(x, c, c, mode='transfer', single_device=True)
+    elif isinstance(net, (networks.ResnetGenerator, networks.UnetGenerator_v2)):
+        input_nc = [m for m in net.model.modules() if isinstance(m, nn.Conv2d)][0].in_channels
+        return net(torch.zeros(1, input_nc, input_size, input_size), single_device=True)
+    elif isinstance(net, networks.LocalPatchEncoder):
+        patches = torch.zeros(1, net.n_patch, net.input_nc, net.input_size, net.input_size)
+        joint_tar = torch.zeros(1, net.n_patch, input_size, input_size)
+        return net(patches, joint_tar, single_device=True)
+    else:
+        raise NotImplementedError()
+
+
+def _record_module_inputs(net, names, func):
+    '''
+    call func() and record the first positional inputs of submodules in names
+    '''
+    inputs = {}
+    def _hook(name, module, args):
+        if name not in inputs:
+            inputs[name] = args
+    handles = [getattr(net, name).register_forward_pre_hook(functools.partial(_hook, name)) for name in names]
+    try:
+        with torch.no_grad():
+            func()
+    finally:
+        for h in handles:
+            h.remove()
+    return inputs
+
+
+def _get_qconfig_mapping(backend):
+    try:
+        from torch.ao.quantization import get_default_qconfig_mapping
+        return get_default_qconfig_mapping(backend)
+    except ImportError:
+        # torch < 1.13. quantized ConvTranspose2d does not support per-channel weight observer
+        return {
+            '': torch.quantization.get_default_qconfig(backend),
+            'object_type': [(nn.ConvTranspose2d, torch.quantization.default_qconfig)],
+        }
+
+
+def _prepare_fx(module, qconfig_mapping, example_inputs):
+    from torch.quantization.quantize_fx import prepare_fx
+    try:
+        return prepare_fx(module, qconfig_mapping, example_inputs)
+    except TypeError:
+        # torch < 1.13
+        return prepare_fx(module, qconfig_mapping)
+
+
+def prepare_int8(net, input_size=256, backend='fbgemm'):
+    '''
+    fold BatchNorm and insert observers, in place. net should be on CPU.
+    input_size: image size used to run example inputs through ResnetGenerator/UnetGenerator_v2/LocalPatchEncoder
+    '''
+    torch.backends.quantized.engine = backend
+    net.eval()
+    fold_batch_norm(net)
+    names = get_quantizable_modules(net)
+    # modules that are not called at test time (not recorded) stay in fp32
+    example_inputs = _record_module_inputs(net, names, lambda: example_forward(net, input_size))
+    qconfig_mapping = _get_qconfig_mapping(backend)
+    net.int8_modules = []
+    for name in names:
+        if name not in example_inputs:
+            continue
+        module = getattr(net, name)
+        args = example_inputs[name]
+        if isinstance(module, networks.VUnetResidualBlock) and len(args) == 1:
+            module = _SingleInputBlock(module)
+        setattr(net, name, _prepare_fx(module, qconfig_mapping, args))
+        net.int8_modules.append(name)
+    return net
+
+
+def convert_int8(net):
+    '''
+    convert observed modules (after calibration) to int8, in place.
+    '''
+    from torch.quantization.quantize_fx import convert_fx
+    for name in net.int8_modules:
+        setattr(net, name, convert_fx(getattr(net, name)))
+    return net
+
+
+def create_int8_network(net, input_size=256, backend='fbgemm'):
+    '''
+    create the structure of an int8 network without calibration, to load int8 weights
+    '''
+    prepare_int8(net, input_size, backend)
+    convert_int8(net)
+    return net
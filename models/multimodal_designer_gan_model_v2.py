@@ -293,21 +293,32 @@ class MultimodalDesignerGAN_V2(BaseModel):
                     v.volatile = True
             self.forward(mode=mode, check_grad=False)
 
-    def backward_D(self):
+    def backward_D(self, reuse_fake=False):
+        '''
+        reuse_fake: keep the netD output on the current (non-detached) fake samples for the GAN loss in backward_G.
+        see BaseModel.can_reuse_D_fake
+        '''
         # PSNR
         self.output['PSNR'] = self.crit_psnr(self.output['img_fake'], self.output['img_real'])
         # fake
-        repr_fake = self.get_sample_repr_for_D('fake', detach_image=True)
-        repr_fake = self.fake_pool.query(repr_fake.data)
-        pred_fake = self.netD(repr_fake)
-        self.output['loss_D_fake'] = self.crit_GAN(pred_fake, False)
+        if reuse_fake:
+            repr_fake = self.get_sample_repr_for_D('fake', detach_image=False)
+        else:
+            repr_fake = self.get_sample_repr_for_D('fake', detach_image=True)
+            repr_fake = self.fake_pool.query(repr_fake.data)
         # real
         repr_real = self.get_sample_repr_for_D('real')
-        pred_real = self.netD(repr_real)
+        # real and fake samples in one netD pass if the norm layer permits (see BaseModel.discriminate)
+        pred_fake, pred_real = self.discriminate(self.netD, [repr_fake, repr_real])
+        self.output['loss_D_fake'] = self.crit_GAN(pred_fake, False)
         self.output['loss_D_real'] = self.crit_GAN(pred_real, True)
         # combine loss
         self.output['loss_D'] = (self.output['loss_D_real'] + self.output['loss_D_fake']) * 0.5 * self.opt.loss_weight_GAN
-        self.output['loss_D'].backward()
+        if reuse_fake:
+            self.output['D_pred_fake'] = pred_fake
+            self.backward_D_params(self.netD, self.output['loss_D'])
+        else:
+            self.output['loss_D'].backward()
 
     def backward_D_wgangp(self):
         raise NotImplementedError('WGAN-GP not supported!')
@@ -322,7 +333,10 @@ class MultimodalDesignerGAN_V2(BaseModel):
             img_fake = self.output['img_fake_trans']
         self.output['loss_G'] = 0
         # GAN loss
-        pred_fake = self.netD(repr_fake)
+        if mode in {'normal', 'dual'} and 'D_pred_fake' in self.output:
+            pred_fake = self.output['D_pred_fake']
+        else:
+            pred_fake = self.netD(repr_fake)
         self.output['loss_G_GAN'] = self.crit_GAN(pred_fake, True)
         self.output['loss_G'] += self.output['loss_G_GAN'] * self.opt.loss_weight_GAN
         # L1 loss
@@ -411,7 +425,7 @@ class MultimodalDesignerGAN_V2(BaseModel):
         self.forward(fwd_mode, check_grad)
         # optimize D
         self.optim_D.zero_grad()
-        self.backward_D()
+        self.backward_D(reuse_fake=self.can_reuse_D_fake(self.netD, train_D, self.fake_pool))
         if train_D:
             self.optim_D.step()
         # optimize G
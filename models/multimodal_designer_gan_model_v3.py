@@ -236,27 +236,33 @@ class MultimodalDesignerGAN_V3(BaseModel):
                     v.volatile = True
             self.forward(mode=mode)
 
-    def backward_D(self):
+    def backward_D(self, reuse_fake=False):
+        '''
+        reuse_fake: keep the netD outputs on the current (non-detached) rec and gen samples for the GAN loss in
+        backward_G. see BaseModel.can_reuse_D_fake
+        '''
         # PSNR
         self.output['PSNR'] = self.crit_psnr(self.output['img_rec'], self.output['img_real'])
         if self.opt.D_output_type == 'binary':
-            # real
             repr_real = self.get_sample_repr_for_D('real')
-            pred_real = self.netD(repr_real)
+            repr_rec = self.get_sample_repr_for_D('rec', detach=not reuse_fake)
+            repr_gen = self.get_sample_repr_for_D('gen', detach=not reuse_fake)
+            # real, rec and gen samples in one netD pass if the norm layer permits (see BaseModel.discriminate)
+            pred_real, pred_rec, pred_gen = self.discriminate(self.netD, [repr_real, repr_rec, repr_gen])
             self.output['loss_D_real'] = self.crit_GAN(pred_real, True)
-            # rec
-            repr_rec = self.get_sample_repr_for_D('rec', detach=True)
-            pred_rec = self.netD(repr_rec)
             self.output['loss_D_rec'] = self.crit_GAN(pred_rec, False)
-            # gen
-            repr_gen = self.get_sample_repr_for_D('gen', detach=True)
-            pred_gen = self.netD(repr_gen)
             self.output['loss_D_gen'] = self.crit_GAN(pred_gen, False)
             # combine loss
             self.output['loss_D'] =(self.output['loss_D_real']*0.5 + self.output['loss_D_rec']*0.25 + self.output['loss_D_gen']*0.25)* self.opt.loss_weight_GAN
+            if reuse_fake:
+                self.output['D_pred_rec'] = pred_rec
+                self.output['D_pred_gen'] = pred_gen
         elif self.opt.D_output_type == 'class':
             raise NotImplementedError()
-        self.output['loss_D'].backward()
+        if reuse_fake:
+            self.backward_D_params(self.netD, self.output['loss_D'])
+        else:
+            self.output['loss_D'].backward()
 
     def backward_D_wgangp(self):
         raise NotImplementedError('WGAN-GP not supported!')
@@ -264,33 +270,40 @@ class MultimodalDesignerGAN_V3(BaseModel):
     def backward_G(self, mode='normal'):
         self.output['loss_G'] = 0
         # GAN Loss
-        repr_rec = self.get_sample_repr_for_D('rec', detach=False)
-        pred_rec = self.netD(repr_rec)
-        repr_gen = self.get_sample_repr_for_D('gen', detach=False)
-        pred_gen = self.netD(repr_gen)
-        if self.opt.D_output_type == 'binary':
-            self.output['loss_G_GAN_rec'] = self.crit_GAN(pred_rec, True)
-            self.output['loss_G_GAN_gen'] = self.crit_GAN(pred_gen, True)
-            self.output['loss_G_GAN'] = (self.output['loss_G_GAN_rec'] + self.output['loss_G_GAN_gen']) * 0.5
-            self.output['loss_G'] += self.output['loss_G_GAN'] * self.opt.loss_weight_GAN
-        elif self.opt.D_output_type == 'class':
-            raise NotImplementedError()
+        with self.profiler.phase('loss_G_GAN'):
+            if 'D_pred_rec' in self.output:
+                pred_rec, pred_gen = self.output['D_pred_rec'], self.output['D_pred_gen']
+            else:
+                repr_rec = self.get_sample_repr_for_D('rec', detach=False)
+                repr_gen = self.get_sample_repr_for_D('gen', detach=False)
+                pred_rec, pred_gen = self.discriminate(self.netD, [repr_rec, repr_gen])
+            if self.opt.D_output_type == 'binary':
+                self.output['loss_G_GAN_rec'] = self.crit_GAN(pred_rec, True)
+                self.output['loss_G_GAN_gen'] = self.crit_GAN(pred_gen, True)
+                self.output['loss_G_GAN'] = (self.output['loss_G_GAN_rec'] + self.output['loss_G_GAN_gen']) * 0.5
+                self.output['loss_G'] += self.output['loss_G_GAN'] * self.opt.loss_weight_GAN
+            elif self.opt.D_output_type == 'class':
+                raise NotImplementedError()
         # L1 loss
-        self.output['loss_G_L1'] = self.crit_L1(self.output['img_rec'], self.output['img_real'])
+        with self.profiler.phase('loss_G_L1'):
+            self.output['loss_G_L1'] = self.crit_L1(self.output['img_rec'], self.output['img_real'])
         self.output['loss_G'] += self.output['loss_G_L1'] * self.opt.loss_weight_L1
         # VGG loss
         if self.opt.loss_weight_vgg > 0:
-            self.output['loss_G_VGG'] = self.crit_vgg(self.output['img_rec'], self.output['img_real'])
+            with self.profiler.phase('loss_G_VGG'):
+                self.output['loss_G_VGG'] = self.crit_vgg(self.output['img_rec'], self.output['img_real'])
+                self.output['loss_G_VGG_gen'] = self.crit_vgg(self.output['img_gen'], self.output['img_real'])
             self.output['loss_G'] += self.output['loss_G_VGG'] * self.opt.loss_weight_vgg
-            self.output['loss_G_VGG_gen'] = self.crit_vgg(self.output['img_gen'], self.output['img_real'])
             self.output['loss_G'] += self.output['loss_G_VGG_gen'] * self.opt.loss_weight_vgg_gen
         # segmentation loss
         if self.opt.G_output_seg:
-            self.output['loss_G_seg_rec'] = self.calc_seg_loss(self.output['seg_pred_rec'], self.input['seg_map'])
+            with self.profiler.phase('loss_G_seg'):
+                self.output['loss_G_seg_rec'] = self.calc_seg_loss(self.output['seg_pred_rec'], self.input['seg_map'])
+                self.output['loss_G_seg_gen'] = self.calc_seg_loss(self.output['seg_pred_gen'], self.input['seg_map'])
             self.output['loss_G'] += self.output['loss_G_seg_rec'] * self.opt.loss_weight_seg
-            self.output['loss_G_seg_gen'] = self.calc_seg_loss(self.output['seg_pred_gen'], self.input['seg_map'])
             self.output['loss_G'] += self.output['loss_G_seg_gen'] * self.opt.loss_weight_seg_gen
-        self.output['loss_G'].backward()
+        with self.profiler.phase('backward'):
+            self.output['loss_G'].backward()
        
 
 
@@ -300,22 +313,35 @@ class MultimodalDesignerGAN_V3(BaseModel):
 
     def optimize_parameters(self, train_D = True, train_G = True, check_grad = False):
         mode = 'normal'
+        # gradients are accumulated over opt.accum_steps micro-batches (see BaseModel.start_accumulation). train_D and
+        # train_G of the last micro-batch decide whether the optimizers step
+        zero_grad, step = self.start_accumulation()
         # forward
         self.output = {} # clear previous output
-        self.forward(mode)
+        with self.profiler.phase('forward'):
+            self.forward(mode)
         # optimize D
-        self.optim_D.zero_grad()
-        self.backward_D()
-        if train_D:
-            self.optim_D.step()
+        if zero_grad:
+            self.optim_D.zero_grad()
+        with self.profiler.phase('D_backward'):
+            self.backward_D(reuse_fake=self.can_reuse_D_fake(self.netD, step and train_D))
+        if step:
+            if train_D:
+                self.step_optimizer(self.optim_D)
+        else:
+            # backward pass of G also computes netD gradients, which should not be accumulated
+            grad_D = self.get_grad(self.netD)
         # optimize G
-        self.optim_G.zero_grad()
+        if zero_grad:
+            self.optim_G.zero_grad()
         if check_grad:
             self.backward_G_grad_check(mode)
         else:
             self.backward_G(mode)
-        if train_G:
-            self.optim_G.step()
+        if not step:
+            self.set_grad(self.netD, grad_D)
+        elif train_G:
+            self.step_optimizer(self.optim_G)
 
     def get_shape_repr(self, seg_mask, edge_map, flx_seg_mask, img, shape_encode=None, shape_with_face=None):
         if shape_encode is None:
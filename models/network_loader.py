@@ -101,3 +101,61 @@ def load_feature_spatial_transformer_net(id, gpu_ids, which_epoch='latest'):
 
     return model.net, opt
 
+
+def load_pose_transfer_model(id, gpu_ids, which_epoch = 'latest', int8 = False):
+    '''
+    Load a trained pose transfer model (unet/resnet, vunet or 2stage) for inference.
+    All options will be loaded from its train_opt.json, except:
+        - gpu_ids
+        - is_train
+        - which_epoch
+        - int8
+
+    Input:
+        id (str): ID of pose transfer model. the prefix ("PoseTransfer_" or "PoseTransfer_2s_") can be omitted
+        gpu_ids: set gpu_ids for the model. use [] for CPU
+        int8: load int8 generator weights (see quantize_pose_transfer_model.py). requires gpu_ids=[]
+    Output:
+        model (BaseModel): pose transfer model in eval mode
+        opt (namespace): updated pose transfer options
+    '''
+    from options.pose_transfer_options import TestPoseTransferOptions
+
+    # load pose transfer options
+    for prefix in ['', 'PoseTransfer_', 'PoseTransfer_2s_']:
+        fn_opt = os.path.join('checkpoints', prefix + id, 'train_opt.json')
+        if os.path.isfile(fn_opt):
+            break
+    else:
+        raise ValueError('invalid pose transfer model id: %s' % id)
+    opt_var = io.load_json(fn_opt)
+
+    # update pose transfer options
+    opt = TestPoseTransferOptions().parse(ord_str = '', save_to_file = False, display = False, set_gpu = False)
+    for k, v in opt_var.items():
+        if k in opt:
+            setattr(opt, k, v)
+
+    opt.is_train = False
+    opt.continue_train = False
+    opt.gpu_ids = gpu_ids
+    opt.which_epoch = which_epoch
+    opt.int8 = int(int8)
+
+    if opt.which_model_T in {'unet', 'resnet'}:
+        from supervised_pose_transfer_model import SupervisedPoseTransferModel
+        model = SupervisedPoseTransferModel()
+    elif opt.which_model_T == 'vunet':
+        from vunet_pose_transfer_model import VUnetPoseTransferModel
+        model = VUnetPoseTransferModel()
+    elif opt.which_model_T == '2stage':
+        from two_stage_pose_transfer_model import TwoStagePoseTransferModel
+        model = TwoStagePoseTransferModel()
+    else:
+        raise NotImplementedError()
+    model.initialize(opt)
+
+    # use running statistics of BN layers, so that the output of a sample does not depend on other samples in the batch
+    model.eval()
+
+    return model, opt
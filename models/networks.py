@@ -1,7 +1,6 @@
 from __future__ import division, print_function
 
 import torch
-import torchvision
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.nn import init
@@ -13,9 +12,11 @@ from resnet_wrapper import create_resnet_conv_layers
 import os
 import numpy as np
 import functools
+import contextlib
 from skimage.measure import compare_ssim, compare_psnr
 
 import util.io as io
+import util.weight_registry as weight_registry
 
 ###############################################################################
 # parameter initialize
@@ -331,11 +332,30 @@ class SegGANLoss(nn.Module):
         return loss
 
 
+def create_vgg19_features(n_layers=30):
+    '''
+    first n_layers layers of torchvision vgg19().features (default: up to relu5_1), with ImageNet-pretrained weights loaded
+    from the local weight registry (see util/weight_registry.py). the fc layers are never created.
+    '''
+    cfg = [64, 64, 'M', 128, 128, 'M', 256, 256, 256, 256, 'M', 512, 512, 512, 512, 'M', 512, 512, 512, 512, 'M']
+    layers = []
+    input_nc = 3
+    for v in cfg:
+        if v == 'M':
+            layers.append(nn.MaxPool2d(kernel_size=2, stride=2))
+        else:
+            layers += [nn.Conv2d(input_nc, v, kernel_size=3, padding=1), nn.ReLU(inplace=True)]
+            input_nc = v
+    features = nn.Sequential(*layers[0:n_layers])
+    param = weight_registry.load_state_dict('vgg19_features')
+    features.load_state_dict({k: v for k, v in param.items() if int(k.split('.')[0]) < n_layers})
+    return features
+
 # Vgg19 and VGGLoss is borrowed from pix2pixHD
 class Vgg19(nn.Module):
     def __init__(self, requires_grad=False):
         super(Vgg19, self).__init__()
-        vgg_pretrained_features = torchvision.models.vgg19(pretrained=True).features
+        vgg_pretrained_features = create_vgg19_features()
         self.crit = nn.L1Loss(reduce=False)
         self.weights = [1.0/32, 1.0/16, 1.0/8, 1.0/4, 1.0]
         self.slice1 = torch.nn.Sequential()
@@ -372,30 +392,72 @@ class Vgg19(nn.Module):
 
 # Perceptual Feature Loss using VGG19 network
 class VGGLoss(nn.Module):
+    '''
+    the VGG network is created at the first call, so that models which never compute this loss do not load it.
+    '''
     def __init__(self, gpu_ids):
         super(VGGLoss, self).__init__()
         self.gpu_ids = gpu_ids
-        self.vgg = Vgg19()
-        if len(gpu_ids) > 0:
-            self.vgg.cuda()
+        self.vgg = None
+
+    def build(self):
+        if self.vgg is None:
+            self.vgg = Vgg19()
+            if len(self.gpu_ids) > 0:
+                self.vgg.cuda()
 
     def forward(self, x, y, loss_type='content'):
+        self.build()
         if len(self.gpu_ids)>1:
             return nn.parallel.data_parallel(self.vgg, (x, y)).mean()
         else:
             return self.vgg(x, y).mean()
 
+@contextlib.contextmanager
+def fp32_reduction(dtype):
+    '''
+    disable cuBLAS reduced precision reduction of float16/bfloat16 matmul inside the block, so that it accumulates in
+    float32. the previous setting is restored on exit
+    '''
+    flag = 'allow_%s_reduced_precision_reduction' % ('fp16' if dtype == torch.float16 else 'bf16')
+    if not hasattr(torch.backends.cuda.matmul, flag):
+        yield
+        return
+    prev = getattr(torch.backends.cuda.matmul, flag)
+    setattr(torch.backends.cuda.matmul, flag, False)
+    try:
+        yield
+    finally:
+        setattr(torch.backends.cuda.matmul, flag, prev)
+
 class VGGLoss_v2(nn.Module):
-    def __init__(self, gpu_ids, content_weights = [1.0/32, 1.0/16, 1.0/8, 1.0/4, 1.0], style_weights=[1.,1.,1.,1.,1.],shifted_style=False):
+    '''
+    VGG layers are created at the first call of forward/compute_feature (see build), so that models which never compute
+    content/style losses do not load VGG weights.
+    '''
+    def __init__(self, gpu_ids, content_weights = [1.0/32, 1.0/16, 1.0/8, 1.0/4, 1.0], style_weights=[1.,1.,1.,1.,1.],shifted_style=False, gram_dtype='float32'):
+        '''
+        gram_dtype: 'float32', 'float16' or 'bfloat16'. precision of the inputs of the gram matrix matmul in the style loss
+            (accumulation and output are float32). see shifted_gram_matrices
+        '''
         super(VGGLoss_v2, self).__init__()
         self.gpu_ids = gpu_ids
         self.shifted_style = shifted_style
         self.content_weights = content_weights
         self.style_weights = style_weights
         self.shift_delta = [[0,2,4,8,16], [0,2,4,8], [0,2,4], [0,2], [0]]
+        assert gram_dtype in {'float32', 'float16', 'bfloat16'}, 'invalid gram_dtype: %s' % gram_dtype
+        self.gram_dtype = gram_dtype
+        # (mask, mask version, sizes, pyramid) of the last mask_pyramid call
+        self.mask_cache = None
         # self.style_weights = [0,0,1,0,0] # use relu-3 layer feature to compure style loss
+        self.built = False
+
+    def build(self):
+        if self.built:
+            return
         # define vgg
-        vgg_pretrained_features = torchvision.models.vgg19(pretrained=True).features
+        vgg_pretrained_features = create_vgg19_features()
         self.slice1 = torch.nn.Sequential()
         self.slice2 = torch.nn.Sequential()
         self.slice3 = torch.nn.Sequential()
@@ -414,10 +476,12 @@ class VGGLoss_v2(nn.Module):
         for param in self.parameters():
             param.requires_grad = False
 
-        if len(gpu_ids) > 0:
+        if len(self.gpu_ids) > 0:
             self.cuda()
+        self.built = True
 
     def compute_feature(self, X):
+        self.build()
         h_relu1 = self.slice1(X)
         h_relu2 = self.slice2(h_relu1)
         h_relu3 = self.slice3(h_relu2)
@@ -432,6 +496,8 @@ class VGGLoss_v2(nn.Module):
         device_mode: multi, single, sub
         '''
         bsz = X.size(0)
+        # should be built before replicated by data_parallel
+        self.build()
         if device_mode is None:
             device_mode = 'multi' if len(self.gpu_ids) > 1 else 'single'
 
@@ -444,8 +510,12 @@ class VGGLoss_v2(nn.Module):
             features_x = self.compute_feature(self.normalize(X))
             features_y = self.compute_feature(self.normalize(Y))
             if mask is not None:
-                features_x = [feat * F.adaptive_max_pool2d(mask, (feat.size(2), feat.size(3))) for feat in features_x]
-                features_y = [feat * F.adaptive_max_pool2d(mask, (feat.size(2), feat.size(3))) for feat in features_y]
+                # one mask pyramid for both branches (and for repeated calls with the same mask, see mask_pyramid)
+                masks = self.mask_pyramid(mask, [feat.size()[2:] for feat in features_x])
+                features_x = [feat * m for feat, m in zip(features_x, masks)]
+                features_y = [feat * m for feat, m in zip(features_y, masks)]
+            else:
+                masks = [None] * len(features_x)
 
             # compute content loss
             if loss_type == 'content':
@@ -455,23 +525,18 @@ class VGGLoss_v2(nn.Module):
             # compute style loss
             if loss_type == 'style':
                 loss = 0
-                if self.shifted_style:
-                    # with cross_correlation
-                    for i, (feat_x, feat_y) in enumerate(zip(features_x, features_y)):
-                        if self.style_weights[i] > 0:
-                            for delta in self.shift_delta[i]:
-                                if delta == 0:
-                                    loss += self.style_weights[i] * F.mse_loss(self.gram_matrix(feat_x), self.gram_matrix(feat_y), reduce=False).view(bsz, -1).sum(dim=1)
-                                else:
-                                    loss += 0.5*self.style_weights[i] * \
-                                            (F.mse_loss(self.shifted_gram_matrix(feat_x, delta, 0), self.shifted_gram_matrix(feat_y, delta, 0), reduce=False) \
-                                            +F.mse_loss(self.shifted_gram_matrix(feat_x, 0, delta), self.shifted_gram_matrix(feat_y, 0, delta), reduce=False)).view(bsz, -1).sum(dim=1)
-                else:
-                    # without cross_correlation
-                    for i, (feat_x, feat_y) in enumerate(zip(features_x, features_y)):
-                        if self.style_weights[i] > 0:
-                            loss += self.style_weights[i] * F.mse_loss(self.gram_matrix(feat_x), self.gram_matrix(feat_y), reduce=False).view(bsz, -1).sum(dim=1)
-                            # loss += self.style_weights[i] * ((self.gram_matrix(feat_x) - self.gram_matrix(feat_y))**2).view(bsz, -1).mean(dim=1)
+                for i, (feat_x, feat_y, m) in enumerate(zip(features_x, features_y, masks)):
+                    if self.style_weights[i] > 0:
+                        if self.shifted_style:
+                            # with cross_correlation: gram matrices of all shifts of a layer in one batched matmul
+                            shifts, shift_weights = self.get_shifts(i)
+                        else:
+                            # without cross_correlation
+                            shifts, shift_weights = [(0,0)], [1.]
+                        gram_x = self.shifted_gram_matrices(feat_x, shifts, m)
+                        gram_y = self.shifted_gram_matrices(feat_y, shifts, m)
+                        loss_shift = F.mse_loss(gram_x, gram_y, reduce=False).view(bsz, len(shifts), -1).sum(dim=2)
+                        loss += self.style_weights[i] * (loss_shift * gram_x.new(shift_weights).view(1,-1)).sum(dim=1)
                 
             if device_mode == 'single':
                 loss = loss.mean(dim=0)
@@ -502,6 +567,81 @@ class VGGLoss_v2(nn.Module):
         g = torch.matmul(feat1, feat2.transpose(1,2)) / (c*h*w)
         return g
 
+    def get_shifts(self, i):
+        '''
+        shifts [(shift_x, shift_y), ...] of the shifted style loss at layer i, and their weights: 1 for the gram matrix
+        (delta=0), 0.5 for each of the horizontal and vertical shifts of delta>0
+        '''
+        shifts, weights = [], []
+        for delta in self.shift_delta[i]:
+            if delta == 0:
+                shifts.append((0,0))
+                weights.append(1.)
+            else:
+                shifts += [(delta,0), (0,delta)]
+                weights += [0.5, 0.5]
+        return shifts, weights
+
+    def mask_pyramid(self, mask, sizes):
+        '''
+        mask max-pooled to each size in sizes (feature sizes of VGG layers, in decreasing order). a level is pooled from the
+        previous one when both poolings have uniform windows (the result is the same as pooling the full mask), otherwise
+        from the full mask. the last pyramid is cached and returned again for the same mask tensor
+        '''
+        sizes = [tuple(size) for size in sizes]
+        if self.mask_cache is not None:
+            cached_mask, version, cached_sizes, pyramid = self.mask_cache
+            if cached_mask is mask and version == mask._version and cached_sizes == sizes:
+                return pyramid
+        pyramid = []
+        for size in sizes:
+            prev = pyramid[-1] if pyramid else mask
+            if all([mask.size(d) % prev.size(d) == 0 and prev.size(d) % size[d-2] == 0 for d in [2, 3]]):
+                pyramid.append(F.adaptive_max_pool2d(prev, size) if prev.size()[2:] != size else prev)
+            else:
+                pyramid.append(F.adaptive_max_pool2d(mask, size))
+        self.mask_cache = (mask, mask._version, sizes, pyramid)
+        return pyramid
+
+    def shifted_gram_matrices(self, feat, shifts, mask=None):
+        '''
+        [shifted_gram_matrix(feat, shift_x, shift_y) for (shift_x, shift_y) in shifts], stacked as (bsz, len(shifts), c, c)
+        and computed in one matmul: each shifted view is zero-padded back to h*w, so that positions outside the overlap
+        contribute nothing, and all views are multiplied with the same unshifted feat.
+        mask: (bsz, 1, h, w). feat should be already masked. the matmul is only done over positions where mask > 0 (padded
+        to the largest count in the batch with positions of zero mask), since other positions of the unshifted feat are 0.
+        with gram_dtype float16/bfloat16, the matmul inputs are scaled by 1/sqrt(c*h*w) (instead of dividing the output,
+        which could overflow in float16) and cast, and the output is float32. the matmul accumulates in float32 (see
+        fp32_reduction).
+        '''
+        bsz, c, h, w = feat.size()
+        views = []
+        for shift_x, shift_y in shifts:
+            assert shift_x<w and shift_y<h
+            if shift_x == 0 and shift_y == 0:
+                views.append(feat)
+            else:
+                views.append(F.pad(feat[:,:,shift_y:,shift_x:], (0, shift_x, 0, shift_y)))
+        feat1 = torch.stack(views, dim=1).view(bsz, len(shifts)*c, h*w)
+        feat2 = feat.view(bsz, c, h*w)
+        if mask is not None:
+            pos = (mask.view(bsz, h*w) > 0).float()
+            k = int(pos.sum(dim=1).max())
+            if k < h*w:
+                # mask positions first. ties are broken arbitrarily, which does not matter for the sum over positions
+                _, index = pos.topk(k, dim=1)
+                index = index.unsqueeze(1)
+                feat1 = feat1.gather(2, index.expand(bsz, feat1.size(1), k))
+                feat2 = feat2.gather(2, index.expand(bsz, c, k))
+        if self.gram_dtype == 'float32':
+            g = torch.matmul(feat1, feat2.transpose(1,2)) / (c*h*w)
+        else:
+            dtype = torch.float16 if self.gram_dtype == 'float16' else torch.bfloat16
+            scale = (c*h*w) ** -0.5
+            with fp32_reduction(dtype):
+                g = torch.matmul((feat1*scale).to(dtype), (feat2*scale).to(dtype).transpose(1,2)).float()
+        return g.view(bsz, len(shifts), c, c)
+
 class TotalVariationLoss(nn.Module):
     def forward(self, x):
         x_grad = x[:,:,:,0:-1] - x[:,:,:,1::]
@@ -2135,6 +2275,32 @@ class VariationalUnet(nn.Module):
         img = self.dec_to_image(ds[-1])
         return img, qs, ps, ds
 
+    def encode_posterior(self, x_ref, c_ref):
+        '''
+        infer posteriors of the reference. together with decode_from_posterior(sample=False), this is equivalent to transfer_pass,
+        but the reference can be encoded once and decoded to many target poses.
+        '''
+        hs = self.enc_up(x_ref, c_ref)
+        es, qs, zs_posterior = self.enc_down(hs)
+        return qs
+
+    def decode_from_posterior(self, c_tar, qs, sample=True):
+        '''
+        decode target pose using given posterior parameters (e.g. from a cached transfer pass)
+        Input:
+            c_tar: target pose
+            qs: posteriors. from LR layer to HR layer
+            sample: sample latent code from posterior, otherwise use the mean
+        '''
+        if sample:
+            zs = [self.latent_sample(q) for q in qs]
+        else:
+            zs = [q.clone() for q in qs]
+        gs = self.dec_up(c_tar)
+        ds, ps, zs_prior = self.dec_down(gs, zs, training=True)
+        img = self.dec_to_image(ds[-1])
+        return img, ps
+
     def forward(self, x_ref, c_ref, c_tar, mode='train', output_feature=False, single_device=False):
         if len(self.gpu_ids) > 1 and not single_device:
             return nn.parallel.data_parallel(self, (x_ref, c_ref, c_tar), module_kwargs={'mode':mode, 'single_device':True, 'output_feature': output_feature})
@@ -2465,14 +2631,34 @@ class LocalPatchEncoder(nn.Module):
         if len(self.gpu_ids)>1 and not single_device:
             return nn.parallel.data_parallel(self, (patches, joint_tar), module_kwargs={'single_device':True})
         else:
-            bsz, n_patch, c, h, w = patches.size()
-            assert n_patch == self.n_patch
-            patches = patches.view(bsz*n_patch, c, h, w)
-            patch_feat = self.encoder(patches) # (bsz*n_patch, output_dim, 1, 1)
-            patch_feat = patch_feat.view(bsz, n_patch, self.output_nc, 1, 1)
-            rec_map = self.reconstruct(patch_feat, joint_tar) # (bsz, n_patch*output_dim, h, w)
-            rec_map = self.reducer(rec_map) # (bsz, output_dim, h, w)
-            return rec_map
+            patch_feat = self.encode(patches)
+            return self.decode(patch_feat, joint_tar)
+
+    def encode(self, patches):
+        '''
+        Input:
+            patches: [bsz, n_patch, c, h_p, w_p]
+        Output:
+            patch_feat: [bsz, n_patch, output_dim, 1, 1]
+        '''
+        bsz, n_patch, c, h, w = patches.size()
+        assert n_patch == self.n_patch
+        patches = patches.view(bsz*n_patch, c, h, w)
+        patch_feat = self.encoder(patches) # (bsz*n_patch, output_dim, 1, 1)
+        patch_feat = patch_feat.view(bsz, n_patch, self.output_nc, 1, 1)
+        return patch_feat
+
+    def decode(self, patch_feat, joint_tar):
+        '''
+        Input:
+            patch_feat: [bsz, n_patch, output_dim, 1, 1]
+            joint_tar: [bsz, n_patch, h, w]
+        Output:
+            rec_map: [bsz, output_dim, h, w]
+        '''
+        rec_map = self.reconstruct(patch_feat, joint_tar) # (bsz, n_patch*output_dim, h, w)
+        rec_map = self.reducer(rec_map) # (bsz, output_dim, h, w)
+        return rec_map
 
 class LocalPatchRearranger(nn.Module):
     '''
@@ -1,9 +1,9 @@
 # borrow from pytorch
 
 import torch.nn as nn
-import torch.utils.model_zoo as model_zoo
 
-from torchvision.models.resnet import BasicBlock, Bottleneck, model_urls
+from torchvision.models.resnet import BasicBlock, Bottleneck
+import util.weight_registry as weight_registry
 import math
 
 
@@ -28,14 +28,13 @@ def create_resnet_conv_layers(network = 'resnet18', input_nc = 3, pretrained = F
 
     if pretrained:
         if input_nc == 3:
-            param = model_zoo.load_url(model_urls[network])
-            param.pop('fc.weight')
-            param.pop('fc.bias')
+            # ImageNet-pretrained weights without the fc layer, from the local weight registry (see util/weight_registry.py)
+            param = weight_registry.load_state_dict('%s_conv' % network)
             model.load_state_dict(param)
         else:
             raise ValueError('only support loading pretrained weights when input_nc == 3 (RGB input)')
 
-        return model
+    return model
 
 
 
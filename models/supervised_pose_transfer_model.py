@@ -69,6 +69,8 @@ class SupervisedPoseTransferModel(BaseModel):
         ###################################
         # loss functions
         ###################################
+        self.crit_psnr = networks.PSNR()
+        self.crit_ssim = networks.SSIM()
         if self.is_train:
             self.loss_functions = []
             self.schedulers = []
@@ -77,8 +79,6 @@ class SupervisedPoseTransferModel(BaseModel):
             self.crit_L1 = nn.L1Loss()
             self.crit_vgg = networks.VGGLoss_v2(self.gpu_ids)
             # self.crit_vgg_old = networks.VGGLoss(self.gpu_ids)
-            self.crit_psnr = networks.PSNR()
-            self.crit_ssim = networks.SSIM()
             self.loss_functions += [self.crit_L1, self.crit_vgg]
             self.optim = torch.optim.Adam(self.netT.parameters(), lr=opt.lr, betas=(opt.beta1, opt.beta2))
             self.optimizers += [self.optim]
@@ -98,9 +98,19 @@ class SupervisedPoseTransferModel(BaseModel):
         # load trained model
         ###################################
         if not self.is_train:
-            self.load_network(self.netT, 'netT', opt.which_model)
+            if opt.int8:
+                self.load_int8_network(self.netT, 'netT', opt.which_epoch)
+            else:
+                self.load_network(self.netT, 'netT', opt.which_epoch)
 
     def set_input(self, data):
+        if 'pose_1' not in data:
+            # data created by PoseTransferDataset
+            data = dict(data)
+            for i in ['1', '2']:
+                data['pose_%s'%i] = data['joint_%s'%i][:,0:18]
+                data['pose_c_%s'%i] = data['joint_c_%s'%i]
+
         input_list = [
             'img_1',
             'pose_1',
@@ -158,8 +168,9 @@ class SupervisedPoseTransferModel(BaseModel):
                     D_input_real = self.output['img_tar']
                 
                 D_input_fake = self.fake_pool.query(D_input_fake.data)
-                loss_D_fake = self.crit_GAN(self.netD(D_input_fake), False)
-                loss_D_real = self.crit_GAN(self.netD(D_input_real), True)
+                pred_fake, pred_real = self.discriminate(self.netD, [D_input_fake, D_input_real])
+                loss_D_fake = self.crit_GAN(pred_fake, False)
+                loss_D_real = self.crit_GAN(pred_real, True)
                 self.output['loss_D'] = 0.5*(loss_D_fake + loss_D_real)
                 # G loss
                 if self.opt.D_cond:
@@ -176,33 +187,71 @@ class SupervisedPoseTransferModel(BaseModel):
                 self.output['loss_style'] = self.compute_patch_style_loss(self.output['img_out'], self.input['pose_c_2'], self.output['img_tar'], self.input['pose_c_2'], self.opt.patch_size)
                 loss += self.output['loss_style'] * self.opt.loss_weight_style
             
-    def backward_D(self):
+    def encode_reference(self):
+        '''
+        netT takes [img_ref, pose_tar] as input, so only the reference image is kept. see transfer_from_reference()
+        '''
+        if self.opt.pose_type != 'joint':
+            raise NotImplementedError('pose_type "%s" requires target segmentation' % self.opt.pose_type)
+        self.ref_code = {'img_ref': self.input['img_1']}
+
+    def transfer_from_reference(self, data):
+        '''
+        transfer the reference to a batch of target poses
+        data: target pose inputs (joint_c_2, joint_2, stickman_2) created by PoseTransferDataset.pack_pose()
+        '''
+        pose_tar = self.Tensor(data['joint_2'].size()).copy_(data['joint_2'])[:,0:18]
+        img_ref = self.ref_code['img_ref']
+        img_ref = img_ref.expand((pose_tar.size(0),) + img_ref.size()[1:])
+        with torch.no_grad():
+            self.output['img_out'] = self.netT(torch.cat((img_ref, pose_tar), dim=1))
+
+    def backward_D(self, reuse_fake=False):
+        '''
+        reuse_fake: keep the netD output on the current (non-detached) fake samples for the generator GAN loss in
+        compute_loss. see BaseModel.can_reuse_D_fake
+        '''
         if self.opt.D_cond:
-            D_input_fake = torch.cat((self.output['img_out'].detach(), self.output['pose_tar']), dim=1)
+            D_input_fake = torch.cat((self.output['img_out'], self.output['pose_tar']), dim=1)
             D_input_real = torch.cat((self.output['img_tar'], self.output['pose_tar']), dim=1)
         else:
-            D_input_fake = self.output['img_out'].detach()
+            D_input_fake = self.output['img_out']
             D_input_real = self.output['img_tar']
 
-        D_input_fake = self.fake_pool.query(D_input_fake.data)
-
-        loss_D_fake = self.crit_GAN(self.netD(D_input_fake), False)
-        loss_D_real = self.crit_GAN(self.netD(D_input_real), True)
+        if not reuse_fake:
+            D_input_fake = self.fake_pool.query(D_input_fake.data)
+        # real and fake samples in one netD pass if the norm layer permits (see BaseModel.discriminate)
+        pred_fake, pred_real = self.discriminate(self.netD, [D_input_fake, D_input_real])
+        loss_D_fake = self.crit_GAN(pred_fake, False)
+        loss_D_real = self.crit_GAN(pred_real, True)
         self.output['loss_D'] = 0.5*(loss_D_fake + loss_D_real)
-        (self.output['loss_D'] * self.opt.loss_weight_gan).backward()
+        if reuse_fake:
+            self.output['D_pred_fake'] = pred_fake
+            self.backward_D_params(self.netD, self.output['loss_D'] * self.opt.loss_weight_gan)
+        else:
+            (self.output['loss_D'] * self.opt.loss_weight_gan).backward()
 
     def backward(self):
+        loss = self.compute_loss()
+        with self.profiler.phase('backward'):
+            loss.backward()
+
+    def compute_loss(self):
         loss = 0
         # L1
-        self.output['loss_L1'] = self.crit_L1(self.output['img_out'], self.output['img_tar'])
+        with self.profiler.phase('loss_L1'):
+            self.output['loss_L1'] = self.crit_L1(self.output['img_out'], self.output['img_tar'])
         loss += self.output['loss_L1'] * self.opt.loss_weight_L1
         # content
-        self.output['loss_content'] = self.crit_vgg(self.output['img_out'], self.output['img_tar'], 'content')
+        with self.profiler.phase('loss_content'):
+            self.output['loss_content'] = self.crit_vgg(self.output['img_out'], self.output['img_tar'], 'content')
         loss += self.output['loss_content'] * self.opt.loss_weight_content
-        self.output['loss_content_old'] = self.crit_vgg(self.output['img_out'], self.output['img_tar'], 'content')
+        with self.profiler.phase('loss_content_old'):
+            self.output['loss_content_old'] = self.crit_vgg(self.output['img_out'], self.output['img_tar'], 'content')
         # style
         if self.opt.loss_weight_style > 0:
-            self.output['loss_style'] = self.compute_patch_style_loss(self.output['img_out'], self.input['pose_c_2'], self.output['img_tar'], self.input['pose_c_2'], self.opt.patch_size)
+            with self.profiler.phase('loss_style'):
+                self.output['loss_style'] = self.compute_patch_style_loss(self.output['img_out'], self.input['pose_c_2'], self.output['img_tar'], self.input['pose_c_2'], self.opt.patch_size)
             loss += self.output['loss_style'] * self.opt.loss_weight_style
 
         # GAN
@@ -211,54 +260,53 @@ class SupervisedPoseTransferModel(BaseModel):
                 D_input = torch.cat((self.output['img_out'], self.output['pose_tar']), dim=1)
             else:
                 D_input = self.output['img_out']
-            self.output['loss_G'] = self.crit_GAN(self.netD(D_input), True)
+            with self.profiler.phase('loss_G'):
+                pred_fake = self.output['D_pred_fake'] if 'D_pred_fake' in self.output else self.netD(D_input)
+                self.output['loss_G'] = self.crit_GAN(pred_fake, True)
             loss  += self.output['loss_G'] * self.opt.loss_weight_gan
-        loss.backward()
+        return loss
 
     def backward_checkgrad(self):
-        self.output['img_out'].retain_grad()
-        loss = 0
-        # L1
-        self.output['loss_L1'] = self.crit_L1(self.output['img_out'], self.output['img_tar'])
-        (self.output['loss_L1'] * self.opt.loss_weight_L1).backward(retain_graph=True)
-        self.output['grad_L1'] = self.output['img_out'].grad.norm()
-        grad = self.output['img_out'].grad.clone()
-        # content loss
-        self.output['loss_content'] = self.crit_vgg(self.output['img_out'], self.output['img_tar'], 'content')
-        (self.output['loss_content'] * self.opt.loss_weight_content).backward(retain_graph=True)
-        self.output['grad_content'] = (self.output['img_out'].grad - grad).norm()
-        grad = self.output['img_out'].grad.clone()
-        # style loss
-        if self.opt.loss_weight_style > 0:
-            self.output['loss_style'] = self.compute_patch_style_loss(self.output['img_out'], self.input['pose_c_2'], self.output['img_tar'], self.input['pose_c_2'], self.opt.patch_size)
-            (self.output['loss_style'] * self.opt.loss_weight_style).backward(retain_graph=True)
-            self.output['grad_style'] = (self.output['img_out'].grad - grad).norm()
-            grad = self.output['img_out'].grad.clone()
-        # gan loss
-        if self.use_GAN:
-            if self.opt.D_cond:
-                D_input = torch.cat((self.output['img_out'], self.output['pose_tar']), dim=1)
-            else:
-                D_input = self.output['img_out']
-            self.output['loss_G'] = self.crit_GAN(self.netD(D_input), True)
-            (self.output['loss_G'] * self.opt.loss_weight_gan).backward()
-            self.output['grad_gan'] = (self.output['img_out'].grad - grad).norm()
-
+        '''
+        same as backward(), and report the gradient norm of each loss term w.r.t. img_out (grad_*)
+        '''
+        loss = self.compute_loss()
+        self.compute_output_grad_norms(self.output['img_out'], [
+            ('grad_L1', 'loss_L1', self.opt.loss_weight_L1),
+            ('grad_content', 'loss_content', self.opt.loss_weight_content),
+            ('grad_style', 'loss_style', self.opt.loss_weight_style),
+            ('grad_gan', 'loss_G', self.opt.loss_weight_gan),
+            ])
+        with self.profiler.phase('backward'):
+            loss.backward()
 
     def optimize_parameters(self, check_grad=False):
         # clear previous output
         self.output = {}
-        self.forward()
+        # gradients are accumulated over opt.accum_steps micro-batches (see BaseModel.start_accumulation)
+        zero_grad, step = self.start_accumulation()
+        with self.profiler.phase('forward'):
+            self.forward()
         if self.use_GAN:
-            self.optim_D.zero_grad()
-            self.backward_D()
-            self.optim_D.step()
-        self.optim.zero_grad()
+            if zero_grad:
+                self.optim_D.zero_grad()
+            with self.profiler.phase('D_backward'):
+                self.backward_D(reuse_fake=self.can_reuse_D_fake(self.netD, step, self.fake_pool))
+            if step:
+                self.step_optimizer(self.optim_D)
+            else:
+                # backward pass of netT also computes netD gradients, which should not be accumulated
+                grad_D = self.get_grad(self.netD)
+        if zero_grad:
+            self.optim.zero_grad()
         if check_grad:
             self.backward_checkgrad()
         else:
             self.backward()
-        self.optim.step()
+        if self.use_GAN and not step:
+            self.set_grad(self.netD, grad_D)
+        if step:
+            self.step_optimizer(self.optim)
 
     def get_pose_dim(self, pose_type):
         if pose_type == 'joint':
@@ -359,6 +407,12 @@ class SupervisedPoseTransferModel(BaseModel):
             ])
         return visuals
 
+    def train(self):
+        self.netT.train()
+
+    def eval(self):
+        self.netT.eval()
+
     def save(self, label):
         self.save_network(self.netT, 'netT', label, self.gpu_ids)
         if self.use_GAN:
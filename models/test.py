@@ -238,6 +238,151 @@ def test_TwoStagePoseTrasferModel():
     model.initialize(opt)
     # data = iter(CreateDataLoader(opt)).next()
 
+def test_traceable_networks():
+    import functools
+    from networks import VariationalUnet, LocalPatchEncoder
+    from traceable_networks import TraceableVariationalUnet, TraceableLocalPatchEncoder, max_output_diff
+
+    norm_layer = functools.partial(nn.BatchNorm2d, affine=True)
+    # VariationalUnet (transfer mode)
+    net = VariationalUnet(input_nc_dec=18, input_nc_enc=3, output_nc=3, nf=16, max_nf=64, input_size=64, n_latent_scales=2,
+        bottleneck_factor=2, box_factor=2, n_residual_blocks=2, norm_layer=norm_layer, activation=nn.ReLU(False),
+        use_dropout=False, gpu_ids=[], output_tanh=False)
+    net.eval()
+    x_ref = torch.rand(2, 3, 64, 64)
+    c_ref = torch.rand(2, 18, 64, 64)
+    c_tar = torch.rand(2, 18, 64, 64)
+    net_t = TraceableVariationalUnet(net)
+    print('VariationalUnet: eager vs. traceable: %e' % max_output_diff(lambda: net(x_ref, c_ref, c_tar, mode='transfer')[0], lambda: net_t(x_ref, c_tar)))
+    with torch.no_grad():
+        traced = torch.jit.trace(net_t, (x_ref, c_tar), check_trace=False)
+    print('VariationalUnet: eager vs. traced: %e' % max_output_diff(lambda: net(x_ref, c_ref, c_tar, mode='transfer')[0], lambda: traced(x_ref, c_tar)))
+    # LocalPatchEncoder
+    net = LocalPatchEncoder(n_patch=5, input_nc=3, output_nc=16, nf=16, max_nf=64, input_size=32, bottleneck_factor=2,
+        n_residual_blocks=2, norm_layer=norm_layer, activation=nn.ReLU(False), use_dropout=False, gpu_ids=[])
+    net.eval()
+    patches = torch.rand(2, 5, 3, 32, 32)
+    joint_tar = torch.rand(2, 5, 64, 64)
+    net_t = TraceableLocalPatchEncoder(net)
+    with torch.no_grad():
+        traced = torch.jit.trace(net_t, (patches, joint_tar))
+    print('LocalPatchEncoder: eager vs. traced: %e' % max_output_diff(lambda: net(patches, joint_tar), lambda: traced(patches, joint_tar)))
+
+def _test_distributed_worker(rank, world_size, init_file, data_root, result_dir):
+    import os
+    import torch.distributed as dist
+    from options.pose_transfer_options import TrainPoseTransferOptions
+    from data.data_loader import CreateDataLoader
+    from models.vunet_pose_transfer_model import VUnetPoseTransferModel
+    import util.distributed as distributed
+
+    # read by util.distributed.init_distributed, as if started by torchrun
+    os.environ['RANK'] = str(rank)
+    os.environ['WORLD_SIZE'] = str(world_size)
+    opt = TrainPoseTransferOptions().parse('--id test_distributed --gpu_ids -1 --which_model_T vunet --data_root %s --batch_size 1 --nThreads 0 '
+        '--accum_steps 2 --distributed 1 --dist_backend gloo --dist_url file://%s' % (data_root, init_file), save_to_file=False, display=False, set_gpu=False)
+    torch.manual_seed(rank) # different initialization on each process. DistributedDataParallel broadcasts weights of rank 0
+    model = VUnetPoseTransferModel()
+    model.initialize(opt)
+    wrapped = model.wrap_distributed()
+    loader = CreateDataLoader(opt, split='train')
+    loader.sampler.set_epoch(1)
+    indices = list(loader.sampler)
+    # gradient sync flag of netT after each micro-batch (set by BaseModel.start_accumulation)
+    grad_sync = []
+    for i, data in enumerate(loader):
+        if i == 4:
+            break
+        model.set_input(data)
+        model.optimize_parameters()
+        grad_sync.append(model.netT.require_backward_grad_sync)
+    torch.save({
+        'sampler': type(loader.sampler).__name__,
+        'dataset_size': len(loader.dataset),
+        'indices': indices,
+        'wrapped': wrapped,
+        'grad_sync': grad_sync,
+        'state_dict': distributed.unwrap_network(model.netT).state_dict(),
+        }, os.path.join(result_dir, 'rank_%d.pth' % rank))
+    dist.destroy_process_group()
+
+def test_distributed():
+    '''
+    distributed training of VUnetPoseTransferModel on CPU with gloo backend and 2 processes, through the training code path:
+    CreateDataLoader (ResumableSampler shards), BaseModel.wrap_distributed and gradient accumulation with gradient sync only
+    in the last micro-batch (util.distributed.set_grad_sync). Runs 2 accumulation cycles, after which the weights should
+    be the same on all processes.
+    '''
+    import tempfile
+    import os
+    import torch.multiprocessing as mp
+    import data.synthetic as synthetic
+
+    world_size = 2
+    tmp_dir = tempfile.mkdtemp()
+    init_file = os.path.join(tmp_dir, 'init')
+    data_root = os.path.join(tmp_dir, 'DF_Pose')
+    synthetic.create_df_pose_dataset(data_root, num_persons=10, poses_per_person=2)
+    mp.spawn(_test_distributed_worker, args=(world_size, init_file, data_root, tmp_dir), nprocs=world_size)
+    results = [torch.load(os.path.join(tmp_dir, 'rank_%d.pth' % r)) for r in range(world_size)]
+    # data sharding
+    n = results[0]['dataset_size']
+    assert all([r['sampler'] == 'ResumableSampler' for r in results])
+    assert all([len(r['indices']) == (n + world_size - 1) // world_size for r in results])
+    assert set(sum([r['indices'] for r in results], [])) == set(range(n))
+    if n % world_size == 0:
+        assert not set(results[0]['indices']) & set(results[1]['indices'])
+    # wrapped networks and gradient sync
+    print('DistributedDataParallel: %s' % ', '.join(results[0]['wrapped']))
+    assert 'netT' in results[0]['wrapped']
+    assert all([r['grad_sync'] == [False, True, False, True] for r in results])
+    diff = max([(v.float() - results[1]['state_dict'][k].float()).abs().max().item() for k, v in results[0]['state_dict'].items()])
+    print('DistributedDataParallel (gloo, %d processes): max param diff between processes = %e' % (world_size, diff))
+    assert diff < 1e-6
+
+def test_train_one_epoch():
+    '''
+    run train_pose_transfer_model.py for one epoch on a small synthetic DF_Pose dataset, with the default resume and
+    distributed settings (--resume_freq 0 --resume 0 --distributed 0: the training loader uses a plain shuffled sampler).
+    '''
+    import tempfile
+    import os
+    import sys
+    import subprocess
+    import data.synthetic as synthetic
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    data_root = tempfile.mkdtemp()
+    synthetic.create_df_pose_dataset(data_root, num_persons=10, poses_per_person=2)
+    model_id = 'test_train_one_epoch'
+    cmd = [sys.executable, 'train_pose_transfer_model.py', '--id', model_id, '--gpu_ids', '-1', '--which_model_T', 'vunet',
+        '--data_root', data_root, '--batch_size', '2', '--nThreads', '0', '--niter', '1', '--niter_decay', '0']
+    ret = subprocess.call(cmd, cwd=root)
+    assert ret == 0, 'training failed (exit code %d)' % ret
+    assert os.path.isfile(os.path.join(root, 'checkpoints', model_id, 'latest_net_netT.pth'))
+    print('one epoch of training with default options: ok')
+
+def test_checkpoint_pruning():
+    '''
+    --keep_last_epochs only removes old epochs of the network/optimizer checkpoint that has been written. int8 weights and
+    other files with an epoch prefix are kept.
+    '''
+    import tempfile
+    import os
+    import util.checkpoint as checkpoint
+
+    save_dir = tempfile.mkdtemp()
+    files = ['%d_net_netT.pth' % e for e in range(1, 5)] + ['%d_optim_optim_T.pth' % e for e in range(1, 5)] + \
+        ['latest_net_netT.pth', '1_net_netT_int8.pth', '2_net_netT_copy.pth', '1_notes.pth']
+    for fn in files:
+        open(os.path.join(save_dir, fn), 'w').close()
+    checkpoint.prune_old_epochs(os.path.join(save_dir, '4_net_netT.pth'), 2)
+    checkpoint.prune_old_epochs(os.path.join(save_dir, '4_optim_optim_T.pth'), 2)
+    expected = ['3_net_netT.pth', '4_net_netT.pth', '3_optim_optim_T.pth', '4_optim_optim_T.pth', 'latest_net_netT.pth',
+        '1_net_netT_int8.pth', '2_net_netT_copy.pth', '1_notes.pth']
+    assert sorted(os.listdir(save_dir)) == sorted(expected), sorted(os.listdir(save_dir))
+    print('checkpoint pruning: ok')
+
 if __name__ == '__main__':
     # test_AttributeEncoder()
     # test_patchGAN_output_size()
@@ -0,0 +1,252 @@
+from __future__ import division, print_function
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+###############################################################################
+# Inference-only views of pose transfer networks, which can be exported by
+# torch.jit.trace / torch.onnx.export.
+# Submodules are shared with the source networks (no copy), and are pre-resolved
+# into nn.ModuleList instead of being looked up by name in every forward pass.
+###############################################################################
+
+class TraceableVariationalUnet(nn.Module):
+    '''
+    Transfer pass of VariationalUnet (mode='transfer'). The prior branch of dec_down is skipped, because it does not affect the
+    output image when decoding from the posterior mean.
+    deterministic: use posterior mean as the feedback of enc_down, instead of a sample (VariationalUnet.latent_sample). The output
+    of the default setting equals VariationalUnet.transfer_pass under the same random seed.
+    '''
+    def __init__(self, net, deterministic=False):
+        super(TraceableVariationalUnet, self).__init__()
+        self.deterministic = deterministic
+        self.input_nc_enc = net.input_nc_enc
+        self.input_nc_dec = net.input_nc_dec
+        self.input_size_enc = net.input_size_enc
+        self.input_size_dec = net.input_size_dec
+        self.n_scales_enc = net.n_scales_enc
+        self.n_scales_dec = net.n_scales_dec
+        self.n_latent_scales = net.n_latent_scales
+        self.n_residual_blocks = nrb = net.n_residual_blocks
+        # enc_up
+        self.enc_up_pre_conv = net.enc_up_pre_conv
+        self.enc_up_res = nn.ModuleList([net.__getattr__('enc_up_%d_res_%d'%(l,i)) for l in range(self.n_scales_enc) for i in range(nrb)])
+        self.enc_up_downsample = nn.ModuleList([net.__getattr__('enc_up_%d_downsample'%l) for l in range(self.n_scales_enc-1)])
+        # enc_down
+        self.enc_down_pre_conv = net.enc_down_pre_conv
+        self.enc_down_res = nn.ModuleList([net.__getattr__('enc_down_%d_res_%d'%(l,i)) for l in range(self.n_latent_scales) for i in range(nrb)])
+        self.enc_down_latent = nn.ModuleList([net.__getattr__('enc_down_%d_latent'%l) for l in range(self.n_latent_scales)])
+        self.enc_down_upsample = nn.ModuleList([net.__getattr__('enc_down_%d_upsample'%l) for l in range(self.n_latent_scales-1)])
+        # dec_up
+        self.dec_up_pre_conv = net.dec_up_pre_conv
+        self.dec_up_res = nn.ModuleList([net.__getattr__('dec_up_%d_res_%d'%(l,i)) for l in range(self.n_scales_dec) for i in range(nrb)])
+        self.dec_up_downsample = nn.ModuleList([net.__getattr__('dec_up_%d_downsample'%l) for l in range(self.n_scales_dec-1)])
+        # dec_down
+        self.dec_down_pre_conv = net.dec_down_pre_conv
+        self.dec_down_res = nn.ModuleList([net.__getattr__('dec_down_%d_res_%d'%(l,i)) for l in range(self.n_scales_dec) for i in range(nrb)])
+        self.dec_down_nin = nn.ModuleList([net.__getattr__('dec_down_%d_nin_%d'%(l,i)) for l in range(self.n_latent_scales) for i in range(nrb//2, nrb)])
+        self.dec_down_upsample = nn.ModuleList([net.__getattr__('dec_down_%d_upsample'%l) for l in range(self.n_scales_dec-1)])
+        self.dec_output = net.dec_output
+
+    def enc_up(self, x):
+        if not x.size(2)==x.size(3)==self.input_size_enc:
+            x = F.adaptive_avg_pool2d(x, self.input_size_enc)
+        nrb = self.n_residual_blocks
+        hs = []
+        h = self.enc_up_pre_conv(x)
+        for l in range(self.n_scales_enc):
+            for i in range(nrb):
+                h = self.enc_up_res[l*nrb+i](h)
+                hs.append(h)
+            if l + 1 < self.n_scales_enc:
+                h = self.enc_up_downsample[l](h)
+        return hs
+
+    def enc_down(self, gs):
+        nrb = self.n_residual_blocks
+        gs = list(gs)
+        qs = []
+        h = self.enc_down_pre_conv(gs[-1])
+        for l in range(self.n_latent_scales):
+            for i in range(nrb//2):
+                h = self.enc_down_res[l*nrb+i](h, gs.pop())
+            q = self.enc_down_latent[l](h)
+            qs.append(q)
+            z = q if self.deterministic else q + torch.randn_like(q)
+            for i in range(nrb//2, nrb):
+                h = self.enc_down_res[l*nrb+i](h, torch.cat((gs.pop(), z), dim=1))
+            if l + 1 < self.n_latent_scales:
+                h = self.enc_down_upsample[l](h)
+        return qs
+
+    def dec_up(self, c):
+        if not c.size(2)==c.size(3)==self.input_size_dec:
+            c = F.adaptive_avg_pool2d(c, self.input_size_dec)
+        nrb = self.n_residual_blocks
+        hs = []
+        h = self.dec_up_pre_conv(c)
+        for l in range(self.n_scales_dec):
+            for i in range(nrb):
+                h = self.dec_up_res[l*nrb+i](h)
+                hs.append(h)
+            if l + 1 < self.n_scales_dec:
+                h = self.dec_up_downsample[l](h)
+        return hs
+
+    def dec_down(self, gs, zs):
+        nrb = self.n_residual_blocks
+        nrb_nin = nrb - nrb//2
+        gs = list(gs)
+        h = self.dec_down_pre_conv(gs[-1])
+        for l in range(self.n_scales_dec):
+            for i in range(nrb//2):
+                h = self.dec_down_res[l*nrb+i](h, gs.pop())
+            for i in range(nrb//2, nrb):
+                if l < self.n_latent_scales:
+                    h = self.dec_down_nin[l*nrb_nin+i-nrb//2](torch.cat((h, zs[l]), dim=1))
+                h = self.dec_down_res[l*nrb+i](h, gs.pop())
+            if l + 1 < self.n_scales_dec:
+                h = self.dec_down_upsample[l](h)
+        return h
+
+    def encode(self, x_ref):
+        return self.enc_down(self.enc_up(x_ref))
+
+    def decode(self, c_tar, qs):
+        return self.dec_output(self.dec_down(self.dec_up(c_tar), qs))
+
+    def forward(self, x_ref, c_tar):
+        '''
+        the encoder of VariationalUnet does not use the reference pose, so it is not an input here
+        '''
+        return self.decode(c_tar, self.encode(x_ref))
+
+
+class TraceableLocalPatchEncoder(nn.Module):
+    '''
+    LocalPatchEncoder with a vectorized reconstruct step.
+    '''
+    def __init__(self, net):
+        super(TraceableLocalPatchEncoder, self).__init__()
+        self.n_patch = net.n_patch
+        self.output_nc = net.output_nc
+        self.encoder = net.encoder
+        self.reducer = net.reducer
+
+    def encode(self, patches):
+        bsz, n_patch, c, h, w = patches.size()
+        patch_feat = self.encoder(patches.view(bsz*n_patch, c, h, w))
+        return patch_feat.view(bsz, n_patch, self.output_nc, 1, 1)
+
+    def decode(self, patch_feat, joint_tar):
+        bsz, n_patch, h, w = joint_tar.size()
+        # same channel order as LocalPatchEncoder.reconstruct: (n_patch, output_nc)
+        rec_map = (patch_feat * joint_tar.unsqueeze(2)).view(bsz, n_patch*self.output_nc, h, w)
+        return self.reducer(rec_map)
+
+    def forward(self, patches, joint_tar):
+        return self.decode(self.encode(patches), joint_tar)
+
+
+###############################################################################
+# model level wrappers: input tensors -> output image (in [-1, 1])
+###############################################################################
+
+class TraceableVUnetPoseTransfer(nn.Module):
+    '''
+    VUnetPoseTransferModel.forward(mode='transfer')
+    '''
+    input_names = ['appr_ref', 'pose_tar']
+
+    def __init__(self, model, deterministic=False):
+        super(TraceableVUnetPoseTransfer, self).__init__()
+        self.netT = TraceableVariationalUnet(model.netT, deterministic)
+
+    @staticmethod
+    def get_inputs(model):
+        '''
+        get inputs from model.input (after model.set_input)
+        '''
+        appr_ref = model.get_appearance(model.opt.appearance_type, index='1')
+        pose_tar = model.get_pose(model.opt.pose_type, index='2')
+        return (appr_ref, pose_tar)
+
+    def forward(self, appr_ref, pose_tar):
+        # the "image" channels go first in the network output (see VUnetPoseTransferModel.parse_output)
+        return torch.tanh(self.netT(appr_ref, pose_tar)[:,0:3])
+
+
+class TraceableTwoStagePoseTransfer(nn.Module):
+    '''
+    TwoStagePoseTransferModel.forward(mode='transfer'), with which_model_s2e="patch_embed" and which_model_s2d in {"resnet", "unet"}.
+    Patch extraction (TwoStagePoseTransferModel.get_patch) is data dependent, and is done outside of the network.
+    '''
+    input_names = ['appr_ref', 'pose_tar_s1', 'patch_ref', 'joint_tar']
+
+    def __init__(self, model, deterministic=False):
+        super(TraceableTwoStagePoseTransfer, self).__init__()
+        opt = model.opt
+        if opt.which_model_s2e != 'patch_embed':
+            raise NotImplementedError('which_model_s2e "%s" is not supported' % opt.which_model_s2e)
+        if opt.which_model_s2d not in {'resnet', 'unet'}:
+            raise NotImplementedError('which_model_s2d "%s" is not supported' % opt.which_model_s2d)
+        self.s2d_residual = opt.which_model_s2d == 'unet'
+        self.netT_s1 = TraceableVariationalUnet(model.netT_s1, deterministic)
+        self.netT_s2e = TraceableLocalPatchEncoder(model.netT_s2e)
+        self.netT_s2d = model.netT_s2d.model
+
+    @staticmethod
+    def get_inputs(model):
+        '''
+        get inputs from model.input (after model.set_input)
+        '''
+        opt = model.opt
+        appr_ref = model.get_appearance(model.opt_s1.appearance_type, index='1')
+        pose_tar_s1 = model.get_pose(model.opt_s1.pose_type, index='2')
+        patch_ref = model.get_patch(model.input['img_1'], model.input['joint_c_1'], opt.patch_size, opt.patch_indices)
+        joint_tar = model.get_pose(pose_type='joint_ext', index='2')[:,opt.patch_indices]
+        return (appr_ref, pose_tar_s1, patch_ref, joint_tar)
+
+    def forward(self, appr_ref, pose_tar_s1, patch_ref, joint_tar):
+        output_s1 = self.netT_s1(appr_ref, pose_tar_s1)[:,0:3]
+        img_out_s1 = torch.tanh(output_s1)
+        s2e_out = self.netT_s2e(patch_ref, joint_tar)
+        s2d_out = self.netT_s2d(torch.cat((img_out_s1, s2e_out), dim=1))
+        if self.s2d_residual:
+            return torch.tanh(output_s1 + s2d_out)
+        else:
+            return torch.tanh(s2d_out)
+
+
+def create_traceable_model(model, deterministic=False):
+    '''
+    create traceable network from a pose transfer model (see network_loader.load_pose_transfer_model)
+    '''
+    if model.opt.which_model_T == 'vunet':
+        return TraceableVUnetPoseTransfer(model, deterministic)
+    elif model.opt.which_model_T == '2stage':
+        return TraceableTwoStagePoseTransfer(model, deterministic)
+    else:
+        raise NotImplementedError('which_model_T "%s" is not supported' % model.opt.which_model_T)
+
+
+def run_eager_transfer(model):
+    '''
+    run eager model in transfer mode. model.input should be set before calling this function
+    '''
+    model.forward(mode='transfer')
+    return model.output['img_out']
+
+
+def max_output_diff(func_1, func_2, seed=0):
+    '''
+    run two functions under the same random seed, and return the max absolute difference of their outputs.
+    used to check the parity of traceable networks / exported modules and the eager model. BN layers should be in eval mode.
+    '''
+    with torch.no_grad():
+        torch.manual_seed(seed)
+        output_1 = func_1()
+        torch.manual_seed(seed)
+        output_2 = func_2()
+    return (output_1 - output_2).abs().max().item()
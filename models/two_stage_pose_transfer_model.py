@@ -7,7 +7,6 @@ import torchvision
 import networks
 from torch.autograd import Variable
 from misc.image_pool import ImagePool
-from misc.color_space import rgb2lab
 from base_model import BaseModel
 from misc import pose_util
 
@@ -175,7 +174,7 @@ class TwoStagePoseTransferModel(BaseModel):
 
         if self.is_train:
             self.optimizers = []
-            self.crit_vgg = networks.VGGLoss_v2(self.gpu_ids, opt.content_layer_weight, opt.style_layer_weight, opt.shifted_style)
+            self.crit_vgg = networks.VGGLoss_v2(self.gpu_ids, opt.content_layer_weight, opt.style_layer_weight, opt.shifted_style, opt.style_gram_dtype)
 
             self.optim = torch.optim.Adam([
                     {'params': self.netT_s2e.parameters()},
@@ -183,6 +182,9 @@ class TwoStagePoseTransferModel(BaseModel):
                 ], lr=opt.lr, betas=(opt.beta1, opt.beta2))
             self.optimizers.append(self.optim)
 
+            if opt.s1_cache:
+                assert not opt.train_s1, 'stage-1 cache can not be used when jointly training stage-1 network'
+
             if opt.train_s1:
                 self.optim_s1 = torch.optim.Adam(self.netT_s1.parameters(), lr=opt.lr_s1, betas=(opt.beta1, opt.beta2))
                 self.optimizers.append(self.optim_s1)
@@ -210,6 +212,10 @@ class TwoStagePoseTransferModel(BaseModel):
                 if self.use_GAN:
                     self.load_network(self.netD, 'netD', opt.which_epoch)
                     self.load_optim(self.optim_D, 'optim_D', opt.which_epoch)
+        elif opt.int8:
+            self.load_int8_network(self.netT_s1, 'netT_s1', opt.which_epoch)
+            self.load_int8_network(self.netT_s2e, 'netT_s2e', opt.which_epoch)
+            self.load_int8_network(self.netT_s2d, 'netT_s2d', opt.which_epoch)
         else:
             self.load_network(self.netT_s1, 'netT_s1', opt.which_epoch)
             self.load_network(self.netT_s2e, 'netT_s2e', opt.which_epoch)
@@ -222,6 +228,14 @@ class TwoStagePoseTransferModel(BaseModel):
             for optim in self.optimizers:
                 self.schedulers.append(networks.get_scheduler(optim, opt))
 
+    def initialize_stage_1(self, opt):
+        '''
+        only create and load the pretrained stage-1 network. used to precompute stage-1 cache (see cache_stage_1_output.py)
+        '''
+        super(TwoStagePoseTransferModel, self).initialize(opt)
+        self._create_stage_1_net(opt)
+        self.load_network(self.netT_s1, 'netT', 'latest', self.opt_s1.id)
+
     def set_input(self, data):
         input_list = [
             'img_1',
@@ -247,6 +261,14 @@ class TwoStagePoseTransferModel(BaseModel):
         self.input['id'] = zip(data['id_1'], data['id_2'])
         self.input['joint_c_1'] = data['joint_c_1']
         self.input['joint_c_2'] = data['joint_c_2']
+        # cached stage-1 output
+        if 's1_output' in data:
+            self.input['s1_output'] = self.Tensor(data['s1_output'].size()).copy_(data['s1_output'])
+            n_q = len([k for k in data if k.startswith('s1_q_')])
+            self.input['s1_qs'] = [self.Tensor(data['s1_q_%d'%i].size()).copy_(data['s1_q_%d'%i]) for i in range(n_q)]
+        else:
+            self.input.pop('s1_output', None)
+            self.input.pop('s1_qs', None)
 
     def forward(self, mode='train'):
         ''' 
@@ -273,7 +295,15 @@ class TwoStagePoseTransferModel(BaseModel):
         pose_tar_s1 = self.get_pose(self.opt_s1.pose_type, index=tar_idx)
 
         s1_mode = 'train' if mode == 'train' else 'transfer'
-        if self.is_train and self.opt.train_s1:
+        if mode == 'train' and 's1_output' in self.input:
+            # use cached stage-1 result
+            if self.opt.s1_cache_sample:
+                with torch.no_grad():
+                    output_s1, self.output['ps_s1'] = self.netT_s1.decode_from_posterior(pose_tar_s1, self.input['s1_qs'], sample=True)
+            else:
+                output_s1 = self.input['s1_output']
+            self.output['qs_s1'] = self.input['s1_qs']
+        elif self.is_train and self.opt.train_s1:
             output_s1, self.output['ps_s1'], self.output['qs_s1'] = self.netT_s1(appr_ref_s1, pose_ref_s1, pose_tar_s1, mode=s1_mode)
         else:
             with torch.no_grad():
@@ -367,45 +397,110 @@ class TwoStagePoseTransferModel(BaseModel):
         if compute_loss:
             self.compute_loss()
 
-    def backward_D(self):
+    def encode_reference(self):
+        '''
+        encode the reference (index "1" of current input) once, to render a sequence of target poses by transfer_from_reference()
+        '''
+        for pose_type in [self.opt_s1.pose_type, self.opt.pose_type]:
+            if 'seg' in pose_type.split('+'):
+                raise NotImplementedError('pose_type "%s" requires target segmentation' % pose_type)
+        if self.opt.s2e_seg_src == 'gt' and (self.opt.which_model_s2e == 'seg_embed' or self.opt.which_model_s2d == 'rpresnet'):
+            raise NotImplementedError('s2e_seg_src "gt" requires target segmentation')
+        appr_ref_s1 = self.get_appearance(self.opt_s1.appearance_type, index='1')
+        pose_ref_s1 = self.get_pose(self.opt_s1.pose_type, index='1')
+        with torch.no_grad():
+            self.ref_code = {'qs_s1': self.netT_s1.encode_posterior(appr_ref_s1, pose_ref_s1)}
+            if self.opt.which_model_s2e == 'patch_embed':
+                patch_ref = self.get_patch(self.input['img_1'], self.input['joint_c_1'], self.opt.patch_size, self.opt.patch_indices)
+                self.ref_code['patch_feat'] = self.netT_s2e.encode(patch_ref)
+            elif self.opt.which_model_s2e == 'patch':
+                self.ref_code['patch_ref'] = self.get_patch(self.input['img_1'], self.input['joint_c_1'], self.opt.patch_size, self.opt.patch_indices)
+            elif self.opt.which_model_s2e == 'seg_embed':
+                # SegmentRegionEncoder depends on the target segmentation, only the inputs can be reused
+                self.ref_code['img_ref'] = self.input['img_1']
+                self.ref_code['seg_ref'] = self.input['seg_mask_1']
+
+    def transfer_from_reference(self, data):
+        '''
+        transfer the encoded reference to a batch of target poses. equivalent to forward(mode='transfer')
+        data: target pose inputs (joint_c_2, joint_2, stickman_2) created by PoseTransferDataset.pack_pose()
+        '''
+        for name in ['joint_2', 'stickman_2']:
+            self.input[name] = self.Tensor(data[name].size()).copy_(data[name])
+        self.input['joint_c_2'] = data['joint_c_2']
+        bsz = data['joint_2'].size(0)
+        expand = lambda x: x.expand((bsz,) + x.size()[1:])
+
+        with torch.no_grad():
+            # stage-1
+            pose_tar_s1 = self.get_pose(self.opt_s1.pose_type, index='2')
+            output_s1, _ = self.netT_s1.decode_from_posterior(pose_tar_s1, [expand(q) for q in self.ref_code['qs_s1']], sample=False)
+            output_s1 = self.parse_output(output_s1, self.opt_s1.output_type)
+            self.output['img_out_s1'] = F.tanh(output_s1['image'])
+            # stage-2 encoder
+            if self.opt.which_model_s2e == 'patch_embed':
+                joint_tar = self.get_pose(pose_type='joint_ext', index='2')[:,self.opt.patch_indices]
+                s2e_out = self.netT_s2e.decode(expand(self.ref_code['patch_feat']), joint_tar)
+            elif self.opt.which_model_s2e == 'patch':
+                joint_c_tar = self.input['joint_c_2'][:,self.opt.patch_indices]
+                s2e_out = self.netT_s2e(expand(self.ref_code['patch_ref']), joint_c_tar)
+            elif self.opt.which_model_s2e == 'seg_embed':
+                s2e_out = self.netT_s2e(expand(self.ref_code['img_ref']), expand(self.ref_code['seg_ref']), output_s1['seg_mask'])
+            # stage-2 decoder
+            dec_input = torch.cat((self.output['img_out_s1'], s2e_out), dim=1)
+            if self.opt.which_model_s2d != 'rpresnet':
+                s2d_out = self.netT_s2d(dec_input)
+            else:
+                s2d_out = self.netT_s2d(dec_input, output_s1['seg_mask'])
+            if self.opt.which_model_s2d == 'unet':
+                self.output['img_out'] = F.tanh(output_s1['image'] + s2d_out)
+            else:
+                self.output['img_out'] = F.tanh(s2d_out)
+
+    def backward_D(self, reuse_fake=False):
+        '''
+        reuse_fake: keep the netD output on the current (non-detached) fake samples for the generator GAN loss in
+        compute_loss. see BaseModel.can_reuse_D_fake
+        '''
         if 'loss_in_lab' in self.opt and self.opt.loss_in_lab:
             # compute loss in Lab space
-            lab_out = rgb2lab(self.output['img_out'])
-            img_out = ((lab_out[:,0:1]-50.)/50.).repeat(1,3,1,1)
-
-            lab_tar = rgb2lab(self.output['img_tar'])
-            img_tar = ((lab_tar[:,0:1]-50.)/50.).repeat(1,3,1,1)
+            img_out, _ = self.get_lab('img_out')
+            img_tar, _ = self.get_lab('img_tar')
         else:
             # compute loss in RGB space
             img_out = self.output['img_out']
             img_tar = self.output['img_tar']
 
         if self.opt.D_cond:
-            D_input_fake = torch.cat((img_out.detach(), self.output['pose_tar']), dim=1)
+            D_input_fake = torch.cat((img_out, self.output['pose_tar']), dim=1)
             D_input_real = torch.cat((img_tar, self.output['pose_tar']), dim=1)
         else:
-            D_input_fake = img_out.detach()
+            D_input_fake = img_out
             D_input_real = img_tar
 
-        D_input_fake = self.fake_pool.query(D_input_fake.data)
-
-        loss_D_fake = self.crit_GAN(self.netD(D_input_fake), False)
-        loss_D_real = self.crit_GAN(self.netD(D_input_real), True)
+        if not reuse_fake:
+            D_input_fake = self.fake_pool.query(D_input_fake.data)
+        # real and fake samples in one netD pass if the norm layer permits (see BaseModel.discriminate)
+        pred_fake, pred_real = self.discriminate(self.netD, [D_input_fake, D_input_real])
+        loss_D_fake = self.crit_GAN(pred_fake, False)
+        loss_D_real = self.crit_GAN(pred_real, True)
         self.output['loss_D'] = 0.5*(loss_D_fake + loss_D_real)
-        (self.output['loss_D'] * self.opt.loss_weight_gan).backward()
+        if reuse_fake:
+            self.output['D_pred_fake'] = pred_fake
+            self.backward_D_params(self.netD, self.output['loss_D'] * self.opt.loss_weight_gan)
+        else:
+            (self.output['loss_D'] * self.opt.loss_weight_gan).backward()
 
     def backward(self):
         loss = self.compute_loss()
-        loss.backward()
+        with self.profiler.phase('backward'):
+            loss.backward()
 
     def compute_loss(self):
         if 'loss_in_lab' in self.opt and self.opt.loss_in_lab:
-            # compute loss in Lab space
-            lab_out = rgb2lab(self.output['img_out'])
-            img_out, color_out = ((lab_out[:,0:1]-50.)/50.).repeat(1,3,1,1), lab_out[:,1:]/100.
-
-            lab_tar = rgb2lab(self.output['img_tar'])
-            img_tar, color_tar = ((lab_tar[:,0:1]-50.)/50.).repeat(1,3,1,1), lab_tar[:,1:]/100.
+            # compute loss in Lab space (shared with backward_D, see BaseModel.get_lab)
+            img_out, color_out = self.get_lab('img_out')
+            img_tar, color_tar = self.get_lab('img_tar')
         else:
             # compute loss in RGB space
             img_out = self.output['img_out']
@@ -413,11 +508,13 @@ class TwoStagePoseTransferModel(BaseModel):
         
         loss = 0
         # L1
-        self.output['loss_L1'] = F.l1_loss(img_out, img_tar)
+        with self.profiler.phase('loss_L1'):
+            self.output['loss_L1'] = F.l1_loss(img_out, img_tar)
         loss += self.output['loss_L1'] * self.opt.loss_weight_L1
         # content
         if self.opt.loss_weight_content > 0:
-            self.output['loss_content'] = self.crit_vgg(img_out, img_tar, loss_type='content')
+            with self.profiler.phase('loss_content'):
+                self.output['loss_content'] = self.crit_vgg(img_out, img_tar, loss_type='content')
             loss += self.output['loss_content'] * self.opt.loss_weight_content
         # style
         if self.opt.loss_weight_style > 0:
@@ -425,15 +522,18 @@ class TwoStagePoseTransferModel(BaseModel):
                 mask = self.output['seg_tar'][:,3:5].sum(dim=1, keepdim=True)
             else:
                 mask = None
-            self.output['loss_style'] = self.crit_vgg(img_out, img_tar, mask, loss_type='style')
+            with self.profiler.phase('loss_style'):
+                self.output['loss_style'] = self.crit_vgg(img_out, img_tar, mask, loss_type='style')
             loss += self.output['loss_style'] * self.opt.loss_weight_style
         # local style
         if self.opt.loss_weight_patch_style > 0:
-            self.output['loss_patch_style'] = self.compute_patch_style_loss(img_out, self.output['joint_c_tar'], img_tar, self.output['joint_c_tar'], self.opt.patch_size, self.opt.patch_indices_for_loss)
+            with self.profiler.phase('loss_patch_style'):
+                self.output['loss_patch_style'] = self.compute_patch_style_loss(img_out, self.output['joint_c_tar'], img_tar, self.output['joint_c_tar'], self.opt.patch_size, self.opt.patch_indices_for_loss)
             loss += self.output['loss_patch_style'] * self.opt.loss_weight_patch_style
         # local l1
         if self.opt.loss_weight_patch_l1 > 0:
-            self.output['loss_patch_l1'] = self.compute_patch_l1_loss(img_out,self.output['joint_c_tar'], img_tar, self.output['joint_c_tar'], self.opt.patch_size, self.opt.patch_indices_for_loss)
+            with self.profiler.phase('loss_patch_l1'):
+                self.output['loss_patch_l1'] = self.compute_patch_l1_loss(img_out,self.output['joint_c_tar'], img_tar, self.output['joint_c_tar'], self.opt.patch_size, self.opt.patch_indices_for_loss)
             loss += self.output['loss_patch_l1'] * self.opt.loss_weight_patch_l1
         # GAN
         if self.use_GAN:
@@ -441,94 +541,63 @@ class TwoStagePoseTransferModel(BaseModel):
                 D_input = torch.cat((img_out, self.output['pose_tar']), dim=1)
             else:
                 D_input = img_out
-            self.output['loss_G'] = self.crit_GAN(self.netD(D_input), True)
+            with self.profiler.phase('loss_G'):
+                pred_fake = self.output['D_pred_fake'] if 'D_pred_fake' in self.output else self.netD(D_input)
+                self.output['loss_G'] = self.crit_GAN(pred_fake, True)
             loss  += self.output['loss_G'] * self.opt.loss_weight_gan
 
         # color (only Lab)
         if 'loss_in_lab' in self.opt and self.opt.loss_in_lab:
-            self.output['loss_color'] = F.mse_loss(color_out, color_tar)
+            with self.profiler.phase('loss_color'):
+                self.output['loss_color'] = F.mse_loss(color_out, color_tar)
             loss += self.output['loss_color'] * self.opt.loss_weight_color
 
         return loss
 
     def backward_checkgrad(self):
-        if 'loss_in_lab' in self.opt and self.opt.loss_in_lab:
-            # compute loss in Lab space
-            lab_out = rgb2lab(self.output['img_out'])
-            img_out, color_out = ((lab_out[:,0:1]-50.)/50.).repeat(1,3,1,1), lab_out[:,1:]/100.
-
-            lab_tar = rgb2lab(self.output['img_tar'])
-            img_tar, color_tar = ((lab_tar[:,0:1]-50.)/50.).repeat(1,3,1,1), lab_tar[:,1:]/100.
-        else:
-            # compute loss in RGB space
-            img_out = self.output['img_out']
-            img_tar = self.output['img_tar']
-
-        self.output['img_out'].retain_grad()
-        loss = 0
-        # L1
-        self.output['loss_L1'] = F.l1_loss(img_out, img_tar)
-        (self.output['loss_L1'] * self.opt.loss_weight_L1).backward(retain_graph=True)
-        self.output['grad_L1'] = self.output['img_out'].grad.norm()
-        grad = self.output['img_out'].grad.clone()
-        # content 
-        self.output['loss_content'] = self.crit_vgg(img_out, img_tar, loss_type='content')
-        (self.output['loss_content'] * self.opt.loss_weight_content).backward(retain_graph=True)
-        self.output['grad_content'] = (self.output['img_out'].grad - grad).norm()
-        grad = self.output['img_out'].grad.clone()
-        # style
-        if self.opt.loss_weight_style > 0:
-            if self.opt.masked_style:
-                mask = self.output['seg_tar'][:,3:5].sum(dim=1, keepdim=True)
-            else:
-                mask = None
-            self.output['loss_style'] = self.crit_vgg(img_out, img_tar, mask, loss_type='style')
-            (self.output['loss_style'] * self.opt.loss_weight_style).backward(retain_graph=True)
-            self.output['grad_style'] = (self.output['img_out'].grad - grad).norm()
-            grad = self.output['img_out'].grad.clone()
-        # patch style 
-        if self.opt.loss_weight_patch_style > 0:
-            self.output['loss_patch_style'] = self.compute_patch_style_loss(img_out, self.output['joint_c_tar'], img_tar, self.output['joint_c_tar'], self.opt.patch_size, self.opt.patch_indices_for_loss)
-            (self.output['loss_patch_style'] * self.opt.loss_weight_patch_style).backward(retain_graph=True)
-            self.output['grad_patch_style'] = (self.output['img_out'].grad - grad).norm()
-            grad = self.output['img_out'].grad.clone()
-        # patch l1
-        if self.opt.loss_weight_patch_l1 > 0:
-            self.output['loss_patch_l1'] = self.compute_patch_l1_loss(img_out, self.output['joint_c_tar'], img_tar, self.output['joint_c_tar'], self.opt.patch_size, self.opt.patch_indices_for_loss)
-            (self.output['loss_patch_l1'] * self.opt.loss_weight_patch_l1).backward(retain_graph=True)
-            self.output['grad_patch_l1'] = (self.output['img_out'].grad - grad).norm()
-            grad = self.output['img_out'].grad.clone()
-        # color
-        if 'loss_in_lab' in self.opt and self.opt.loss_in_lab:
-            self.output['loss_color'] = F.mse_loss(color_out, color_tar)
-            (self.output['loss_color'] * self.opt.loss_weight_color).backward(retain_graph=True)
-            self.output['grad_color'] = (self.output['img_out'].grad - grad).norm()
-            grad = self.output['img_out'].grad.clone()
-        # gan 
-        if self.use_GAN:
-            if self.opt.D_cond:
-                D_input = torch.cat((img_out, self.output['pose_tar']), dim=1)
-            else:
-                D_input = self.output['img_out']
-            self.output['loss_G'] = self.crit_GAN(self.netD(D_input), True)
-            (self.output['loss_G'] * self.opt.loss_weight_gan).backward()
-            self.output['grad_gan'] = (self.output['img_out'].grad - grad).norm()
+        '''
+        same as backward(), and report the gradient norm of each loss term w.r.t. img_out (grad_*)
+        '''
+        loss = self.compute_loss()
+        self.compute_output_grad_norms(self.output['img_out'], [
+            ('grad_L1', 'loss_L1', self.opt.loss_weight_L1),
+            ('grad_content', 'loss_content', self.opt.loss_weight_content),
+            ('grad_style', 'loss_style', self.opt.loss_weight_style),
+            ('grad_patch_style', 'loss_patch_style', self.opt.loss_weight_patch_style),
+            ('grad_patch_l1', 'loss_patch_l1', self.opt.loss_weight_patch_l1),
+            ('grad_color', 'loss_color', self.opt.loss_weight_color),
+            ('grad_gan', 'loss_G', self.opt.loss_weight_gan),
+            ])
+        with self.profiler.phase('backward'):
+            loss.backward()
 
-        
     def optimize_parameters(self, check_grad=False):
         # clear previous output
         self.output = {}
-        self.forward()
+        # gradients are accumulated over opt.accum_steps micro-batches (see BaseModel.start_accumulation)
+        zero_grad, step = self.start_accumulation()
+        with self.profiler.phase('forward'):
+            self.forward()
         if self.use_GAN:
-            self.optim_D.zero_grad()
-            self.backward_D()
-            self.optim_D.step()
-        self.optim.zero_grad()
+            if zero_grad:
+                self.optim_D.zero_grad()
+            with self.profiler.phase('D_backward'):
+                self.backward_D(reuse_fake=self.can_reuse_D_fake(self.netD, step, self.fake_pool))
+            if step:
+                self.step_optimizer(self.optim_D)
+            else:
+                # backward pass of netT also computes netD gradients, which should not be accumulated
+                grad_D = self.get_grad(self.netD)
+        if zero_grad:
+            self.optim.zero_grad()
         if check_grad:
             self.backward_checkgrad()
         else:
             self.backward()
-        self.optim.step()
+        if self.use_GAN and not step:
+            self.set_grad(self.netD, grad_D)
+        if step:
+            self.step_optimizer(self.optim)
 
 
     def get_output_dim(self, output_type):
@@ -764,6 +833,16 @@ class TwoStagePoseTransferModel(BaseModel):
             visuals['seg_tar'] = [self.output['seg_tar'].data.cpu(), 'seg']
         return visuals
 
+    def train(self):
+        self.netT_s1.train()
+        self.netT_s2e.train()
+        self.netT_s2d.train()
+
+    def eval(self):
+        self.netT_s1.eval()
+        self.netT_s2e.eval()
+        self.netT_s2d.eval()
+
     def save(self, label):
         self.save_network(self.netT_s1, 'netT_s1', label, self.gpu_ids)
         self.save_network(self.netT_s2e, 'netT_s2e', label, self.gpu_ids)
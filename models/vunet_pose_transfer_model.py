@@ -6,7 +6,6 @@ import torch.nn.functional as F
 import torchvision
 import networks
 from misc.image_pool import ImagePool
-from misc.color_space import rgb2lab
 from misc import pose_util
 from base_model import BaseModel
 from misc import pose_util
@@ -72,7 +71,7 @@ class VUnetPoseTransferModel(BaseModel):
 
         if self.is_train:
             self.optimizers =[]
-            self.crit_vgg = networks.VGGLoss_v2(self.gpu_ids, opt.content_layer_weight, opt.style_layer_weight, opt.shifted_style)
+            self.crit_vgg = networks.VGGLoss_v2(self.gpu_ids, opt.content_layer_weight, opt.style_layer_weight, opt.shifted_style, opt.style_gram_dtype)
             # self.crit_vgg_old = networks.VGGLoss(self.gpu_ids)
             self.optim = torch.optim.Adam(self.netT.parameters(), lr=opt.lr, betas=(opt.beta1, opt.beta2), weight_decay=opt.weight_decay)
             self.optimizers += [self.optim]
@@ -88,7 +87,10 @@ class VUnetPoseTransferModel(BaseModel):
         # load trained model
         ###################################
         if not self.is_train:
-            self.load_network(self.netT, 'netT', opt.which_epoch)
+            if opt.int8:
+                self.load_int8_network(self.netT, 'netT', opt.which_epoch)
+            else:
+                self.load_network(self.netT, 'netT', opt.which_epoch)
         elif opt.continue_train:
             self.load_network(self.netT, 'netT', opt.which_epoch)
             self.load_optim(self.optim, 'optim', opt.which_epoch)
@@ -183,45 +185,77 @@ class VUnetPoseTransferModel(BaseModel):
         if compute_loss:
             self.compute_loss()
         
-    def backward_D(self):
+    def encode_reference(self):
+        '''
+        encode the reference (index "1" of current input) once, to render a sequence of target poses by transfer_from_reference()
+        '''
+        if 'seg' in self.opt.pose_type.split('+'):
+            raise NotImplementedError('pose_type "%s" requires target segmentation' % self.opt.pose_type)
+        appr_ref = self.get_appearance(self.opt.appearance_type, index='1')
+        pose_ref = self.get_pose(self.opt.pose_type, index='1')
+        with torch.no_grad():
+            self.ref_code = {'qs': self.netT.encode_posterior(appr_ref, pose_ref)}
+
+    def transfer_from_reference(self, data):
+        '''
+        transfer the encoded reference to a batch of target poses. equivalent to forward(mode='transfer')
+        data: target pose inputs (joint_c_2, joint_2, stickman_2) created by PoseTransferDataset.pack_pose()
+        '''
+        for name in ['joint_2', 'stickman_2']:
+            self.input[name] = self.Tensor(data[name].size()).copy_(data[name])
+        self.input['joint_c_2'] = data['joint_c_2']
+        pose_tar = self.get_pose(self.opt.pose_type, index='2')
+        bsz = pose_tar.size(0)
+        qs = [q.expand((bsz,) + q.size()[1:]) for q in self.ref_code['qs']]
+        with torch.no_grad():
+            netT_output, _ = self.netT.decode_from_posterior(pose_tar, qs, sample=False)
+        netT_output = self.parse_output(netT_output, self.opt.output_type)
+        self.output['img_out'] = F.tanh(netT_output['image'])
+
+    def backward_D(self, reuse_fake=False):
+        '''
+        reuse_fake: keep the netD output on the current (non-detached) fake samples for the generator GAN loss in
+        compute_loss. see BaseModel.can_reuse_D_fake
+        '''
         if 'loss_in_lab' in self.opt and self.opt.loss_in_lab:
             # compute loss in Lab space
-            lab_out = rgb2lab(self.output['img_out'])
-            img_out = ((lab_out[:,0:1]-50.)/50.).repeat(1,3,1,1)
-
-            lab_tar = rgb2lab(self.output['img_tar'])
-            img_tar = ((lab_tar[:,0:1]-50.)/50.).repeat(1,3,1,1)
+            img_out, _ = self.get_lab('img_out')
+            img_tar, _ = self.get_lab('img_tar')
         else:
             # compute loss in RGB space
             img_out = self.output['img_out']
             img_tar = self.output['img_tar']
 
         if self.opt.D_cond:
-            D_input_fake = torch.cat((img_out.detach(), self.output['pose_tar']), dim=1)
+            D_input_fake = torch.cat((img_out, self.output['pose_tar']), dim=1)
             D_input_real = torch.cat((img_tar, self.output['pose_tar']), dim=1)
         else:
-            D_input_fake = img_out.detach()
+            D_input_fake = img_out
             D_input_real = img_tar
 
-        D_input_fake = self.fake_pool.query(D_input_fake.data)
-
-        loss_D_fake = self.crit_GAN(self.netD(D_input_fake), False)
-        loss_D_real = self.crit_GAN(self.netD(D_input_real), True)
+        if not reuse_fake:
+            D_input_fake = self.fake_pool.query(D_input_fake.data)
+        # real and fake samples in one netD pass if the norm layer permits (see BaseModel.discriminate)
+        pred_fake, pred_real = self.discriminate(self.netD, [D_input_fake, D_input_real])
+        loss_D_fake = self.crit_GAN(pred_fake, False)
+        loss_D_real = self.crit_GAN(pred_real, True)
         self.output['loss_D'] = 0.5*(loss_D_fake + loss_D_real)
-        (self.output['loss_D'] * self.opt.loss_weight_gan).backward()
+        if reuse_fake:
+            self.output['D_pred_fake'] = pred_fake
+            self.backward_D_params(self.netD, self.output['loss_D'] * self.opt.loss_weight_gan)
+        else:
+            (self.output['loss_D'] * self.opt.loss_weight_gan).backward()
 
     def backward(self):
         loss = self.compute_loss()
-        loss.backward()
+        with self.profiler.phase('backward'):
+            loss.backward()
 
     def compute_loss(self):
         if 'loss_in_lab' in self.opt and self.opt.loss_in_lab:
-            # compute loss in Lab space
-            lab_out = rgb2lab(self.output['img_out'])
-            img_out, color_out = ((lab_out[:,0:1]-50.)/50.).repeat(1,3,1,1), lab_out[:,1:]/100.
-
-            lab_tar = rgb2lab(self.output['img_tar'])
-            img_tar, color_tar = ((lab_tar[:,0:1]-50.)/50.).repeat(1,3,1,1), lab_tar[:,1:]/100.
+            # compute loss in Lab space (shared with backward_D, see BaseModel.get_lab)
+            img_out, color_out = self.get_lab('img_out')
+            img_tar, color_tar = self.get_lab('img_tar')
         else:
             # compute loss in RGB space
             img_out = self.output['img_out']
@@ -229,14 +263,17 @@ class VUnetPoseTransferModel(BaseModel):
         
         loss = 0
         # KL
-        self.output['loss_kl'] = self.compute_kl_loss(self.output['ps'], self.output['qs'])
+        with self.profiler.phase('loss_kl'):
+            self.output['loss_kl'] = self.compute_kl_loss(self.output['ps'], self.output['qs'])
         loss += self.output['loss_kl'] * self.opt.loss_weight_kl
         # L1
-        self.output['loss_L1'] = F.l1_loss(img_out, img_tar)
+        with self.profiler.phase('loss_L1'):
+            self.output['loss_L1'] = F.l1_loss(img_out, img_tar)
         loss += self.output['loss_L1'] * self.opt.loss_weight_L1
         # content
         if self.opt.loss_weight_content > 0:
-            self.output['loss_content'] = self.crit_vgg(img_out, img_tar, loss_type='content')
+            with self.profiler.phase('loss_content'):
+                self.output['loss_content'] = self.crit_vgg(img_out, img_tar, loss_type='content')
             loss += self.output['loss_content'] * self.opt.loss_weight_content
         # style
         if self.opt.loss_weight_style > 0:
@@ -244,11 +281,13 @@ class VUnetPoseTransferModel(BaseModel):
                 mask = self.output['seg_tar'][:,3:5].sum(dim=1, keepdim=True)
             else:
                 mask = None
-            self.output['loss_style'] = self.crit_vgg(img_out, img_tar, mask, loss_type='style')
+            with self.profiler.phase('loss_style'):
+                self.output['loss_style'] = self.crit_vgg(img_out, img_tar, mask, loss_type='style')
             loss += self.output['loss_style'] * self.opt.loss_weight_style
         # local style
         if self.opt.loss_weight_patch_style > 0:
-            self.output['loss_patch_style'] = self.compute_patch_style_loss(img_out, self.output['joint_c_tar'], img_tar, self.output['joint_c_tar'], self.opt.patch_size, self.opt.patch_indices_for_loss)
+            with self.profiler.phase('loss_patch_style'):
+                self.output['loss_patch_style'] = self.compute_patch_style_loss(img_out, self.output['joint_c_tar'], img_tar, self.output['joint_c_tar'], self.opt.patch_size, self.opt.patch_indices_for_loss)
             loss += self.output['loss_patch_style'] * self.opt.loss_weight_patch_style
         # GAN
         if self.use_GAN:
@@ -256,107 +295,71 @@ class VUnetPoseTransferModel(BaseModel):
                 D_input = torch.cat((img_out, self.output['pose_tar']), dim=1)
             else:
                 D_input = img_out
-            self.output['loss_G'] = self.crit_GAN(self.netD(D_input), True)
+            with self.profiler.phase('loss_G'):
+                pred_fake = self.output['D_pred_fake'] if 'D_pred_fake' in self.output else self.netD(D_input)
+                self.output['loss_G'] = self.crit_GAN(pred_fake, True)
             loss += self.output['loss_G'] * self.opt.loss_weight_gan
         # seg
         if 'seg' in self.opt.output_type:
-            self.output['loss_seg'] = F.cross_entropy(self.output['seg_out'], self.output['seg_tar'].squeeze(dim=1).long())
+            with self.profiler.phase('loss_seg'):
+                self.output['loss_seg'] = F.cross_entropy(self.output['seg_out'], self.output['seg_tar'].squeeze(dim=1).long())
             loss += self.output['loss_seg'] * self.opt.loss_weight_seg
         # joint
         if 'joint' in self.opt.output_type:
-            self.output['loss_joint'] = F.binary_cross_entropy(self.output['joint_out'], self.output['joint_tar'])
+            with self.profiler.phase('loss_joint'):
+                self.output['loss_joint'] = F.binary_cross_entropy(self.output['joint_out'], self.output['joint_tar'])
             loss += self.output['loss_joint'] * self.opt.loss_weight_joint
         # color (only Lab)
         if 'loss_in_lab' in self.opt and self.opt.loss_in_lab:
-            self.output['loss_color'] = F.mse_loss(color_out, color_tar)
+            with self.profiler.phase('loss_color'):
+                self.output['loss_color'] = F.mse_loss(color_out, color_tar)
             loss += self.output['loss_color'] * self.opt.loss_weight_color
 
         return loss
 
     def backward_checkgrad(self):
-        if 'loss_in_lab' in self.opt and self.opt.loss_in_lab:
-            # compute loss in Lab space
-            lab_out = rgb2lab(self.output['img_out'])
-            img_out, color_out = ((lab_out[:,0:1]-50.)/50.).repeat(1,3,1,1), lab_out[:,1:]/100.
-
-            lab_tar = rgb2lab(self.output['img_tar'])
-            img_tar, color_tar = ((lab_tar[:,0:1]-50.)/50.).repeat(1,3,1,1), lab_tar[:,1:]/100.
-        else:
-            # compute loss in RGB space
-            img_out = self.output['img_out']
-            img_tar = self.output['img_tar']
-
-        self.output['img_out'].retain_grad()
-        loss = 0
-        # L1
-        self.output['loss_L1'] = F.l1_loss(img_out, img_tar)
-        (self.output['loss_L1'] * self.opt.loss_weight_L1).backward(retain_graph=True)
-        self.output['grad_L1'] = self.output['img_out'].grad.norm()
-        grad = self.output['img_out'].grad.clone()
-        # content 
-        if self.opt.loss_weight_content > 0:
-            self.output['loss_content'] = self.crit_vgg(img_out, img_tar, loss_type='content')
-            (self.output['loss_content'] * self.opt.loss_weight_content).backward(retain_graph=True)
-            self.output['grad_content'] = (self.output['img_out'].grad - grad).norm()
-            grad = self.output['img_out'].grad.clone()
-        # style
-        if self.opt.loss_weight_style > 0:
-            if self.opt.masked_style:
-                mask = self.output['seg_tar'][:,3:5].sum(dim=1, keepdim=True)
-            else:
-                mask = None
-            self.output['loss_style'] = self.crit_vgg(img_out, img_tar, mask, loss_type='style')
-            (self.output['loss_style'] * self.opt.loss_weight_style).backward(retain_graph=True)
-            self.output['grad_style'] = (self.output['img_out'].grad - grad).norm()
-            grad = self.output['img_out'].grad.clone()
-        # patch style 
-        if self.opt.loss_weight_patch_style > 0:
-            self.output['loss_patch_style'] = self.compute_patch_style_loss(img_out, self.output['joint_c_tar'], img_tar, self.output['joint_c_tar'], self.opt.patch_size, self.opt.patch_indices_for_loss)
-            (self.output['loss_patch_style'] * self.opt.loss_weight_patch_style).backward(retain_graph=True)
-            self.output['grad_patch_style'] = (self.output['img_out'].grad - grad).norm()
-            grad = self.output['img_out'].grad.clone()
-        # gan 
-        if self.use_GAN:
-            if self.opt.D_cond:
-                D_input = torch.cat((img_out, self.output['pose_tar']), dim=1)
-            else:
-                D_input = self.output['img_out']
-            self.output['loss_G'] = self.crit_GAN(self.netD(D_input), True)
-            (self.output['loss_G'] * self.opt.loss_weight_gan).backward(retain_graph=True)
-            self.output['grad_gan'] = (self.output['img_out'].grad - grad).norm()
-            grad = self.output['img_out'].grad.clone()
-        # color
-        if 'loss_in_lab' in self.opt and self.opt.loss_in_lab:
-            self.output['loss_color'] = F.mse_loss(color_out, color_tar)
-            (self.output['loss_color'] * self.opt.loss_weight_color).backward(retain_graph=True)
-            self.output['grad_color'] = (self.output['img_out'].grad - grad).norm()
-            grad = self.output['img_out'].grad.clone()
-        # seg
-        if 'seg' in self.opt.output_type:
-            self.output['loss_seg'] = F.cross_entropy(self.output['seg_out'], self.output['seg_tar'].squeeze(dim=1).long())
-            (self.output['loss_seg'] * self.opt.loss_weight_seg).backward(retain_graph=True)
-        # joint
-        if 'joint' in self.opt.output_type:
-            self.output['loss_joint'] = F.binary_cross_entropy(self.output['joint_out'], self.output['joint_tar'])
-            (self.output['loss_joint'] * self.opt.loss_weight_joint).backward(retain_graph=True)
-        # KL
-        self.output['loss_kl'] = self.compute_kl_loss(self.output['ps'], self.output['qs'])
-        (self.output['loss_kl'] * self.opt.loss_weight_kl).backward()
+        '''
+        same as backward(), and report the gradient norm of each loss term w.r.t. img_out (grad_*)
+        '''
+        loss = self.compute_loss()
+        self.compute_output_grad_norms(self.output['img_out'], [
+            ('grad_L1', 'loss_L1', self.opt.loss_weight_L1),
+            ('grad_content', 'loss_content', self.opt.loss_weight_content),
+            ('grad_style', 'loss_style', self.opt.loss_weight_style),
+            ('grad_patch_style', 'loss_patch_style', self.opt.loss_weight_patch_style),
+            ('grad_gan', 'loss_G', self.opt.loss_weight_gan),
+            ('grad_color', 'loss_color', self.opt.loss_weight_color),
+            ])
+        with self.profiler.phase('backward'):
+            loss.backward()
 
     def optimize_parameters(self, check_grad=False):
         # clear previous output
         self.output = {}
-        self.forward()
+        # gradients are accumulated over opt.accum_steps micro-batches (see BaseModel.start_accumulation)
+        zero_grad, step = self.start_accumulation()
+        with self.profiler.phase('forward'):
+            self.forward()
         if self.use_GAN:
-            self.optim_D.zero_grad()
-            self.backward_D()
-            self.optim_D.step()
-        self.optim.zero_grad()
+            if zero_grad:
+                self.optim_D.zero_grad()
+            with self.profiler.phase('D_backward'):
+                self.backward_D(reuse_fake=self.can_reuse_D_fake(self.netD, step, self.fake_pool))
+            if step:
+                self.step_optimizer(self.optim_D)
+            else:
+                # backward pass of netT also computes netD gradients, which should not be accumulated
+                grad_D = self.get_grad(self.netD)
+        if zero_grad:
+            self.optim.zero_grad()
         if check_grad:
             self.backward_checkgrad()
         else:
             self.backward()
-        self.optim.step()
+        if self.use_GAN and not step:
+            self.set_grad(self.netD, grad_D)
+        if step:
+            self.step_optimizer(self.optim)
 
     def get_output_dim(self, output_type):
         dim = 0
@@ -594,6 +597,12 @@ class VUnetPoseTransferModel(BaseModel):
             visuals['joint_out'] = [self.output['joint_out'], 'pose']
         return visuals
 
+    def train(self):
+        self.netT.train()
+
+    def eval(self):
+        self.netT.eval()
+
     def save(self, label):
         self.save_network(self.netT, 'netT', label, self.gpu_ids)
         if self.use_GAN:
@@ -4,6 +4,7 @@ import torch
 import argparse
 import os
 import util.io as io
+import util.distributed as distributed
 
 
 def opt_to_str(opt):
@@ -72,7 +73,12 @@ class BaseOptions(object):
             
         self.auto_set()
 
-        if len(self.opt.gpu_ids) > 0 and set_gpu:
+        if 'distributed' in self.opt and self.opt.distributed:
+            # one process per device. only the main process displays and saves options
+            distributed.init_distributed(self.opt, set_gpu)
+            display = display and self.opt.rank == 0
+            save_to_file = save_to_file and self.opt.rank == 0
+        elif len(self.opt.gpu_ids) > 0 and set_gpu:
             os.environ['CUDA_VISIBLE_DEVICES'] = ','.join([str(i) for i in self.opt.gpu_ids])
             self.opt.gpu_ids = range(len(self.opt.gpu_ids))
             torch.cuda.set_device(0)
@@ -272,6 +272,7 @@ class TrainMMGANOptions_V3(BaseMMGANOptions_V3):
         parser.add_argument('--lr_D', type=float, default=2e-5, help='initial learning rate for netD')
         parser.add_argument('--beta1', type = float, default = 0.5, help = 'momentum1 term for Adam')
         parser.add_argument('--beta2', type = float, default = 0.999, help = 'momentum2 term for Adam')
+        parser.add_argument('--accum_steps', type=int, default=1, help='accumulate gradients over accum_steps batches before each optimizer step (effective batch size = batch_size * accum_steps)')
         # scheduler
         parser.add_argument('--lr_policy', type=str, default='lambda', help='learning rate policy: lambda|step|plateau',
             choices = ['step', 'plateau', 'lambda'])
@@ -289,6 +290,17 @@ class TrainMMGANOptions_V3(BaseMMGANOptions_V3):
         parser.add_argument('--D_train_freq', type = int, default = 1, help='frequency of training netD')
         parser.add_argument('--G_train_freq', type = int, default = 1, help='frequency of training netG')
         parser.add_argument('--check_grad_freq', type = int, default = 100, help = 'frequency of checking gradient of each loss')
+        # distributed training (see util/distributed.py)
+        parser.add_argument('--distributed', type=int, default=0, choices=[0,1], help='multi-process training with DistributedDataParallel, one process per device. start with torchrun or torch.distributed.launch')
+        parser.add_argument('--dist_backend', type=str, default='nccl', choices=['nccl', 'gloo'], help='distributed backend. use gloo for CPU training')
+        parser.add_argument('--dist_url', type=str, default='env://', help='url used to set up distributed training')
+        parser.add_argument('--local_rank', type=int, default=-1, help='set by torch.distributed.launch')
+        parser.add_argument('--ddp_find_unused', type=int, default=0, choices=[0,1], help='set DistributedDataParallel(find_unused_parameters=True), when some trained parameters do not receive gradients in a step')
+        # profiling (see util/timer.StepProfiler)
+        parser.add_argument('--profile', type=int, default=0, choices=[0,1], help='time each phase of training steps (with cuda synchronization), print rolling p50/p95 with training errors and dump them to checkpoints/id/step_profile.json')
+        parser.add_argument('--trace_steps', type=int, nargs=2, default=[-1,-1], help='capture an autograd profiler trace of steps [a, b) to checkpoints/id/profile/ (see util/trace_window.py)')
+        parser.add_argument('--trace_len', type=int, default=20, help='number of steps traced after the training process receives SIGUSR1')
+        parser.add_argument('--trace_top', type=int, default=30, help='number of operators in the trace summary table')
 
         # loss weights
         parser.add_argument('--loss_weight_GAN', type = float, default = 1., help = 'loss wweight of GAN loss (for netG)')
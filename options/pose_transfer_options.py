@@ -109,6 +109,7 @@ class TrainPoseTransferOptions(BasePoseTransferOptions):
         parser.add_argument('--beta1', type = float, default = 0.5, help = 'momentum1 term for Adam')
         parser.add_argument('--beta2', type = float, default = 0.999, help = 'momentum2 term for Adam')
         parser.add_argument('--weight_decay', type=float, default=0, help='weight decay')
+        parser.add_argument('--accum_steps', type=int, default=1, help='accumulate gradients over accum_steps batches before each optimizer step (effective batch size = batch_size * accum_steps)')
         # scheduler
         parser.add_argument('--lr_policy', type=str, default='step', choices = ['step', 'plateau', 'lambda'], help='learning rate policy: lambda|step|plateau')
         # parser.add_argument('--epoch_count', type=int, default=1, help='the starting epoch count, we save the model by <epoch_count>, <epoch_count>+<save_latest_freq>, ...')
@@ -119,14 +120,30 @@ class TrainPoseTransferOptions(BasePoseTransferOptions):
         parser.add_argument('--display_freq', type = int, default = 10, help='frequency of showing training results on screen')
         parser.add_argument('--test_epoch_freq', type = int, default = 1, help='frequency of testing model')
         parser.add_argument('--save_epoch_freq', type = int, default = 5, help='frequency of saving model to disk' )
+        parser.add_argument('--async_save', type=int, default=1, choices=[0,1], help='write checkpoints in a background thread')
+        parser.add_argument('--keep_last_epochs', type=int, default=0, help='only keep network/optimizer checkpoints ([epoch]_net_*.pth, [epoch]_optim_*.pth) of the last K saved epochs (the "latest" checkpoint and other files are always kept). 0 to keep all')
+        parser.add_argument('--resume_freq', type=int, default=0, help='save full training state (networks, optimizers, schedulers, image pool, random states, data position) to checkpoints/id/train_state.pth every N steps and at the end of each epoch, for --resume. 0 to disable')
+        parser.add_argument('--resume', type=int, default=0, choices=[0,1], help='resume training from checkpoints/id/train_state.pth, in the middle of an epoch if needed')
         parser.add_argument('--vis_epoch_freq', type = int, default = 1, help='frequency of visualizing generated images')
         parser.add_argument('--check_grad_freq', type = int, default = 100, help = 'frequency of checking gradient of each loss')
         parser.add_argument('--nvis', type = int, default = 64, help='number of visualized images')
+        # distributed training (see util/distributed.py)
+        parser.add_argument('--distributed', type=int, default=0, choices=[0,1], help='multi-process training with DistributedDataParallel, one process per device. start with torchrun or torch.distributed.launch')
+        parser.add_argument('--dist_backend', type=str, default='nccl', choices=['nccl', 'gloo'], help='distributed backend. use gloo for CPU training')
+        parser.add_argument('--dist_url', type=str, default='env://', help='url used to set up distributed training')
+        parser.add_argument('--local_rank', type=int, default=-1, help='set by torch.distributed.launch')
+        parser.add_argument('--ddp_find_unused', type=int, default=0, choices=[0,1], help='set DistributedDataParallel(find_unused_parameters=True), when some trained parameters do not receive gradients in a step')
+        # profiling (see util/timer.StepProfiler)
+        parser.add_argument('--profile', type=int, default=0, choices=[0,1], help='time each phase of training steps (with cuda synchronization), print rolling p50/p95 with training errors and dump them to checkpoints/id/step_profile.json')
+        parser.add_argument('--trace_steps', type=int, nargs=2, default=[-1,-1], help='capture an autograd profiler trace of steps [a, b) to checkpoints/id/profile/ (see util/trace_window.py)')
+        parser.add_argument('--trace_len', type=int, default=20, help='number of steps traced after the training process receives SIGUSR1')
+        parser.add_argument('--trace_top', type=int, default=30, help='number of operators in the trace summary table')
         # loss setting
         parser.add_argument('--content_layer_weight', type=float, default=[1./32,1./16,1./8,1./4,1.,], nargs='+', help='content loss weights of vgg layers: relu1_1, relu2_1, relu3_1, relu4_1, relu5_1')
         parser.add_argument('--style_layer_weight', type=float, default=[1.,1.,1.,1.,1.,], nargs='+', help='style loss weights of vgg layers: relu1_1, relu2_1, relu3_1, relu4_1, relu5_1')
         parser.add_argument('--loss_in_lab', type=int, default=0, choices=[0,1], help='compute loss in Lab space: use a,b channel to compute color loss, and L channel to compute all other losses')
         parser.add_argument('--shifted_style', type=int, default=1, choices=[0,1], help='seg shifted_style=1 to use shifted_style_loss (style loss with cross correlation)')
+        parser.add_argument('--style_gram_dtype', type=str, default='float32', choices=['float32', 'float16', 'bfloat16'], help='precision of gram matrix matmul inputs in style loss (accumulated in float32). float16 is for GPU training')
         parser.add_argument('--masked_style', type=int, default=0, choices=[0,1], help='compute style loss only insided masked region (upper/lower body)')
         # loss weight
         parser.add_argument('--loss_weight_L1', type=float, default=1.)
@@ -143,6 +160,10 @@ class TrainPoseTransferOptions(BasePoseTransferOptions):
         # train 2-stage model
         parser.add_argument('--train_s1', type=int, default=0, choices=[0,1], help='set 1 to jointly train stage-1 and stage-2 networks')
         parser.add_argument('--lr_s1', type=float, default=2e-5, help='initial learning rate for stage-1 net when joint training')
+        parser.add_argument('--s1_cache', type=int, default=0, choices=[0,1], help='read stage-1 outputs from precomputed cache instead of running netT_s1 (only when train_s1==0). see cache_stage_1_output.py')
+        parser.add_argument('--s1_cache_dir', type=str, default='', help='stage-1 cache dir. default is checkpoints/which_model_stage_1/s1_cache/')
+        parser.add_argument('--s1_cache_flip', type=int, default=1, choices=[0,1], help='cache_stage_1_output.py setting: also cache flipped samples. flip augmentation is disabled when training with a cache without flipped samples')
+        parser.add_argument('--s1_cache_sample', type=int, default=0, choices=[0,1], help='0: use the cached stage-1 output (transfer mode, mean latent code), netT_s1 is not run. 1: sample the latent code from the cached posterior and run the decoder of netT_s1 every step (only the encoder is skipped), like netT_s1 in train mode without a cache')
 
 class TestPoseTransferOptions(BasePoseTransferOptions):
     def initialize(self):
@@ -153,6 +174,84 @@ class TestPoseTransferOptions(BasePoseTransferOptions):
         parser.add_argument('--nbatch', type=int, default=-1, help='set number of minibatch used for test')
         parser.add_argument('--save_output', action='store_true', help='save output images in the folder exp_dir/test/')
         parser.add_argument('--save_seg', action='store_true', help='save segmentation outputs in the folder exp_dir/test_seg/')
+        parser.add_argument('--output_format', type=str, default='jpg', choices=['jpg', 'png', 'bmp'], help='image format of saved outputs. png and bmp are lossless')
+        parser.add_argument('--seg_format', type=str, default='bmp', choices=['png', 'bmp'], help='image format of saved segmentation outputs')
+        parser.add_argument('--jpeg_quality', type=int, default=95, help='JPEG quality (0-100) of saved outputs')
+        parser.add_argument('--png_compression', type=int, default=3, help='PNG compression level (0-9) of saved outputs')
+        parser.add_argument('--output_workers', type=int, default=4, help='number of threads writing outputs in background. 0 to write in the main thread')
+        parser.add_argument('--output_archive', type=int, default=0, help='if > 0, save outputs into indexed shard archives (util/image_archive.py) of this number of samples per shard in the output folders, instead of image files')
+        parser.add_argument('--output_queue', type=int, default=8, help='max number of output batches waiting to be written. the test loop blocks when the queue is full')
         parser.add_argument('--vis_only', action='store_true', help='only viusal')
         parser.add_argument('--test_nvis', type = int, default = 64, help='number of visualized images')
         parser.add_argument('--reconstruct_ref', action='store_true', help='reconstruct image_ref (by appearance_ref+pose_ref), instead of transferring to target pose')
+        # pose sequence mode
+        parser.add_argument('--seq_pose', type=str, default='', help='render a target pose sequence (JSON or npz file of [n_frame, n_joint, 2] joint coordinates) with one reference, instead of testing on the dataset')
+        parser.add_argument('--seq_ref_id', type=str, default='', help='sample id of the reference in the test set. default is the first test sample')
+        parser.add_argument('--seq_output', type=str, default='', help='output video (.mp4, .avi) or frame archive (.npy). default is exp_dir/seq/seq_ref_id.mp4')
+        parser.add_argument('--seq_fps', type=float, default=25, help='frame rate of output video')
+        parser.add_argument('--seq_codec', type=str, default='mp4v', help='fourcc code of output video')
+        # int8 inference
+        parser.add_argument('--int8', type=int, default=0, choices=[0,1], help='load int8 generator weights created by quantize_pose_transfer_model.py (cpu only)')
+
+class SweepPoseTransferOptions(TestPoseTransferOptions):
+    '''
+    options of sweep_pose_transfer_model.py. model options of each checkpoint are loaded from checkpoints/id/train_opt.json,
+    except batch_size, nThreads and the test options, which are shared by all checkpoints
+    '''
+    def initialize(self):
+        super(SweepPoseTransferOptions, self).initialize()
+        parser = self.parser
+
+        parser.add_argument('--sweep', type=str, nargs='+', default=[], help='checkpoints to evaluate: id[:epoch] ... epoch defaults to latest')
+        parser.add_argument('--cache_mb', type=float, default=4096, help='host memory (MB) to cache decoded test batches for checkpoints with identical data options')
+        parser.add_argument('--sweep_output', type=str, default='checkpoints/sweep/results.json', help='json file of consolidated results')
+
+class ServePoseTransferOptions(BaseOptions):
+    '''
+    options of pose_transfer_server.py. model options are loaded from checkpoints/id/train_opt.json
+    '''
+    def initialize(self):
+        super(ServePoseTransferOptions, self).initialize()
+        self.is_train = False
+        parser = self.parser
+
+        parser.add_argument('--host', type=str, default='127.0.0.1', help='HTTP server address')
+        parser.add_argument('--port', type=int, default=8008, help='HTTP server port')
+        parser.add_argument('--socket', type=str, default='', help='serve on this Unix domain socket instead of TCP host:port')
+        parser.add_argument('--max_batch_size', type=int, default=8, help='maximum number of requests in a micro-batch')
+        parser.add_argument('--max_latency', type=float, default=20, help='maximum time (ms) a request waits in queue for other requests to form a micro-batch')
+        parser.add_argument('--image_format', type=str, default='jpg', choices=['jpg', 'png'], help='default output image encoding')
+        parser.add_argument('--stats_window', type=int, default=10000, help='number of recent requests used to compute latency percentiles')
+        parser.add_argument('--cpu_threads', type=int, default=0, help='number of intra-op threads when running on CPU. 0 for pytorch default')
+        parser.add_argument('--int8', type=int, default=0, choices=[0,1], help='load int8 generator weights created by quantize_pose_transfer_model.py (cpu only)')
+
+class ExportPoseTransferOptions(BaseOptions):
+    '''
+    options of export_pose_transfer_model.py. model options are loaded from checkpoints/id/train_opt.json
+    '''
+    def initialize(self):
+        super(ExportPoseTransferOptions, self).initialize()
+        self.is_train = False
+        parser = self.parser
+
+        parser.add_argument('--format', type=str, default=['torchscript', 'onnx'], nargs='+', choices=['torchscript', 'onnx'], help='export formats')
+        parser.add_argument('--batch_size', type=int, default=1, help='batch size of example inputs')
+        parser.add_argument('--deterministic', type=int, default=0, choices=[0,1], help='use posterior mean instead of a sample as the encoder feedback of VariationalUnet. the exported module will not contain random ops')
+        parser.add_argument('--onnx_opset', type=int, default=11, help='ONNX opset version')
+        parser.add_argument('--tolerance', type=float, default=1e-4, help='max absolute output difference allowed in parity check')
+
+class QuantizePoseTransferOptions(BaseOptions):
+    '''
+    options of quantize_pose_transfer_model.py. model options are loaded from checkpoints/id/train_opt.json
+    '''
+    def initialize(self):
+        super(QuantizePoseTransferOptions, self).initialize()
+        self.is_train = False
+        parser = self.parser
+
+        parser.add_argument('--n_calib', type=int, default=256, help='number of training pairs used for calibration')
+        parser.add_argument('--n_test', type=int, default=256, help='number of test pairs used to compare int8 and fp32 outputs')
+        parser.add_argument('--batch_size', type=int, default=8, help='batch size of calibration and evaluation')
+        parser.add_argument('--n_warmup', type=int, default=3, help='number of warm-up batches before measuring latency')
+        parser.add_argument('--backend', type=str, default='fbgemm', choices=['fbgemm', 'qnnpack'], help='quantized engine (fbgemm for x86, qnnpack for ARM)')
+        parser.add_argument('--cpu_threads', type=int, default=0, help='number of intra-op threads. 0 for pytorch default')
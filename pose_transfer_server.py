@@ -0,0 +1,333 @@
+from __future__ import division, print_function
+
+import torch
+from torch.utils.data.dataloader import default_collate
+from options.pose_transfer_options import ServePoseTransferOptions
+from models.network_loader import load_pose_transfer_model
+from data.pose_transfer_dataset import PoseTransferDataset
+
+import os
+import time
+import json
+import base64
+import threading
+import traceback
+import numpy as np
+import cv2
+from collections import OrderedDict, deque
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn, UnixStreamServer
+    import Queue as queue
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn, UnixStreamServer
+    import queue
+
+# Long-running local pose transfer service. The model is loaded once, and concurrent requests are grouped into micro-batches.
+#
+#     python pose_transfer_server.py --id PoseTransfer_2s_7.5 --gpu_ids -1 --max_batch_size 8 --max_latency 20 [--socket /tmp/pt.sock]
+#
+# API:
+#     POST /transfer  json {
+#                         "img_ref": base64 encoded image file (jpg/png/...) of size fine_size x fine_size of the model,
+#                         "joint_ref": [[x0, y0], ..., [x17, y17]], -1 for invisible joints,
+#                         "joint_tar": [[x0, y0], ..., [x17, y17]],
+#                         "seg_ref": (optional) base64 encoded segmentation map, needed by 2-stage models with seg_embed encoder,
+#                         "format": (optional) "jpg" or "png"
+#                     }
+#                     returns json {"image": base64 encoded output image, "format": ..., "latency": ms}
+#     GET  /stats     request latency percentiles (ms) and batching statistics
+#     GET  /health
+
+
+class TransferRequest(object):
+    def __init__(self, sample):
+        self.sample = sample
+        self.t_submit = time.time()
+        self.done = threading.Event()
+        self.output = None
+        self.error = None
+
+
+class LatencyStats(object):
+    '''
+    Rolling statistics of request latency and micro-batch size.
+    '''
+    def __init__(self, window):
+        self.lock = threading.Lock()
+        self.latency = deque(maxlen=window)
+        self.batch_size = deque(maxlen=window)
+        self.batch_time = deque(maxlen=window)
+        self.num_request = 0
+        self.num_error = 0
+        self.t_start = time.time()
+
+    def add_request(self, latency, error=False):
+        with self.lock:
+            self.num_request += 1
+            if error:
+                self.num_error += 1
+            else:
+                self.latency.append(latency)
+
+    def add_batch(self, batch_size, batch_time):
+        with self.lock:
+            self.batch_size.append(batch_size)
+            self.batch_time.append(batch_time)
+
+    def get_stats(self):
+        with self.lock:
+            latency = np.array(self.latency) * 1000.
+            batch_size = np.array(self.batch_size)
+            batch_time = np.array(self.batch_time) * 1000.
+            stats = OrderedDict([
+                ('uptime', time.time() - self.t_start),
+                ('num_request', self.num_request),
+                ('num_error', self.num_error),
+                ('num_batch', len(batch_size)),
+                ])
+        if len(latency) > 0:
+            stats['latency_p50'] = float(np.percentile(latency, 50))
+            stats['latency_p90'] = float(np.percentile(latency, 90))
+            stats['latency_p99'] = float(np.percentile(latency, 99))
+            stats['latency_mean'] = float(latency.mean())
+        if len(batch_size) > 0:
+            stats['batch_size_mean'] = float(batch_size.mean())
+            stats['batch_time_p50'] = float(np.percentile(batch_time, 50))
+            stats['batch_time_p99'] = float(np.percentile(batch_time, 99))
+        return stats
+
+
+class DynamicBatcher(threading.Thread):
+    '''
+    Collect queued requests into micro-batches and run the model on them. A batch is launched when it reaches max_batch_size,
+    or when its first request has waited max_latency seconds.
+    '''
+    def __init__(self, model, opt, max_batch_size, max_latency, stats):
+        super(DynamicBatcher, self).__init__()
+        self.daemon = True
+        self.model = model
+        self.opt = opt
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.stats = stats
+        self.queue = queue.Queue()
+
+    def submit(self, sample):
+        '''
+        blocking call. return output image as (h, w, 3) np.uint8 array in RGB order
+        '''
+        req = TransferRequest(sample)
+        self.queue.put(req)
+        # Event.wait without timeout can not be interrupted in python2
+        while not req.done.wait(1.):
+            pass
+        if req.error is not None:
+            raise RuntimeError(req.error)
+        return req.output
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = batch[0].t_submit + self.max_latency
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            # requests with different input sizes can not be stacked
+            groups = OrderedDict()
+            for req in batch:
+                groups.setdefault(tuple(req.sample['img_1'].size()), []).append(req)
+            for reqs in groups.values():
+                self.run_batch(reqs)
+
+    def run_batch(self, reqs):
+        t = time.time()
+        try:
+            data = default_collate([req.sample for req in reqs])
+            with torch.no_grad():
+                self.model.set_input(data)
+                if self.opt.which_model_T in {'unet', 'resnet'}:
+                    self.model.forward()
+                else:
+                    self.model.forward(mode='transfer')
+            images = self.model.output['img_out'].cpu().numpy().transpose(0,2,3,1)
+            images = ((images + 1.0) * 127.5).clip(0,255).astype(np.uint8)
+            for req, img in zip(reqs, images):
+                req.output = img
+        except Exception:
+            error = traceback.format_exc()
+            print(error)
+            for req in reqs:
+                req.error = error
+        finally:
+            self.stats.add_batch(len(reqs), time.time() - t)
+            for req in reqs:
+                req.done.set()
+
+
+class SampleBuilder(object):
+    '''
+    Create model inputs from a request, using the same pre-processing as PoseTransferDataset.
+    '''
+    def __init__(self, model, opt):
+        self.opt = opt
+        self.dataset = PoseTransferDataset()
+        self.dataset.initialize_transform(opt)
+        # target segmentation is not available at inference time
+        pose_types = [opt.pose_type]
+        if opt.which_model_T == '2stage':
+            pose_types.append(model.opt_s1.pose_type)
+        for pose_type in pose_types:
+            if 'seg' in pose_type.split('+'):
+                raise NotImplementedError('pose_type "%s" requires target segmentation, which is not supported' % pose_type)
+        self.need_seg_ref = False
+        if opt.which_model_T == '2stage':
+            if opt.s2e_seg_src == 'gt' and (opt.which_model_s2e == 'seg_embed' or opt.which_model_s2d == 'rpresnet'):
+                raise NotImplementedError('s2e_seg_src "gt" requires target segmentation, which is not supported')
+            self.need_seg_ref = opt.which_model_s2e == 'seg_embed'
+
+    @staticmethod
+    def decode_image(s, flags):
+        buf = np.frombuffer(base64.b64decode(s), dtype=np.uint8)
+        img = cv2.imdecode(buf, flags)
+        if img is None:
+            raise ValueError('can not decode image')
+        return img
+
+    def parse_joint(self, joint_c):
+        joint_c = [[float(x), float(y)] for x, y in joint_c]
+        if len(joint_c) != self.opt.joint_nc:
+            raise ValueError('expect %d joints, got %d' % (self.opt.joint_nc, len(joint_c)))
+        return joint_c
+
+    def build(self, req):
+        img_1 = self.decode_image(req['img_ref'], cv2.IMREAD_COLOR).astype(np.float32) / 255.
+        img_1 = img_1[:,:,[2,1,0]]
+        # the networks only accept the training size. reject other sizes here (400), so that a bad request does not fail the
+        # other requests of its micro-batch
+        if img_1.shape[0:2] != (self.opt.fine_size, self.opt.fine_size):
+            raise ValueError('img_ref should be %dx%d, got %dx%d' % (self.opt.fine_size, self.opt.fine_size, img_1.shape[1], img_1.shape[0]))
+        if 'seg_ref' in req:
+            seg_1 = self.decode_image(req['seg_ref'], cv2.IMREAD_GRAYSCALE).astype(np.float32)[:,:,np.newaxis]
+            if seg_1.shape[0:2] != img_1.shape[0:2]:
+                raise ValueError('size of seg_ref does not match img_ref')
+        elif self.need_seg_ref:
+            raise ValueError('seg_ref is required by this model')
+        else:
+            seg_1 = np.zeros(img_1.shape[0:2] + (1,), dtype=np.float32)
+        joint_c_1 = self.parse_joint(req['joint_ref'])
+        joint_c_2 = self.parse_joint(req['joint_tar'])
+        # target image and segmentation are placeholders
+        img_2 = np.zeros_like(img_1)
+        seg_2 = np.zeros_like(seg_1)
+        sample = self.dataset.pack_sample(img_1, seg_1, joint_c_1, img_2, seg_2, joint_c_2)
+        sample['id_1'] = 'ref'
+        sample['id_2'] = 'tar'
+        return sample
+
+
+class PoseTransferRequestHandler(BaseHTTPRequestHandler):
+    def address_string(self):
+        # client_address is empty for Unix domain socket
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'unix'
+
+    def log_message(self, format, *args):
+        # per-request logging is replaced by /stats
+        pass
+
+    def send_json(self, code, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self.send_json(200, self.server.stats.get_stats())
+        elif self.path == '/health':
+            self.send_json(200, {'status': 'ok'})
+        else:
+            self.send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if self.path != '/transfer':
+            self.send_json(404, {'error': 'not found'})
+            return
+        t = time.time()
+        try:
+            req = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+            fmt = req.get('format', self.server.opt.image_format)
+            if fmt not in {'jpg', 'png'}:
+                raise ValueError('invalid image format %s' % fmt)
+            sample = self.server.builder.build(req)
+        except (ValueError, KeyError, TypeError) as e:
+            self.server.stats.add_request(time.time() - t, error=True)
+            self.send_json(400, {'error': '%s: %s' % (type(e).__name__, e)})
+            return
+        try:
+            img = self.server.batcher.submit(sample)
+        except RuntimeError as e:
+            self.server.stats.add_request(time.time() - t, error=True)
+            self.send_json(500, {'error': str(e)})
+            return
+        _, buf = cv2.imencode('.' + fmt, img[:,:,[2,1,0]])
+        latency = time.time() - t
+        self.server.stats.add_request(latency)
+        self.send_json(200, {
+            'image': base64.b64encode(buf.tobytes()).decode('ascii'),
+            'format': fmt,
+            'latency': latency * 1000.,
+            })
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+if __name__ == '__main__':
+    opt = ServePoseTransferOptions().parse(save_to_file=False)
+    if not opt.gpu_ids and opt.cpu_threads > 0:
+        torch.set_num_threads(opt.cpu_threads)
+    # load model
+    model, model_opt = load_pose_transfer_model(opt.id, opt.gpu_ids, opt.which_epoch, opt.int8)
+    stats = LatencyStats(opt.stats_window)
+    batcher = DynamicBatcher(model, model_opt, opt.max_batch_size, opt.max_latency / 1000., stats)
+    batcher.start()
+    # create server
+    if opt.socket:
+        if os.path.exists(opt.socket):
+            os.remove(opt.socket)
+        server = ThreadingUnixHTTPServer(opt.socket, PoseTransferRequestHandler)
+        address = opt.socket
+    else:
+        server = ThreadingHTTPServer((opt.host, opt.port), PoseTransferRequestHandler)
+        address = 'http://%s:%d' % (opt.host, opt.port)
+    server.opt = opt
+    server.stats = stats
+    server.batcher = batcher
+    server.builder = SampleBuilder(model, model_opt)
+    print('[%s] serving %s on %s (%s), max_batch_size=%d, max_latency=%.1fms' % (time.strftime('%Y-%m-%d %H:%M:%S'), model_opt.id, address,
+        'gpu %s' % opt.gpu_ids if opt.gpu_ids else 'cpu', opt.max_batch_size, opt.max_latency))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if opt.socket and os.path.exists(opt.socket):
+            os.remove(opt.socket)
@@ -0,0 +1,256 @@
+from __future__ import division, print_function
+
+import torch
+import torch.nn as nn
+import numpy as np
+
+import util.io as io
+import data.synthetic as synthetic
+from options.pose_transfer_options import TrainPoseTransferOptions
+
+import os
+import argparse
+import resource
+from collections import OrderedDict, defaultdict
+
+# Memory and FLOPs of each named submodule of a pose transfer model (vunet, 2stage, unet/resnet) in one training step
+# (forward and backward of all networks, including discriminator and loss networks) on synthetic input, on CPU:
+#
+#     python profile_network_memory.py --opt_file checkpoints/PoseTransfer_7.5/train_opt.json --budget 11000
+#     python profile_network_memory.py --set which_model_T=vunet vunet_nf=64 vunet_max_nf=256 fine_size=256 --depth 2
+#
+# For each submodule (named by the model attribute and the module path, e.g. "netT.dec_down_3_res_1"):
+#     params        parameter memory
+#     grad+optim    gradient and optimizer state memory
+#     activations   tensors saved for backward while the submodule (innermost one) is running. tensors are counted once,
+#                   parameters are not counted
+#     GFLOPs        forward FLOPs (2x multiply-adds of conv/linear layers, one op per output element of other layers).
+#                   backward is about 2x forward
+# The step is run with batch sizes b and 2b, and activation memory is fitted as fixed + per_sample * batch_size to predict
+# the maximum batch size fitting in --budget (MB). Allocator overhead and temporary buffers are not included, use --margin
+# to reserve a part of the budget for them.
+
+
+def load_opt(args):
+    opt = TrainPoseTransferOptions().parse('--gpu_ids -1 --which_model_T vunet', save_to_file=False, display=False, set_gpu=False)
+    if args.opt_file:
+        for k, v in io.load_json(args.opt_file).items():
+            if k in opt:
+                setattr(opt, k, v)
+    for s in args.set:
+        k, v = s.split('=', 1)
+        assert k in opt, 'unknown option: %s' % k
+        t = type(getattr(opt, k))
+        setattr(opt, k, (v.lower() in {'1', 'true'}) if t is bool else t(v))
+    opt.is_train = True
+    opt.continue_train = False
+    opt.gpu_ids = []
+    opt.distributed = False
+    return opt
+
+
+def create_model(opt):
+    if opt.which_model_T in {'unet', 'resnet'}:
+        from models.supervised_pose_transfer_model import SupervisedPoseTransferModel
+        model = SupervisedPoseTransferModel()
+    elif opt.which_model_T == 'vunet':
+        from models.vunet_pose_transfer_model import VUnetPoseTransferModel
+        model = VUnetPoseTransferModel()
+    elif opt.which_model_T == '2stage':
+        from models.two_stage_pose_transfer_model import TwoStagePoseTransferModel
+        model = TwoStagePoseTransferModel()
+    else:
+        raise NotImplementedError(opt.which_model_T)
+    model.initialize(opt)
+    return model
+
+
+def get_modules(model):
+    '''
+    OrderedDict: name -> module, for all submodules of the networks (and loss networks) of the model. a module shared by
+    several networks appears once
+    '''
+    modules = OrderedDict()
+    seen = set()
+    for attr, net in sorted(vars(model).items()):
+        if isinstance(net, nn.Module):
+            for name, m in net.named_modules():
+                if id(m) not in seen:
+                    seen.add(id(m))
+                    modules[attr + ('.' + name if name else '')] = m
+    return modules
+
+
+def _nbytes(t):
+    return t.numel() * t.element_size()
+
+
+def count_flops(m, x, y):
+    if isinstance(m, (nn.Conv1d, nn.Conv2d, nn.Conv3d)):
+        return 2 * y.numel() * (m.in_channels // m.groups) * int(np.prod(m.kernel_size))
+    elif isinstance(m, (nn.ConvTranspose1d, nn.ConvTranspose2d, nn.ConvTranspose3d)):
+        return 2 * x.numel() * (m.out_channels // m.groups) * int(np.prod(m.kernel_size))
+    elif isinstance(m, nn.Linear):
+        return 2 * y.numel() * m.in_features
+    else:
+        return y.numel()
+
+
+class StepRecorder(object):
+    '''
+    attribute activation memory and FLOPs of one training step to the innermost running module
+    '''
+    def __init__(self, modules):
+        self.names = {id(m): name for name, m in modules.items()}
+        self.params = set([p.data_ptr() for m in modules.values() for p in m.parameters(recurse=False)])
+        self.stack = []
+        self.handles = []
+        self.activations = defaultdict(int)
+        self.flops = defaultdict(int)
+        self.saved = set()
+        for m in modules.values():
+            self.handles.append(m.register_forward_pre_hook(self._pre_hook))
+            self.handles.append(m.register_forward_hook(self._hook))
+        try:
+            self.saved_tensors_hooks = torch.autograd.graph.saved_tensors_hooks(self._pack, lambda t: t)
+        except AttributeError:
+            # torch < 1.10: count outputs of leaf modules instead of saved tensors
+            self.saved_tensors_hooks = None
+
+    def _current(self):
+        return self.stack[-1] if self.stack else '(other)'
+
+    def _pre_hook(self, m, input):
+        self.stack.append(self.names[id(m)])
+
+    def _hook(self, m, input, output):
+        self.stack.pop()
+        if len(m._modules) == 0 and isinstance(output, torch.Tensor):
+            x = input[0] if len(input) > 0 and isinstance(input[0], torch.Tensor) else output
+            self.flops[self.names[id(m)]] += count_flops(m, x, output)
+            if self.saved_tensors_hooks is None and output.requires_grad:
+                self._pack(output, self.names[id(m)])
+
+    def _pack(self, t, name=None):
+        key = (t.data_ptr(), t.numel())
+        if t.data_ptr() not in self.params and key not in self.saved:
+            self.saved.add(key)
+            self.activations[name or self._current()] += _nbytes(t)
+        return t
+
+    def __enter__(self):
+        if self.saved_tensors_hooks is not None:
+            self.saved_tensors_hooks.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        if self.saved_tensors_hooks is not None:
+            self.saved_tensors_hooks.__exit__(*args)
+        self.stack = []
+
+    def remove(self):
+        for h in self.handles:
+            h.remove()
+
+
+def get_param_memory(model, modules):
+    '''
+    return (params, grad_optim): bytes of parameters and of gradients + optimizer states, per module
+    '''
+    optim_state = defaultdict(int)
+    for optim in model.optimizers:
+        for p, state in optim.state.items():
+            optim_state[id(p)] += sum([_nbytes(v) for v in state.values() if isinstance(v, torch.Tensor)])
+    params, grad_optim = defaultdict(int), defaultdict(int)
+    for name, m in modules.items():
+        for p in m.parameters(recurse=False):
+            params[name] += _nbytes(p)
+            grad_optim[name] += (_nbytes(p.grad) if p.grad is not None else 0) + optim_state[id(p)]
+    return params, grad_optim
+
+
+def train_step(model, opt, batch_size, rng):
+    model.set_input(synthetic.create_pose_transfer_batch(opt, batch_size, rng))
+    model.optimize_parameters()
+
+
+def group(stats, depth):
+    '''
+    sum stats of submodules by module name truncated to "depth" levels below the network attribute
+    '''
+    rst = defaultdict(int)
+    for name, v in stats.items():
+        rst['.'.join(name.split('.')[0:depth+1])] += v
+    return rst
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='per-module activation/parameter memory and FLOPs of a pose transfer model (CPU)')
+    parser.add_argument('--opt_file', type=str, default='', help='train_opt.json of a pose transfer model. default: vunet with default options')
+    parser.add_argument('--set', type=str, nargs='*', default=[], help='override options: key=value ...')
+    parser.add_argument('--batch_size', type=int, default=2, help='measure with batch_size and 2*batch_size')
+    parser.add_argument('--depth', type=int, default=1, help='module name depth in the report (1: netT.dec_down_3_res_1)')
+    parser.add_argument('--top', type=int, default=30, help='number of rows in the report')
+    parser.add_argument('--budget', type=float, default=0, help='memory budget (MB) to predict max batch size')
+    parser.add_argument('--margin', type=float, default=0.1, help='fraction of budget reserved for allocator overhead and temporary buffers')
+    parser.add_argument('--output', type=str, default='', help='save report as json')
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    rng = np.random.RandomState(0)
+    opt = load_opt(args)
+    model = create_model(opt)
+    model.train()
+    # the first step builds lazily created loss networks and optimizer states
+    train_step(model, opt, args.batch_size, rng)
+    modules = get_modules(model)
+
+    activations, flops = [], []
+    for batch_size in [args.batch_size, 2 * args.batch_size]:
+        recorder = StepRecorder(modules)
+        with recorder:
+            train_step(model, opt, batch_size, rng)
+        recorder.remove()
+        activations.append(recorder.activations)
+        flops.append(recorder.flops)
+    params, grad_optim = get_param_memory(model, modules)
+
+    # report at batch_size
+    MB = 2.**20
+    act = group(activations[0], args.depth)
+    flp = group(flops[0], args.depth)
+    prm = group(params, args.depth)
+    grd = group(grad_optim, args.depth)
+    names = set(act.keys()) | set(prm.keys())
+    rows = sorted([(name, prm[name] / MB, grd[name] / MB, act[name] / MB, flp[name] / 1e9) for name in names], key=lambda r: -(r[1] + r[2] + r[3]))
+    total = [sum([r[i] for r in rows]) for i in range(1, 5)]
+    print('%s (batch_size %d, fine_size %d)' % (opt.which_model_T, args.batch_size, opt.fine_size))
+    print('%-40s %10s %12s %12s %10s %7s' % ('module', 'params', 'grad+optim', 'activations', 'GFLOPs', 'share'))
+    for r in rows[0:args.top]:
+        print('%-40s %10.2f %12.2f %12.2f %10.2f %6.1f%%' % (r + ((r[1] + r[2] + r[3]) / (total[0] + total[1] + total[2]) * 100,)))
+    print('%-40s %10.2f %12.2f %12.2f %10.2f' % tuple(['total'] + total))
+
+    # fit activation memory (MB) = fixed + per_sample * batch_size
+    act_1, act_2 = [sum(a.values()) / MB for a in activations]
+    per_sample = (act_2 - act_1) / args.batch_size
+    fixed = max(0, act_1 - per_sample * args.batch_size) + total[0] + total[1]
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2.**10
+    print('activations: %.1f MB/sample + %.1f MB. params, grads and optimizer states: %.1f MB. peak RSS: %.1f MB' % (per_sample, fixed - total[0] - total[1], total[0] + total[1], peak_rss))
+    max_batch_size = None
+    if args.budget > 0:
+        max_batch_size = int((args.budget * (1 - args.margin) - fixed) // per_sample) if per_sample > 0 else None
+        print('predicted max batch size for %.0f MB (margin %.0f%%): %s' % (args.budget, args.margin * 100, max_batch_size))
+
+    if args.output:
+        io.mkdir_if_missing(os.path.dirname(args.output) or '.')
+        io.save_json({
+            'opt': vars(opt),
+            'batch_size': args.batch_size,
+            'modules': [OrderedDict(zip(['name', 'params', 'grad_optim', 'activations', 'gflops'], r)) for r in rows],
+            'activation_per_sample': per_sample,
+            'fixed': fixed,
+            'peak_rss': peak_rss,
+            'budget': args.budget,
+            'max_batch_size': max_batch_size,
+            }, args.output)
+        print('report saved to %s' % args.output)
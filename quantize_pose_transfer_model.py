@@ -0,0 +1,134 @@
+from __future__ import division, print_function
+
+import torch
+from torch.utils.data.dataloader import default_collate
+from options.pose_transfer_options import QuantizePoseTransferOptions
+from models.network_loader import load_pose_transfer_model
+from models import int8_quantization
+from data.data_loader import CreateDataset
+
+import util.io as io
+import os
+import time
+import numpy as np
+import tqdm
+from collections import OrderedDict
+
+# Post-training int8 quantization of a trained pose transfer generator for CPU inference.
+#
+#     python quantize_pose_transfer_model.py --id PoseTransfer_2s_7.5 --n_calib 256 --n_test 256
+#     python test_pose_transfer_model.py --id PoseTransfer_2s_7.5 --gpu_ids -1 --int8 1
+#
+# BatchNorm layers are folded into convolutions, activation ranges are calibrated on training pairs (without augmentation),
+# and the int8 weights are saved next to the fp32 weights as checkpoints/id/[epoch]_net_[netT*]_int8.pth. Output quality
+# (PSNR/SSIM) and batch latency of the int8 and fp32 models are compared on test pairs, and written to
+# checkpoints/id/int8_report_[epoch].json
+
+opt = QuantizePoseTransferOptions().parse(save_to_file=False)
+if opt.cpu_threads > 0:
+    torch.set_num_threads(opt.cpu_threads)
+torch.backends.quantized.engine = opt.backend
+model_fp32, model_opt = load_pose_transfer_model(opt.id, [], opt.which_epoch)
+model_int8, _ = load_pose_transfer_model(opt.id, [], opt.which_epoch)
+if model_opt.which_model_T == '2stage':
+    net_labels = ['netT_s1', 'netT_s2e', 'netT_s2d']
+else:
+    net_labels = ['netT']
+
+def run_model(model, data, seed):
+    # VariationalUnet samples from the posterior in transfer mode. use the same random seed for both models
+    torch.manual_seed(seed)
+    with torch.no_grad():
+        model.set_input(data)
+        if model_opt.which_model_T in {'unet', 'resnet'}:
+            model.forward()
+        else:
+            model.forward(mode='transfer')
+    return model.output['img_out'], model.output['img_tar']
+
+def iter_batches(dataset, n):
+    n = min(n, len(dataset)) if n > 0 else len(dataset)
+    for i in range(0, n, opt.batch_size):
+        yield default_collate([dataset[j] for j in range(i, min(i+opt.batch_size, n))])
+
+###################################
+# calibrate and convert
+###################################
+for label in net_labels:
+    net = getattr(model_int8, label)
+    if int8_quantization.is_quantizable(net):
+        int8_quantization.prepare_int8(net, input_size=model_opt.fine_size, backend=opt.backend)
+        print('[%s] prepared for int8: %s' % (label, ', '.join(net.int8_modules)))
+    else:
+        print('[%s] %s does not support int8, keep fp32' % (label, net.__class__.__name__))
+
+dataset_calib = CreateDataset(model_opt, 'train')
+n_calib = 0
+for i, data in enumerate(tqdm.tqdm(iter_batches(dataset_calib, opt.n_calib), desc='calibration')):
+    run_model(model_int8, data, seed=i)
+    n_calib += data['img_1'].size(0)
+
+int8_labels = []
+for label in net_labels:
+    net = getattr(model_int8, label)
+    if int8_quantization.is_quantizable(net):
+        int8_quantization.convert_int8(net)
+        model_int8.save_network(net, label + '_int8', opt.which_epoch, [])
+        int8_labels.append(label)
+
+###################################
+# compare int8 and fp32
+###################################
+crit_psnr = model_fp32.crit_psnr
+crit_ssim = model_fp32.crit_ssim
+dataset_test = CreateDataset(model_opt, 'test')
+scores = {k: [] for k in ['psnr_fp32', 'ssim_fp32', 'psnr_int8', 'ssim_int8', 'psnr_int8_vs_fp32']}
+latency = {'fp32': [], 'int8': []}
+n_test = 0
+for i, data in enumerate(tqdm.tqdm(iter_batches(dataset_test, opt.n_test), desc='evaluation')):
+    bsz = data['img_1'].size(0)
+    for name, model in [('fp32', model_fp32), ('int8', model_int8)]:
+        t = time.time()
+        img_out, img_tar = run_model(model, data, seed=i)
+        t = time.time() - t
+        if i >= opt.n_warmup:
+            latency[name].append(t)
+        scores['psnr_%s'%name].append(crit_psnr(img_out, img_tar).item() * bsz)
+        scores['ssim_%s'%name].append(crit_ssim(img_out, img_tar).item() * bsz)
+        if name == 'fp32':
+            img_fp32 = img_out
+    scores['psnr_int8_vs_fp32'].append(crit_psnr(img_out, img_fp32).item() * bsz)
+    n_test += bsz
+
+report = OrderedDict([
+    ('id', model_opt.id),
+    ('which_epoch', opt.which_epoch),
+    ('backend', opt.backend),
+    ('num_threads', torch.get_num_threads()),
+    ('batch_size', opt.batch_size),
+    ('n_calib', n_calib),
+    ('n_test', n_test),
+    ('int8_networks', int8_labels),
+    ])
+for k in ['psnr_fp32', 'psnr_int8', 'ssim_fp32', 'ssim_int8', 'psnr_int8_vs_fp32']:
+    report[k] = float(np.sum(scores[k]) / n_test)
+for name in ['fp32', 'int8']:
+    if len(latency[name]) > 0:
+        report['latency_p50_%s'%name] = float(np.percentile(latency[name], 50)) * 1000.
+        report['latency_mean_%s'%name] = float(np.mean(latency[name])) * 1000.
+if 'latency_p50_int8' in report:
+    report['speedup'] = report['latency_p50_fp32'] / report['latency_p50_int8']
+for name, suffix in [('fp32', ''), ('int8', '_int8')]:
+    fns = [os.path.join('checkpoints', model_opt.id, '%s_net_%s%s.pth' % (opt.which_epoch, label, suffix if label in int8_labels else '')) for label in net_labels]
+    report['size_%s'%name] = sum([os.path.getsize(fn) for fn in fns]) / 2.**20
+
+fn_report = os.path.join('checkpoints', model_opt.id, 'int8_report_%s.json' % opt.which_epoch)
+io.save_json(report, fn_report)
+print('%-20s %10s %10s' % ('', 'fp32', 'int8'))
+print('%-20s %10.3f %10.3f' % ('PSNR', report['psnr_fp32'], report['psnr_int8']))
+print('%-20s %10.4f %10.4f' % ('SSIM', report['ssim_fp32'], report['ssim_int8']))
+if 'speedup' in report:
+    print('%-20s %10.1f %10.1f' % ('latency p50 (ms)', report['latency_p50_fp32'], report['latency_p50_int8']))
+print('%-20s %10.1f %10.1f' % ('size (MB)', report['size_fp32'], report['size_int8']))
+print('PSNR of int8 output vs. fp32 output: %.3f' % report['psnr_int8_vs_fp32'])
+print('report saved to %s' % fn_report)
@@ -0,0 +1,92 @@
+from __future__ import division, print_function
+
+# Cold-start cost of pose transfer models: time and resident memory to create a model, and the extra cost paid when the
+# VGG loss network is built (at the first content/style loss, see networks.VGGLoss_v2.build). Before lazy construction the
+# VGG cost was paid by every model at initialize(). Model options are the same as train_pose_transfer_model.py:
+#
+#     python scripts/benchmark_cold_start.py --id cold_start --which_model_T 2stage --gpu_ids -1
+#
+# For comparison, the VGG19 loss network is also built in the old way (torchvision.models.vgg19(pretrained=True), including
+# the fc layers), with the cost measured as the time and RSS increase. Results are saved to checkpoints/[id]/cold_start.json.
+
+import time
+t_start = time.time()
+import torch
+t_import = time.time() - t_start
+
+import os
+import sys
+import json
+import resource
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from options.pose_transfer_options import TrainPoseTransferOptions
+
+def get_rss():
+    '''
+    current and peak resident memory (MB)
+    '''
+    with open('/proc/self/statm') as f:
+        rss = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2.**20
+    # ru_maxrss is in KB on Linux
+    return rss, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2.**10
+
+opt = TrainPoseTransferOptions().parse(save_to_file=False, display=False)
+if opt.which_model_T in {'unet', 'resnet'}:
+    from models.supervised_pose_transfer_model import SupervisedPoseTransferModel
+    model = SupervisedPoseTransferModel()
+elif opt.which_model_T == 'vunet':
+    from models.vunet_pose_transfer_model import VUnetPoseTransferModel
+    model = VUnetPoseTransferModel()
+elif opt.which_model_T == '2stage':
+    from models.two_stage_pose_transfer_model import TwoStagePoseTransferModel
+    model = TwoStagePoseTransferModel()
+else:
+    raise NotImplementedError()
+
+rss_0, _ = get_rss()
+t = time.time()
+model.initialize(opt)
+t_init = time.time() - t
+rss_init, peak_init = get_rss()
+
+t = time.time()
+x = torch.rand(1, 3, opt.fine_size, opt.fine_size)
+if opt.gpu_ids:
+    x = x.cuda()
+with torch.no_grad():
+    model.crit_vgg(x, x)
+t_vgg = time.time() - t
+rss_vgg, peak_vgg = get_rss()
+
+# old VGG19 construction, measured last so that it does not change the numbers above
+try:
+    import torchvision
+    t = time.time()
+    vgg_old = torchvision.models.vgg19(pretrained=True).features
+    t_vgg_old = time.time() - t
+    rss_vgg_old, _ = get_rss()
+    del vgg_old
+except Exception as e:
+    print('can not build torchvision vgg19: %s' % e)
+    t_vgg_old = rss_vgg_old = None
+
+results = {
+    'import_torch': {'time': t_import, 'rss': rss_0},
+    'initialize': {'time': t_init, 'rss': rss_init, 'peak_rss': peak_init},
+    'build_vgg': {'time': t_vgg, 'rss_increase': rss_vgg - rss_init, 'peak_rss': peak_vgg},
+    'build_vgg_torchvision': None if t_vgg_old is None else {'time': t_vgg_old, 'rss_increase': rss_vgg_old - rss_vgg},
+}
+save_dir = os.path.join('checkpoints', opt.id)
+if not os.path.isdir(save_dir):
+    os.makedirs(save_dir)
+with open(os.path.join(save_dir, 'cold_start.json'), 'w') as f:
+    json.dump(results, f, indent=1, sort_keys=True)
+
+print('%-32s %10s %10s %10s' % ('', 'time (s)', 'RSS (MB)', 'peak (MB)'))
+print('%-32s %10.2f %10.1f %10s' % ('import torch', t_import, rss_0, ''))
+print('%-32s %10.2f %10.1f %10.1f' % ('model.initialize (lazy VGG)', t_init, rss_init, peak_init))
+print('%-32s %10.2f %10.1f %10.1f' % ('first VGG loss (build VGG)', t_vgg, rss_vgg, peak_vgg))
+print('%-32s %10.2f %10.1f %10s' % ('initialize with eager VGG', t_init + t_vgg, rss_vgg, ''))
+if t_vgg_old is not None:
+    print('%-32s %10.2f %+10.1f %10s' % ('torchvision vgg19 (old)', t_vgg_old, rss_vgg_old - rss_vgg, ''))
+print('results saved to %s' % os.path.join(save_dir, 'cold_start.json'))
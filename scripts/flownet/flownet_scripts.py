@@ -1,6 +1,7 @@
 from __future__ import division, print_function
 
 import util.io as io
+import util.image_archive as image_archive
 import numpy as np
 import tqdm
 import os
@@ -106,8 +107,9 @@ def warp_image_by_flow():
     pair_list = []
     flow_file_list = []
     for idx, (id_1, id_2) in enumerate(pairs):
-        fn_1 = os.path.abspath(img_flow1_dir + _get_name(id_1, id_2, idx, img_flow1_namefmt))
-        fn_2 = os.path.abspath(img_flow2_dir + _get_name(id_1, id_2, idx, img_flow2_namefmt))
+        # the flow network reads image files. samples in image archives are extracted to output_dir/input_[1,2]/
+        fn_1 = os.path.abspath(image_archive.materialize(img_flow1_dir + _get_name(id_1, id_2, idx, img_flow1_namefmt), output_dir + 'input_1/'))
+        fn_2 = os.path.abspath(image_archive.materialize(img_flow2_dir + _get_name(id_1, id_2, idx, img_flow2_namefmt), output_dir + 'input_2/'))
         fn_out = os.path.abspath(output_dir + _get_name(id_1, id_2, idx, 'ipair', 'flo'))
         flow_file_list.append(fn_out)
         pair_list.append(' '.join([fn_2, fn_1, fn_out])) # note that the flow is from img_2(target pose) to img_1(reference pose)
@@ -136,9 +138,9 @@ def warp_image_by_flow():
         fn_seg = seg_dir + _get_name(id_1, id_2, idx, seg_namefmt, 'bmp')
         fn_flow = flow_file_list[idx]
 
-        img_1 = imageio.imread(fn_1)
-        img_2 = imageio.imread(fn_2)
-        seg = imageio.imread(fn_seg)
+        img_1 = image_archive.imread(fn_1, imageio.imread)
+        img_2 = image_archive.imread(fn_2, imageio.imread)
+        seg = image_archive.imread(fn_seg, imageio.imread)
         mask = ((seg==3)|(seg==4)|(seg==7)).astype(np.uint8)[..., np.newaxis]
         flow_2to1 = flow_util.readFlow(fn_flow)
 
@@ -155,7 +157,7 @@ def warp_image_by_flow():
         imageio.imwrite(fn_visflow, img_flow)        
 
 
-        img_tar = imageio.imread(img_tar_dir + _get_name(id_1, id_2, idx, img_tar_namefmt))
+        img_tar = image_archive.imread(img_tar_dir + _get_name(id_1, id_2, idx, img_tar_namefmt), imageio.imread)
         ssim_score.append(compare_ssim(img_tar, img_2_warp, multichannel=True))
         psnr_score.append(compare_psnr(img_tar, img_2_warp))
 
@@ -1,5 +1,6 @@
 from __future__ import print_function, division
 import util.io as io
+import util.image_archive as image_archive
 import scipy.io
 import numpy as np
 import imageio
@@ -64,7 +65,7 @@ def create_image_info():
 
 
 def _read_seg(fn, n_class=8):
-    seg_label = imageio.imread(fn).astype(np.int)
+    seg_label = image_archive.imread(fn, imageio.imread).astype(np.int)
     seg = [(seg_label == i) for i in range(n_class)]
     seg = np.stack(seg, axis=2).astype(np.float32)
     if n_class==8:
@@ -113,9 +114,9 @@ def create_descriptor_rgb():
     desc_gen = []
 
     for fn_1, fn_2, fn_gen in zip(image_info['image_1'], image_info['image_2'], image_info['image_gen']):
-        desc_1.append(imageio.imread(fn_1))
-        desc_2.append(imageio.imread(fn_2))
-        desc_gen.append(imageio.imread(fn_gen))
+        desc_1.append(image_archive.imread(fn_1, imageio.imread))
+        desc_2.append(image_archive.imread(fn_2, imageio.imread))
+        desc_gen.append(image_archive.imread(fn_gen, imageio.imread))
     
     desc_1 = np.stack(desc_1).astype(np.float32)/127.5 - 1.
     desc_2 = np.stack(desc_2).astype(np.float32)/127.5 - 1.
@@ -142,15 +143,15 @@ def create_descriptor_vgg():
     vgg = VGGLoss_v2(gpu_ids=[0])
     image_info = io.load_json('temp/patch_matching/label/image_info.json')
     
-    images_1 = np.stack([imageio.imread(fn) for fn in image_info['image_1']]).astype(np.float32)/127.5 -1.
-    images_2 = np.stack([imageio.imread(fn) for fn in image_info['image_2']]).astype(np.float32)/127.5 -1.
-    images_gen = np.stack([imageio.imread(fn) for fn in image_info['image_gen']]).astype(np.float32)/127.5 -1.
+    images_1 = np.stack([image_archive.imread(fn, imageio.imread) for fn in image_info['image_1']]).astype(np.float32)/127.5 -1.
+    images_2 = np.stack([image_archive.imread(fn, imageio.imread) for fn in image_info['image_2']]).astype(np.float32)/127.5 -1.
+    images_gen = np.stack([image_archive.imread(fn, imageio.imread) for fn in image_info['image_gen']]).astype(np.float32)/127.5 -1.
 
     desc_dict = {}
     batch_size = 16
     for idx in ['1', '2', 'gen']:
         print('compute feature for images_%s'%idx)
-        images = np.stack([imageio.imread(fn) for fn in image_info['image_%s'%idx]]).astype(np.float32)/127.5 -1.
+        images = np.stack([image_archive.imread(fn, imageio.imread) for fn in image_info['image_%s'%idx]]).astype(np.float32)/127.5 -1.
         n, h, w = images.shape[0:3]
         # compute features
         feat_pyramid = []
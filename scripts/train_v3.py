@@ -8,6 +8,8 @@ from options.multimodal_gan_options_v3 import TrainMMGANOptions_V3
 from misc.visualizer import GANVisualizer_V3
 
 import util.io as io
+import util.distributed as distributed
+import util.trace_window as trace_window
 import os
 import sys
 import time
@@ -19,20 +21,34 @@ opt = TrainMMGANOptions_V3().parse()
 # create model
 model = MultimodalDesignerGAN_V3()
 model.initialize(opt)
+if opt.distributed:
+    # one process per device (see util/distributed.py). only the main process logs and saves
+    print('[rank %d/%d] DistributedDataParallel: %s' % (distributed.get_rank(), distributed.get_world_size(), ', '.join(model.wrap_distributed())))
+is_main = distributed.is_main_process()
 # create data loader
 train_loader = CreateDataLoader(opt, split = 'train')
 val_loader = CreateDataLoader(opt, split = 'test')
 
 # create visualizer
-visualizer = GANVisualizer_V3(opt)
+visualizer = GANVisualizer_V3(opt) if is_main else None
 
 total_steps = 0
 
+# per-phase step timing, printed with training errors (see util/timer.StepProfiler). only enabled with --profile 1
+profiler = model.profiler
+# operator-level trace of steps [trace_steps[0], trace_steps[1]), or of trace_len steps after receiving SIGUSR1
+trace = trace_window.TraceWindow(os.path.join(model.save_dir, 'profile'), opt.trace_steps[0], opt.trace_steps[1], opt.trace_len, opt.trace_top,
+    use_cuda=len(opt.gpu_ids) > 0, rank=distributed.get_rank() if opt.distributed else None)
+
 for epoch in range(opt.epoch_count, opt.niter + opt.niter_decay + 1):
     model.update_learning_rate()
-    for i, data in enumerate(train_loader):
+    if opt.distributed:
+        train_loader.sampler.set_epoch(epoch)
+    for i, data in enumerate(profiler.iterate(train_loader)):
         total_steps += 1
-        model.set_input(data)
+        trace.step(total_steps)
+        with profiler.phase('set_input'):
+            model.set_input(data)
 
         if total_steps <= opt.D_pretrain:
             train_D = True
@@ -46,30 +62,41 @@ for epoch in range(opt.epoch_count, opt.niter + opt.niter_decay + 1):
         model.optimize_parameters(train_D = train_D, train_G = train_G, check_grad = check_grad)
 
         if total_steps % opt.display_freq == 0:
-            train_error = model.get_current_errors()
-            
-            visualizer.print_train_error(
-                iter_num = total_steps,
-                epoch = epoch, 
-                num_batch = len(train_loader), 
-                lr = model.optimizers[0].param_groups[0]['lr'], 
-                errors = train_error)
+            with profiler.phase('logging'):
+                train_error = distributed.reduce_errors(model.get_current_errors())
+                
+                if is_main:
+                    visualizer.print_train_error(
+                        iter_num = total_steps,
+                        epoch = epoch, 
+                        num_batch = len(train_loader), 
+                        lr = model.optimizers[0].param_groups[0]['lr'], 
+                        errors = train_error,
+                        profile = profiler.format() if profiler.enabled else None)
 
-            if opt.pavi:
-                visualizer.pavi_log(phase = 'train', iter_num = total_steps, outputs = train_error)
+                    if opt.pavi:
+                        visualizer.pavi_log(phase = 'train', iter_num = total_steps, outputs = train_error)
+                    if profiler.enabled:
+                        profiler.dump(os.path.join(model.save_dir, 'step_profile.json'))
+        profiler.step()
 
     if epoch % opt.vis_epoch_freq == 0:
         # visualize training samples
         train_visuals = model.get_current_visuals()
-        visualizer.visualize_image(epoch = epoch, subset = 'train', visuals = train_visuals)
-        # visualize test samples
+        if is_main:
+            visualizer.visualize_image(epoch = epoch, subset = 'train', visuals = train_visuals)
+        # visualize test samples (all processes run the model, to keep DistributedDataParallel buffer broadcasts in step)
         val_data = iter(val_loader).next()
         model.set_input(val_data)
         model.test()
         val_visuals = model.get_current_visuals()
-        visualizer.visualize_image(epoch = epoch, subset = 'test', visuals = val_visuals)
+        if is_main:
+            visualizer.visualize_image(epoch = epoch, subset = 'test', visuals = val_visuals)
     
-    if epoch % opt.save_epoch_freq == 0:
-        model.save(epoch)
-    model.save('latest')
+    if is_main:
+        if epoch % opt.save_epoch_freq == 0:
+            model.save(epoch)
+        model.save('latest')
 
+# export the trace if the window is still open
+trace.stop(total_steps + 1)
@@ -0,0 +1,209 @@
+from __future__ import division, print_function
+
+import torch
+from data.data_loader import CreateDataset
+from options.pose_transfer_options import SweepPoseTransferOptions
+from misc.loss_buffer import LossBuffer
+from util.image_writer import ImageWriter
+
+import util.io as io
+import os
+import json
+import time
+import argparse
+from collections import OrderedDict
+import tqdm
+
+# Evaluate several checkpoints (model id, epoch) on the test set in one process, instead of one launch of
+# test_pose_transfer_model.py per checkpoint (see test.sh):
+#
+#     python sweep_pose_transfer_model.py --gpu_ids 0 --batch_size 16 --sweep PoseTransfer_7.5 PoseTransfer_7.5:10 PoseTransfer_7.9
+#
+# - the test set is created once for checkpoints with identical data options (DATA_OPTIONS in train_opt.json). decoded
+#   batches are cached in host memory (up to --cache_mb) in the first pass, and later checkpoints read them from the
+#   cache. batches not fitting in the cache are loaded from the rest of the dataset
+# - consecutive epochs of the same model id share one model instance, and only the weights are swapped
+#   (BaseModel.reload_networks)
+# - batch_size, nThreads and the test options (nbatch, reconstruct_ref, save_output, ...) are shared by all checkpoints.
+#   with --save_output, outputs of each checkpoint are saved in checkpoints/[id]/test_[epoch]/ (test_ref_[epoch]/ with
+#   --reconstruct_ref)
+#
+# A table of the test errors (PSNR, SSIM, ...) of all checkpoints is printed and saved to --sweep_output.
+
+# options used by the pose transfer dataset. checkpoints with the same values share test batches
+DATA_OPTIONS = ['dataset_mode', 'data_root', 'fn_split', 'img_dir', 'seg_dir', 'fn_pose', 'debug', 'supervised', 'appearance_type',
+    'use_limb', 'extend_pose', 'joint_mode', 'joint_radius', 'seg_bin_size', 'seg_nc', 'vunet_box_factor']
+# options of the sweep command which are not overridden by train_opt.json
+PRESERVED_OPTIONS = {'gpu_ids', 'is_train', 'batch_size', 'nThreads'}
+
+
+def parse_sweep(entries):
+    '''
+    "id[:epoch]" -> (id, epoch)
+    '''
+    sweep = []
+    for s in entries:
+        model_id, epoch = s.rsplit(':', 1) if ':' in s else (s, 'latest')
+        sweep.append((model_id, epoch))
+    return sweep
+
+
+def load_model_opt(opt, model_id, epoch):
+    opt_m = argparse.Namespace(**vars(opt))
+    for k, v in io.load_json(os.path.join('checkpoints', model_id, 'train_opt.json')).items():
+        if k in opt_m and k not in PRESERVED_OPTIONS:
+            setattr(opt_m, k, v)
+    opt_m.id = model_id
+    opt_m.which_epoch = epoch
+    return opt_m
+
+
+def get_data_key(opt):
+    return json.dumps([(k, getattr(opt, k, None)) for k in DATA_OPTIONS])
+
+
+def create_model(opt):
+    if opt.which_model_T in {'unet', 'resnet'}:
+        from models.supervised_pose_transfer_model import SupervisedPoseTransferModel
+        model = SupervisedPoseTransferModel()
+    elif opt.which_model_T == 'vunet':
+        from models.vunet_pose_transfer_model import VUnetPoseTransferModel
+        model = VUnetPoseTransferModel()
+    elif opt.which_model_T == '2stage':
+        from models.two_stage_pose_transfer_model import TwoStagePoseTransferModel
+        model = TwoStagePoseTransferModel()
+    else:
+        raise NotImplementedError(opt.which_model_T)
+    model.initialize(opt)
+    return model
+
+
+def _nbytes(data):
+    return sum([v.numel() * v.element_size() for v in data.values() if torch.is_tensor(v)])
+
+
+class BatchCache(object):
+    '''
+    Test batches of one dataset. Batches are kept in host memory in the first pass, until budget[0] (bytes, shared by all
+    caches) is used up. Later passes yield the cached batches, then load the remaining ones with a data loader over the
+    rest of the dataset.
+    '''
+    def __init__(self, opt, budget):
+        self.opt = opt
+        self.budget = budget
+        self.dataset = CreateDataset(opt, 'test')
+        # same as CreateDataLoader (drop_last=True)
+        self.n_batch = len(self.dataset) // opt.batch_size
+        if opt.nbatch > 0:
+            self.n_batch = min(self.n_batch, opt.nbatch)
+        self.batches = []
+
+    def __len__(self):
+        return self.n_batch
+
+    def __iter__(self):
+        for data in self.batches:
+            yield data
+        start = len(self.batches)
+        if start == self.n_batch:
+            return
+        bsz = self.opt.batch_size
+        loader = torch.utils.data.DataLoader(
+            dataset = torch.utils.data.Subset(self.dataset, range(start * bsz, self.n_batch * bsz)),
+            batch_size = bsz,
+            shuffle = False,
+            num_workers = int(self.opt.nThreads),
+            drop_last = True,
+            pin_memory = False)
+        for i, data in enumerate(loader):
+            nbytes = _nbytes(data)
+            # only cache a contiguous prefix of batches
+            if start + i == len(self.batches) and nbytes <= self.budget[0]:
+                self.batches.append(data)
+                self.budget[0] -= nbytes
+            yield data
+
+
+def evaluate(model, batches, opt):
+    loss_buffer = LossBuffer(size=len(batches))
+    if opt.save_output:
+        subdir = 'test_ref_%s' if opt.reconstruct_ref else 'test_%s'
+        img_dir = os.path.join(model.save_dir, subdir % opt.which_epoch)
+        io.mkdir_if_missing(img_dir)
+        seg_dir = None
+        if opt.save_seg:
+            assert 'seg' in opt.output_type
+            seg_dir = os.path.join(model.save_dir, (subdir % opt.which_epoch).replace('test', 'test_seg', 1))
+            io.mkdir_if_missing(seg_dir)
+        output_writer = ImageWriter(num_threads=opt.output_workers, max_pending=opt.output_queue, image_format=opt.output_format,
+            seg_format=opt.seg_format, jpeg_quality=opt.jpeg_quality, png_compression=opt.png_compression,
+            archive_shard_size=opt.output_archive)
+
+    for data in tqdm.tqdm(batches, total=len(batches), desc='Testing %s:%s' % (opt.id, opt.which_epoch)):
+        model.set_input(data)
+        if opt.reconstruct_ref:
+            model.test(mode='reconstruct_ref', compute_loss=False)
+        else:
+            model.test(compute_loss=False)
+        loss_buffer.add(model.get_current_errors())
+        if opt.save_output:
+            segs = model.output['seg_out'].max(dim=1)[1].cpu() if opt.save_seg else None # size (bsz, h, w)
+            output_writer.submit(model.input['id'], img_dir, model.output['img_out'].cpu(), seg_dir, segs)
+
+    if opt.save_output:
+        output_writer.close()
+    return loss_buffer.get_errors()
+
+
+def print_table(results):
+    names = []
+    for r in results:
+        names += [k for k in r['errors'] if k not in names]
+    width = max([len('%s:%s' % (r['id'], r['epoch'])) for r in results] + [10])
+    print('%-*s %10s %8s' % (width, 'checkpoint', 'time (s)', 'cached') + ''.join(['%12s' % k for k in names]))
+    for r in results:
+        row = '%-*s %10.1f %7.0f%%' % (width, '%s:%s' % (r['id'], r['epoch']), r['time'], r['cached'] * 100)
+        row += ''.join([('%12.4f' % r['errors'][k]) if k in r['errors'] else '%12s' % '-' for k in names])
+        print(row)
+
+
+if __name__ == '__main__':
+    opt = SweepPoseTransferOptions().parse(save_to_file=False)
+    sweep = parse_sweep(opt.sweep)
+    assert sweep, 'no checkpoint to evaluate. use --sweep id[:epoch] ...'
+
+    budget = [opt.cache_mb * 2.**20]
+    caches = {}
+    model = None
+    results = []
+    for model_id, epoch in sweep:
+        opt_m = load_model_opt(opt, model_id, epoch)
+        # test set
+        data_key = get_data_key(opt_m)
+        if data_key not in caches:
+            caches[data_key] = BatchCache(opt_m, budget)
+        batches = caches[data_key]
+        n_cached = len(batches.batches)
+        # model: swap weights if the previous checkpoint is of the same model id
+        if model is not None and model.opt.id == model_id and not opt_m.int8:
+            model.reload_networks(epoch)
+        else:
+            # release the previous model before creating the next one
+            model = None
+            model = create_model(opt_m)
+        t = time.time()
+        errors = evaluate(model, batches, model.opt)
+        results.append(OrderedDict([
+            ('id', model_id),
+            ('epoch', epoch),
+            ('errors', OrderedDict([(k, float(v)) for k, v in errors.items()])),
+            ('time', time.time() - t),
+            ('cached', n_cached / max(1, len(batches))),
+            ]))
+        print('[%s:%s] %s' % (model_id, epoch, ', '.join(['%s: %.4f' % (k, v) for k, v in errors.items()])))
+
+    print('\n')
+    print_table(results)
+    io.mkdir_if_missing(os.path.dirname(opt.sweep_output) or '.')
+    io.save_json({'opt': vars(opt), 'results': results}, opt.sweep_output)
+    print('results saved to %s' % opt.sweep_output)
@@ -5,6 +5,7 @@ from data.data_loader import CreateDataLoader
 from options.pose_transfer_options import TestPoseTransferOptions
 from misc.visualizer import GANVisualizer_V3
 from misc.loss_buffer import LossBuffer
+from util.image_writer import ImageWriter
 
 import util.io as io
 import os
@@ -36,6 +37,70 @@ else:
     raise NotImplementedError()
 
 model.initialize(opt)
+
+if opt.seq_pose:
+    # pose sequence mode: render a sequence of target poses with one reference, and stream frames into a video file
+    from data.data_loader import CreateDataset
+    from torch.utils.data.dataloader import default_collate
+    dataset = CreateDataset(opt, 'test')
+    # load target poses
+    if opt.seq_pose.endswith('.npz'):
+        with np.load(opt.seq_pose) as seq_file:
+            pose_seq = seq_file['joint_c'] if 'joint_c' in seq_file.files else seq_file[seq_file.files[0]]
+    else:
+        pose_seq = io.load_json(opt.seq_pose)
+        if isinstance(pose_seq, dict):
+            pose_seq = pose_seq['joint_c']
+    pose_seq = np.array(pose_seq, dtype=np.float32).tolist()
+    n_frame = len(pose_seq)
+    # encode reference once
+    sid_ref = opt.seq_ref_id if opt.seq_ref_id else dataset.id_list[0][0]
+    img_ref = dataset.read_image(sid_ref)
+    seg_ref = dataset.read_seg(sid_ref)
+    joint_c_ref = dataset.pose_label[sid_ref]
+    data_ref = dataset.pack_sample(img_ref, seg_ref, joint_c_ref, img_ref, seg_ref, joint_c_ref)
+    data_ref['id_1'] = data_ref['id_2'] = sid_ref
+    # use running statistics of BN layers, so that a frame does not depend on other frames in the same batch
+    model.eval()
+    model.set_input(default_collate([data_ref]))
+    model.encode_reference()
+    # create video writer / frame archive
+    fn_out = opt.seq_output if opt.seq_output else os.path.join(model.save_dir, 'seq', '%s.mp4' % sid_ref)
+    io.mkdir_if_missing(os.path.dirname(os.path.abspath(fn_out)))
+    img_h, img_w = img_ref.shape[0:2]
+    if fn_out.endswith('.npy'):
+        # (n_frame, h, w, 3) uint8 array in RGB order
+        frame_archive = np.lib.format.open_memmap(fn_out, mode='w+', dtype=np.uint8, shape=(n_frame, img_h, img_w, 3))
+        video_writer = None
+    else:
+        video_writer = cv2.VideoWriter(fn_out, cv2.VideoWriter_fourcc(*opt.seq_codec), opt.seq_fps, (img_w, img_h))
+        if not video_writer.isOpened():
+            raise Exception('can not open video writer: %s' % fn_out)
+    # render
+    t_model = 0
+    t_start = time.time()
+    for i in tqdm.trange(0, n_frame, opt.batch_size, desc='Rendering'):
+        data_tar = default_collate([dataset.pack_pose(joint_c, (img_w, img_h), index='2') for joint_c in pose_seq[i:(i+opt.batch_size)]])
+        t = time.time()
+        model.transfer_from_reference(data_tar)
+        frames = model.output['img_out'].cpu().numpy().transpose(0,2,3,1)
+        t_model += time.time() - t
+        frames = ((frames + 1.0) * 127.5).clip(0,255).astype(np.uint8)
+        if video_writer is None:
+            frame_archive[i:(i+frames.shape[0])] = frames
+        else:
+            for frame in frames:
+                video_writer.write(frame[:,:,[2,1,0]]) # convert to BGR channel order for cv2
+    if video_writer is None:
+        frame_archive.flush()
+        del frame_archive
+    else:
+        video_writer.release()
+    t_total = time.time() - t_start
+    print('%d frames saved to %s' % (n_frame, fn_out))
+    print('speed: %.2f fps (model: %.2f fps)' % (n_frame / t_total, n_frame / t_model))
+    exit()
+
 # create data loader
 # train_loader = CreateDataLoader(opt, split = 'train')
 val_loader = CreateDataLoader(opt, split = 'test')
@@ -87,6 +152,13 @@ if opt.vis_only:
 
 # test
 loss_buffer = LossBuffer(size=len(val_loader))
+if opt.save_output:
+    if opt.save_seg:
+        assert 'seg' in opt.output_type
+    output_writer = ImageWriter(num_threads=opt.output_workers, max_pending=opt.output_queue, image_format=opt.output_format,
+        seg_format=opt.seg_format, jpeg_quality=opt.jpeg_quality, png_compression=opt.png_compression,
+        archive_shard_size=opt.output_archive)
+    seg_dir = None
 
 if not opt.reconstruct_ref:
     # normal mode
@@ -105,19 +177,9 @@ if not opt.reconstruct_ref:
         loss_buffer.add(model.get_current_errors())
         # save output
         if opt.save_output:
-            id_list = model.input['id']
-            images = model.output['img_out'].cpu().numpy().transpose(0,2,3,1)
-            images = ((images + 1.0) * 127.5).clip(0,255).astype(np.uint8)
-            for (id1, id2), img in zip(id_list, images):
-                img = img[:,:,[2,1,0]] # convert to BGR channel order for cv2
-                cv2.imwrite(os.path.join(img_dir,'%s_%s.jpg' % (id1, id2)), img)
-
-            if opt.save_seg:
-                assert 'seg' in opt.output_type
-                segs = model.output['seg_out'].max(dim=1)[1] # size (bsz, h, w)
-                segs = segs.cpu().numpy().astype(np.uint8)
-                for (id1, id2), seg in zip(id_list, segs):
-                    cv2.imwrite(os.path.join(seg_dir, '%s_%s.bmp' % (id1, id2)), seg)
+            # encoding and writing are done by the writer threads
+            segs = model.output['seg_out'].max(dim=1)[1].cpu() if opt.save_seg else None # size (bsz, h, w)
+            output_writer.submit(model.input['id'], img_dir, model.output['img_out'].cpu(), seg_dir, segs)
 else:
     # reconstruct image_ref
     if opt.save_output:
@@ -135,20 +197,15 @@ else:
         loss_buffer.add(model.get_current_errors())
         # save output
         if opt.save_output:
-            id_list = model.input['id']
-            images = model.output['img_out'].cpu().numpy().transpose(0,2,3,1)
-            images = ((images + 1.0) * 127.5).clip(0,255).astype(np.uint8)
-            for (id1, id2), img in zip(id_list, images):
-                img = img[:,:,[2,1,0]] # convert to BGR channel order for cv2
-                cv2.imwrite(os.path.join(img_dir,'%s_%s.jpg' % (id1, id2)), img)
-
-            if opt.save_seg:
-                assert 'seg' in opt.output_type
-                segs = model.output['seg_out'].max(dim=1)[1] # size (bsz, h, w)
-                segs = segs.cpu().numpy().astype(np.uint8)
-                for (id1, id2), seg in zip(id_list, segs):
-                    cv2.imwrite(os.path.join(seg_dir, '%s_%s.bmp' % (id1, id2)), seg)
+            # encoding and writing are done by the writer threads
+            segs = model.output['seg_out'].max(dim=1)[1].cpu() if opt.save_seg else None # size (bsz, h, w)
+            output_writer.submit(model.input['id'], img_dir, model.output['img_out'].cpu(), seg_dir, segs)
+
 
+if opt.save_output:
+    # wait for the writer threads and check that all outputs are written
+    n_file = output_writer.close()
+    print('%d outputs saved' % n_file)
 
 test_error = loss_buffer.get_errors()
 print('\n')
@@ -7,6 +7,9 @@ from misc.visualizer import GANVisualizer_V3
 from misc.loss_buffer import LossBuffer
 
 import util.io as io
+import util.distributed as distributed
+import util.trace_window as trace_window
+import util.checkpoint as checkpoint
 import os
 import sys
 import time
@@ -28,41 +31,94 @@ else:
     raise NotImplementedError()
 
 model.initialize(opt)
+if opt.distributed:
+    # one process per device (see util/distributed.py). only the main process logs and saves
+    print('[rank %d/%d] DistributedDataParallel: %s' % (distributed.get_rank(), distributed.get_world_size(), ', '.join(model.wrap_distributed())))
+is_main = distributed.is_main_process()
 # save terminal order line
-io.save_str_list([' '.join(sys.argv)], os.path.join(model.save_dir, 'order_line.txt'))
+if is_main:
+    io.save_str_list([' '.join(sys.argv)], os.path.join(model.save_dir, 'order_line.txt'))
 # create data loader
 train_loader = CreateDataLoader(opt, split = 'train')
 val_loader = CreateDataLoader(opt, split = 'test')
 # create visualizer
-visualizer = GANVisualizer_V3(opt)
+visualizer = GANVisualizer_V3(opt) if is_main else None
 
 pavi_upper_list = ['PSNR', 'SSIM']
 pavi_lower_list = ['loss_L1', 'loss_content', 'loss_style', 'loss_G', 'loss_D', 'loss_pose', 'loss_kl']
 
+num_batch = len(train_loader)
 if not opt.continue_train:
     total_steps = 0
     epoch_count = 1
 else:
     epoch_count = 1 + int(opt.which_epoch)
-    total_steps = len(train_loader)*int(opt.which_epoch)
+    total_steps = num_batch*int(opt.which_epoch)
+# resume from the training state, which is saved every opt.resume_freq steps (see BaseModel.save_train_state)
+epoch_step = 0
+fn_train_state = os.path.join(model.save_dir, 'train_state.pth')
+if opt.resume and os.path.isfile(fn_train_state):
+    loop_state = model.load_train_state(fn_train_state)
+    total_steps = loop_state['total_steps']
+    if loop_state['end_of_epoch']:
+        epoch_count = loop_state['epoch'] + 1
+    else:
+        epoch_count = loop_state['epoch']
+        epoch_step = loop_state['epoch_step']
+    # restore the sampler seed (and the position in the epoch, which is 0 at the end of an epoch)
+    train_loader.sampler.load_state_dict(loop_state['sampler'])
+    checkpoint.set_rng_state(loop_state['rng'])
+    print('resume training at epoch %d, step %d/%d (total_steps: %d)' % (epoch_count, epoch_step, num_batch, total_steps))
+last_state_step = total_steps
+# per-phase step timing, printed with training errors (see util/timer.StepProfiler). only enabled with --profile 1
+profiler = model.profiler
+# operator-level trace of steps [trace_steps[0], trace_steps[1]), or of trace_len steps after receiving SIGUSR1
+trace = trace_window.TraceWindow(os.path.join(model.save_dir, 'profile'), opt.trace_steps[0], opt.trace_steps[1], opt.trace_len, opt.trace_top,
+    use_cuda=len(opt.gpu_ids) > 0, rank=distributed.get_rank() if opt.distributed else None)
 
 for epoch in range(epoch_count, opt.niter + opt.niter_decay + 1):
-    model.update_learning_rate()
-    for i, data in enumerate(train_loader):
+    if epoch_step == 0:
+        # not resuming in the middle of this epoch
+        model.update_learning_rate()
+        # only ResumableSampler (distributed training, --resume_freq or --resume) is reshuffled by epoch
+        if hasattr(train_loader.sampler, 'set_epoch'):
+            train_loader.sampler.set_epoch(epoch)
+    for i, data in enumerate(profiler.iterate(train_loader), epoch_step):
         total_steps += 1
-        model.set_input(data)
-        model.optimize_parameters(check_grad=(total_steps%opt.check_grad_freq==0))
-
-        if total_steps % opt.display_freq == 0:
-            train_error = model.get_current_errors()
-            visualizer.print_train_error(
-                iter_num = total_steps,
-                epoch = epoch, 
-                num_batch = len(train_loader), 
-                lr = model.optimizers[0].param_groups[0]['lr'], 
-                errors = train_error)
-            if opt.pavi:
-                visualizer.pavi_log(phase = 'train', iter_num = total_steps, outputs = train_error, upper_list = pavi_upper_list, lower_list = pavi_lower_list)
+        trace.step(total_steps)
+        with profiler.phase('set_input'):
+            model.set_input(data)
+        # gradient attribution (extra autograd.grad passes through netD) is not used with DistributedDataParallel
+        model.optimize_parameters(check_grad=(total_steps%opt.check_grad_freq==0 and not opt.distributed))
+
+        with profiler.phase('logging'):
+            # gradients of an unfinished accumulation cycle are not saved
+            if opt.resume_freq > 0 and total_steps - last_state_step >= opt.resume_freq and model.accum_count % opt.accum_steps == 0:
+                if is_main:
+                    model.save_train_state({
+                        'epoch': epoch,
+                        'epoch_step': i + 1,
+                        'end_of_epoch': False,
+                        'total_steps': total_steps,
+                        'sampler': train_loader.sampler.state_dict(start=(i + 1) * opt.batch_size),
+                        })
+                last_state_step = total_steps
+
+            if total_steps % opt.display_freq == 0:
+                train_error = distributed.reduce_errors(model.get_current_errors())
+                if is_main:
+                    visualizer.print_train_error(
+                        iter_num = total_steps,
+                        epoch = epoch, 
+                        num_batch = num_batch, 
+                        lr = model.optimizers[0].param_groups[0]['lr'], 
+                        errors = train_error,
+                        profile = profiler.format() if profiler.enabled else None)
+                    if opt.pavi:
+                        visualizer.pavi_log(phase = 'train', iter_num = total_steps, outputs = train_error, upper_list = pavi_upper_list, lower_list = pavi_lower_list)
+                    if profiler.enabled:
+                        profiler.dump(os.path.join(model.save_dir, 'step_profile.json'))
+        profiler.step()
 
     if epoch % opt.test_epoch_freq == 0:
         _ = model.get_current_errors()
@@ -73,14 +129,16 @@ for epoch in range(epoch_count, opt.niter + opt.niter_decay + 1):
             model.set_input(data)
             model.test(compute_loss=True)
             loss_buffer.add(model.get_current_errors())
-            print('\rTesting %d/%d (%.2f%%)' % (i, len(val_loader), 100.*i/len(val_loader)), end = '')
-            sys.stdout.flush()
-        print('\n')
-
-        test_error = loss_buffer.get_errors()
-        visualizer.print_test_error(iter_num = total_steps, epoch=epoch, errors = test_error)
-        if opt.pavi:
-            visualizer.pavi_log(phase = 'test', iter_num = total_steps, outputs = test_error, upper_list = pavi_upper_list, lower_list = pavi_lower_list)
+            if is_main:
+                print('\rTesting %d/%d (%.2f%%)' % (i, len(val_loader), 100.*i/len(val_loader)), end = '')
+                sys.stdout.flush()
+
+        test_error = distributed.reduce_errors(loss_buffer.get_errors())
+        if is_main:
+            print('\n')
+            visualizer.print_test_error(iter_num = total_steps, epoch=epoch, errors = test_error)
+            if opt.pavi:
+                visualizer.pavi_log(phase = 'test', iter_num = total_steps, outputs = test_error, upper_list = pavi_upper_list, lower_list = pavi_lower_list)
 
 
     if epoch % opt.vis_epoch_freq == 0:
@@ -101,7 +159,8 @@ for epoch in range(epoch_count, opt.niter + opt.niter_decay + 1):
                 for name, item in v.iteritems():
                     visuals[name][0] = torch.cat((visuals[name][0], item[0]),dim=0)
             
-        visualizer.visualize_image(epoch = epoch, subset = 'train', visuals = visuals)
+        if is_main:
+            visualizer.visualize_image(epoch = epoch, subset = 'train', visuals = visuals)
 
         visuals = None
         for i, data in enumerate(val_loader):
@@ -116,9 +175,26 @@ for epoch in range(epoch_count, opt.niter + opt.niter_decay + 1):
                 for name, item in v.iteritems():
                     visuals[name][0] = torch.cat((visuals[name][0], item[0]),dim=0)
             
-        visualizer.visualize_image(epoch = epoch, subset = 'test', visuals = visuals)
+        if is_main:
+            visualizer.visualize_image(epoch = epoch, subset = 'test', visuals = visuals)
         visuals = None
     
-    if epoch % opt.save_epoch_freq == 0:
-        model.save(epoch)
-    model.save('latest')
+    epoch_step = 0
+    if is_main:
+        if epoch % opt.save_epoch_freq == 0:
+            model.save(epoch)
+        model.save('latest')
+        if opt.resume_freq > 0 and model.accum_count % opt.accum_steps == 0:
+            model.save_train_state({
+                'epoch': epoch,
+                'epoch_step': num_batch,
+                'end_of_epoch': True,
+                'total_steps': total_steps,
+                'sampler': train_loader.sampler.state_dict(),
+                })
+    last_state_step = total_steps
+
+# export the trace if the window is still open
+trace.stop(total_steps + 1)
+if is_main:
+    model.flush_checkpoints()
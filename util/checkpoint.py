@@ -0,0 +1,221 @@
+from __future__ import division, print_function
+
+import torch
+import numpy as np
+import os
+import re
+import random
+import shutil
+import atexit
+import threading
+import traceback
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+# Checkpoint writing utilities:
+#   - snapshot(obj): copy tensors in a (nested) state dict to host memory, so that training can continue while it is written
+#   - atomic_save(obj, path): torch.save to a temp file, fsync, then rename. a crash during writing never corrupts path
+#   - CheckpointWriter: write snapshots in a background thread, and remove old epoch checkpoints
+#   - get_rng_state / set_rng_state: random states of python, numpy and torch (cpu and cuda), for resumable training
+
+def snapshot(obj):
+    '''
+    copy all tensors in obj (state dict, optimizer state dict, or nested dict/list of them) to CPU memory.
+    '''
+    if torch.is_tensor(obj):
+        obj = obj.detach()
+        return obj.cpu() if obj.is_cuda else obj.clone()
+    elif isinstance(obj, dict):
+        return type(obj)([(k, snapshot(v)) for k, v in obj.items()])
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)([snapshot(v) for v in obj])
+    else:
+        return obj
+
+
+def load(path):
+    '''
+    load a checkpoint which may contain non-tensor objects (e.g. numpy random state) to CPU
+    '''
+    try:
+        return torch.load(path, map_location='cpu', weights_only=False)
+    except TypeError:
+        # torch < 1.13
+        return torch.load(path, map_location='cpu')
+
+
+def get_rng_state():
+    state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available() and torch.cuda.is_initialized():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def _fsync_dir(dirname):
+    try:
+        fd = os.open(dirname, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _atomic_replace(tmp_path, path):
+    # os.rename does not overwrite existing files on Windows
+    if os.name == 'nt' and os.path.exists(path):
+        os.remove(path)
+    os.rename(tmp_path, path)
+    _fsync_dir(os.path.dirname(os.path.abspath(path)))
+
+
+def atomic_save(obj, path):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    _atomic_replace(tmp_path, path)
+
+
+def atomic_link(src, path):
+    '''
+    make path a hard link of src (a copy if hard links are not supported)
+    '''
+    tmp_path = path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(src, tmp_path)
+    except (OSError, AttributeError):
+        shutil.copyfile(src, tmp_path)
+    _atomic_replace(tmp_path, path)
+
+
+def remove_old_epochs(save_dir, keep, names):
+    '''
+    remove "[epoch]_[name].pth" files in save_dir for name in names (e.g. "net_netG", "optim_G"), except those of the last
+    "keep" epochs of each name. other files (e.g. int8 weights "[epoch]_net_netG_int8.pth" or copies of checkpoints) and
+    files of non-numeric epoch labels (e.g. "latest") are not removed. return removed epochs.
+    '''
+    pattern = re.compile(r'^(\d+)_(.*)\.pth$')
+    epoch_files = {}
+    for fn in os.listdir(save_dir):
+        m = pattern.match(fn)
+        if m and m.group(2) in names:
+            epoch_files.setdefault(m.group(2), {})[int(m.group(1))] = fn
+    removed = set()
+    for files in epoch_files.values():
+        for epoch in sorted(files.keys())[:-keep]:
+            os.remove(os.path.join(save_dir, files[epoch]))
+            removed.add(epoch)
+    return sorted(removed)
+
+
+def prune_old_epochs(path, keep):
+    '''
+    called after writing path. if path is an epoch checkpoint "[epoch]_net_[label].pth" or "[epoch]_optim_[label].pth" and
+    keep > 0, remove the files of the same name of older epochs in its directory (see remove_old_epochs)
+    '''
+    m = re.match(r'^\d+_((net|optim)_.*)\.pth$', os.path.basename(path))
+    if keep > 0 and m:
+        removed = remove_old_epochs(os.path.dirname(path), keep, [m.group(1)])
+        if removed:
+            print('[checkpoint] remove %s of epoch %s' % (m.group(1), ', '.join(map(str, removed))))
+
+
+class CheckpointWriter(object):
+    '''
+    Write checkpoints in a background thread. Jobs are done in submission order. Errors in the writer thread are raised in
+    the main thread at the next call of save/link/flush.
+    keep_last: if > 0, only keep the checkpoints of the last keep_last numeric epochs of each network/optimizer (see
+        prune_old_epochs).
+    '''
+    def __init__(self, keep_last=0):
+        self.keep_last = keep_last
+        self.queue = queue.Queue()
+        self.error = None
+        # path -> latest snapshot not yet written (see save(replace_pending=True))
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        # wait for pending jobs when the training script exits
+        atexit.register(self.close)
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                func, args = job
+                func(*args)
+                prune_old_epochs(args[-1], self.keep_last)
+            except Exception:
+                self.error = traceback.format_exc()
+            finally:
+                self.queue.task_done()
+
+    def _check_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('checkpoint writer failed:\n%s' % error)
+
+    def save(self, obj, path, replace_pending=False):
+        '''
+        obj should be a snapshot (see snapshot()), which is not modified by training.
+        replace_pending: if an earlier snapshot of the same path is still waiting in the queue, write this one instead of
+            both. used for frequently saved files (e.g. the training state), so that the number of snapshots kept in
+            host memory is bounded when writing is slower than training.
+        '''
+        self._check_error()
+        if not replace_pending:
+            self.queue.put((atomic_save, (obj, path)))
+            return
+        with self.lock:
+            queued = path in self.pending
+            self.pending[path] = obj
+        if not queued:
+            self.queue.put((self._save_pending, (path,)))
+
+    def _save_pending(self, path):
+        with self.lock:
+            obj = self.pending.pop(path)
+        atomic_save(obj, path)
+
+    def link(self, src, path):
+        self._check_error()
+        self.queue.put((atomic_link, (src, path)))
+
+    def flush(self):
+        '''
+        block until all submitted checkpoints are written
+        '''
+        self.queue.join()
+        self._check_error()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self._check_error()
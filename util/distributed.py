@@ -0,0 +1,109 @@
+from __future__ import division, print_function
+
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+import os
+from collections import OrderedDict
+
+# Multi-process distributed training (one process per device). Start a training script with a launcher, for example:
+#
+#     torchrun --nproc_per_node 4 train_pose_transfer_model.py --distributed 1 --gpu_ids 0,1,2,3 ...
+#     python -m torch.distributed.launch --nproc_per_node 4 train_pose_transfer_model.py --distributed 1 --gpu_ids 0,1,2,3 ...
+#     torchrun --nproc_per_node 2 train_pose_transfer_model.py --distributed 1 --dist_backend gloo --gpu_ids -1 ... (CPU)
+#
+# Each process only sees one device (opt.gpu_ids = [0] on GPU, [] on CPU), so the nn.parallel.data_parallel branch in the
+# forward function of networks (len(gpu_ids) > 1 and not single_device) is never taken. batch_size is the per-process batch size.
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def init_distributed(opt, set_gpu=True):
+    '''
+    initialize the default process group, and assign one device to this process. rank and world size are read from
+    the environment variables set by the launcher (RANK, WORLD_SIZE, LOCAL_RANK). set opt.rank, opt.world_size and
+    update opt.gpu_ids.
+    '''
+    rank = int(os.environ.get('RANK', max(opt.local_rank, 0)))
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    local_rank = int(os.environ.get('LOCAL_RANK', max(opt.local_rank, 0)))
+    if len(opt.gpu_ids) > 0:
+        # should be done before CUDA is initialized
+        device = opt.gpu_ids[local_rank % len(opt.gpu_ids)]
+        if set_gpu:
+            os.environ['CUDA_VISIBLE_DEVICES'] = str(device)
+            opt.gpu_ids = [0]
+            torch.cuda.set_device(0)
+        else:
+            opt.gpu_ids = [device]
+            torch.cuda.set_device(device)
+    dist.init_process_group(backend=opt.dist_backend, init_method=opt.dist_url, rank=rank, world_size=world_size)
+    opt.rank = rank
+    opt.world_size = world_size
+    return opt
+
+
+class DistributedDataParallel(nn.parallel.DistributedDataParallel):
+    '''
+    DistributedDataParallel which forwards unknown attributes to the wrapped network, so that model code can still call
+    helper functions like netT.latent_kl() or netT_s2e.encode(). Note that such calls bypass gradient synchronization
+    hooks of the forward function, and should not be used to compute trained outputs.
+    '''
+    def __getattr__(self, name):
+        try:
+            return super(DistributedDataParallel, self).__getattr__(name)
+        except AttributeError:
+            return getattr(self.module, name)
+
+
+def wrap_network(network, gpu_ids, find_unused_parameters=False):
+    device_ids = [torch.cuda.current_device()] if gpu_ids else None
+    return DistributedDataParallel(network, device_ids=device_ids, find_unused_parameters=find_unused_parameters)
+
+
+def unwrap_network(network):
+    if isinstance(network, nn.parallel.DistributedDataParallel):
+        return network.module
+    return network
+
+
+def set_grad_sync(network, enabled):
+    '''
+    enable/disable gradient all-reduce in the backward pass of a DistributedDataParallel network (the same as entering
+    network.no_sync()). ignored for other networks.
+    '''
+    if isinstance(network, nn.parallel.DistributedDataParallel):
+        network.require_backward_grad_sync = enabled
+
+
+def reduce_errors(errors):
+    '''
+    average an error dict (name -> float) over all processes. should be called by all processes with the same keys.
+    '''
+    if not is_distributed() or len(errors) == 0:
+        return errors
+    keys = list(errors.keys())
+    t = torch.tensor([float(errors[k]) for k in keys], dtype=torch.float64)
+    if dist.get_backend() == 'nccl':
+        t = t.cuda()
+    dist.all_reduce(t)
+    t = (t / get_world_size()).cpu()
+    return OrderedDict([(k, t[i].item()) for i, k in enumerate(keys)])
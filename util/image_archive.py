@@ -0,0 +1,184 @@
+from __future__ import division, print_function
+
+import numpy as np
+import cv2
+import os
+import json
+import threading
+
+# Indexed shard archives of generated images / segmentation maps, as an alternative to one image file per sample pair.
+# An archive is a directory (e.g. checkpoints/[id]/test/) containing:
+#
+#     index.json          {"kind": "image"|"seg", "shards": [...], "keys": ["[id_1]_[id_2]", ...], "pairs": [[id_1, id_2], ...],
+#                          "location": [[shard, offset], ...]}
+#     shard_00000.npy     uint8 array (n, h, w, 3) of RGB images, or (n, h, w) of segmentation labels
+#     ...
+#
+# Shards are memory-mapped when read, so a sample is accessed without decoding or reading the whole shard. index.json is
+# written last, so an interrupted run leaves no (partial) archive.
+#
+# Consumers address samples by the same paths as image files ("[archive_dir]/[id_1]_[id_2].jpg", extension ignored), so
+# scripts switch between image folders and archives by replacing imageio.imread / cv2.imread with imread():
+#
+#     img = image_archive.imread('checkpoints/PoseTransfer_7.5/test/%s_%s.jpg' % (id_1, id_2), imageio.imread)  # RGB uint8
+#
+# or open an archive for random access by pair:
+#
+#     archive = image_archive.open_archive('checkpoints/PoseTransfer_7.5/test/')
+#     img = archive.get(id_1, id_2)
+
+INDEX_FILE = 'index.json'
+
+
+def is_archive(path):
+    return os.path.isfile(os.path.join(path, INDEX_FILE))
+
+
+def _key(id_1, id_2):
+    return '%s_%s' % (id_1, id_2)
+
+
+class ArchiveWriter(object):
+    '''
+    Write uint8 arrays of one kind ("image": RGB (h, w, 3), "seg": (h, w) labels) into shards of shard_size samples.
+    Not thread safe, callers should serialize add() (see util/image_writer.py).
+    '''
+    def __init__(self, archive_dir, kind='image', shard_size=1000):
+        assert kind in {'image', 'seg'}
+        self.archive_dir = archive_dir
+        self.kind = kind
+        self.shard_size = shard_size
+        self.buffer = []
+        self.index = {'kind': kind, 'shards': [], 'keys': [], 'pairs': [], 'location': []}
+        if not os.path.isdir(archive_dir):
+            os.makedirs(archive_dir)
+        # remove existing archive, so that readers never see an index of old shards
+        for fn in os.listdir(archive_dir):
+            if fn == INDEX_FILE or (fn.startswith('shard_') and fn.endswith('.npy')):
+                os.remove(os.path.join(archive_dir, fn))
+
+    def add(self, id_1, id_2, arr):
+        # start a new shard if the sample size changes
+        if self.buffer and self.buffer[0].shape != arr.shape:
+            self._write_shard()
+        self.index['keys'].append(_key(id_1, id_2))
+        self.index['pairs'].append([id_1, id_2])
+        self.index['location'].append([len(self.index['shards']), len(self.buffer)])
+        self.buffer.append(arr)
+        if len(self.buffer) == self.shard_size:
+            self._write_shard()
+
+    def _write_shard(self):
+        if not self.buffer:
+            return
+        fn = 'shard_%05d.npy' % len(self.index['shards'])
+        np.save(os.path.join(self.archive_dir, fn), np.stack(self.buffer).astype(np.uint8))
+        self.index['shards'].append(fn)
+        self.buffer = []
+
+    def close(self):
+        self._write_shard()
+        fn_index = os.path.join(self.archive_dir, INDEX_FILE)
+        with open(fn_index + '.tmp', 'w') as f:
+            json.dump(self.index, f)
+        os.rename(fn_index + '.tmp', fn_index)
+        return len(self.index['keys'])
+
+
+class ImageArchive(object):
+    '''
+    Random access reader of an archive. Shards are memory-mapped on first access.
+    '''
+    def __init__(self, archive_dir):
+        self.archive_dir = archive_dir
+        with open(os.path.join(archive_dir, INDEX_FILE)) as f:
+            index = json.load(f)
+        self.kind = index['kind']
+        self.shard_files = index['shards']
+        self.pairs = [tuple(p) for p in index['pairs']]
+        self.location = dict(zip(index['keys'], [tuple(l) for l in index['location']]))
+        self.shards = [None] * len(self.shard_files)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def __contains__(self, pair):
+        return _key(*pair) in self.location
+
+    def _shard(self, i):
+        if self.shards[i] is None:
+            with self.lock:
+                if self.shards[i] is None:
+                    self.shards[i] = np.load(os.path.join(self.archive_dir, self.shard_files[i]), mmap_mode='r')
+        return self.shards[i]
+
+    def get_by_key(self, key):
+        if key not in self.location:
+            raise KeyError('%s not found in archive %s' % (key, self.archive_dir))
+        shard, offset = self.location[key]
+        return np.array(self._shard(shard)[offset])
+
+    def get(self, id_1, id_2):
+        '''
+        RGB uint8 (h, w, 3) image, or uint8 (h, w) segmentation map
+        '''
+        return self.get_by_key(_key(id_1, id_2))
+
+    def __getitem__(self, pair):
+        return self.get(*pair)
+
+
+_archives = {}
+_archives_lock = threading.Lock()
+
+
+def open_archive(archive_dir):
+    '''
+    cached ImageArchive of archive_dir. reopened if the archive has been rewritten
+    '''
+    path = os.path.abspath(archive_dir)
+    mtime = os.path.getmtime(os.path.join(path, INDEX_FILE))
+    with _archives_lock:
+        if path not in _archives or _archives[path][0] != mtime:
+            _archives[path] = (mtime, ImageArchive(path))
+        return _archives[path][1]
+
+
+def imread(fn, reader=None):
+    '''
+    read "[dir]/[name].[ext]" from the archive dir if dir is an archive (name is "[id_1]_[id_2]"), otherwise from the image
+    file with reader (default: cv2). return RGB uint8 (h, w, 3) for color images and (h, w) for segmentation maps
+    '''
+    archive_dir, name = os.path.split(fn)
+    if is_archive(archive_dir):
+        return open_archive(archive_dir).get_by_key(os.path.splitext(name)[0])
+    if reader is not None:
+        return reader(fn)
+    img = cv2.imread(fn, cv2.IMREAD_UNCHANGED)
+    if img is None:
+        raise IOError('cannot read image %s' % fn)
+    return img[:,:,[2,1,0]] if img.ndim == 3 else img
+
+
+def materialize(fn, cache_dir):
+    '''
+    return a path of an image file with the content of fn, for external tools which read image files. samples in an
+    archive are written to cache_dir (samples of different archives should use different cache dirs).
+    '''
+    archive_dir, name = os.path.split(fn)
+    if not is_archive(archive_dir):
+        return fn
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    fn_out = os.path.join(cache_dir, name)
+    img = imread(fn)
+    cv2.imwrite(fn_out, img[:,:,[2,1,0]] if img.ndim == 3 else img)
+    return fn_out
+
+
+def list_paths(archive_dir, ext='.jpg'):
+    '''
+    paths "[archive_dir]/[id_1]_[id_2][ext]" of all samples in an archive, readable by imread()
+    '''
+    return [os.path.join(archive_dir, _key(*p) + ext) for p in open_archive(archive_dir).pairs]
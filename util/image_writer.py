@@ -0,0 +1,196 @@
+from __future__ import division, print_function
+
+import numpy as np
+import cv2
+import os
+import threading
+import traceback
+
+from .image_archive import ArchiveWriter, ImageArchive
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+# Background writing of generated images and segmentation maps:
+#   - ImageWriter: a pool of threads that converts (bsz, c, h, w) output tensors to uint8 arrays, encodes and writes them,
+#     while the main thread runs the next batch. cv2 releases the GIL when encoding, so threads run in parallel.
+#   - the job queue is bounded: submit() blocks when max_pending batches are waiting, so host memory of pending outputs is
+#     bounded (backpressure). with num_threads=0, batches are written in the calling thread.
+#   - close() waits for all jobs and verifies that every submitted file exists and is non-empty.
+#   - with archive_shard_size > 0, outputs are written into indexed shard archives (see util/image_archive.py) in the
+#     output dirs, instead of one file per sample.
+
+IMAGE_FORMATS = {
+    # format: (extension, lossless)
+    'jpg': ('.jpg', False),
+    'png': ('.png', True),
+    'bmp': ('.bmp', True),
+}
+
+
+def encode_params(fmt, jpeg_quality=95, png_compression=3):
+    if fmt == 'jpg':
+        return [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality]
+    elif fmt == 'png':
+        return [cv2.IMWRITE_PNG_COMPRESSION, png_compression]
+    else:
+        return []
+
+
+def image_to_uint8(images, bgr=True):
+    '''
+    (bsz, 3, h, w) tensor/array in range (-1, 1), RGB -> (bsz, h, w, 3) uint8 array, BGR channel order for cv2 if bgr
+    '''
+    if not isinstance(images, np.ndarray):
+        images = images.numpy()
+    images = ((images.transpose(0,2,3,1) + 1.0) * 127.5).clip(0,255).astype(np.uint8)
+    return images[:,:,:,::-1] if bgr else images
+
+
+def seg_to_uint8(segs):
+    '''
+    (bsz, h, w) label maps -> uint8 array
+    '''
+    if not isinstance(segs, np.ndarray):
+        segs = segs.numpy()
+    return segs.astype(np.uint8)
+
+
+def write_image(fn, img, params):
+    ok, buf = cv2.imencode(os.path.splitext(fn)[1], img, params)
+    if not ok:
+        raise IOError('failed to encode %s' % fn)
+    with open(fn, 'wb') as f:
+        f.write(buf.tobytes())
+
+
+class ImageWriter(object):
+    '''
+    Write output batches in background threads. Errors in writer threads are raised in the main thread at the next call of
+    submit/flush/close.
+    '''
+    def __init__(self, num_threads=4, max_pending=8, image_format='jpg', seg_format='bmp', jpeg_quality=95, png_compression=3,
+            archive_shard_size=0):
+        assert image_format in IMAGE_FORMATS and seg_format in IMAGE_FORMATS
+        assert IMAGE_FORMATS[seg_format][1], 'segmentation maps must be saved in a lossless format'
+        self.image_ext = IMAGE_FORMATS[image_format][0]
+        self.seg_ext = IMAGE_FORMATS[seg_format][0]
+        self.image_params = encode_params(image_format, jpeg_quality, png_compression)
+        self.seg_params = encode_params(seg_format, jpeg_quality, png_compression)
+        self.archive_shard_size = archive_shard_size
+        # output dir -> ArchiveWriter
+        self.archives = {}
+        self.archive_lock = threading.Lock()
+        self.queue = queue.Queue(maxsize=max(1, max_pending))
+        self.error = None
+        self.files = []
+        self.threads = []
+        for _ in range(num_threads):
+            t = threading.Thread(target=self._run)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                func, args = job
+                func(*args)
+            except Exception:
+                self.error = traceback.format_exc()
+            finally:
+                self.queue.task_done()
+
+    def _check_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('image writer failed:\n%s' % error)
+
+    def _write_images(self, fn_list, images):
+        if self.archive_shard_size > 0:
+            self._write_archive(fn_list, image_to_uint8(images, bgr=False), 'image')
+        else:
+            for fn, img in zip(fn_list, image_to_uint8(images)):
+                write_image(fn, img, self.image_params)
+
+    def _write_segs(self, fn_list, segs):
+        if self.archive_shard_size > 0:
+            self._write_archive(fn_list, seg_to_uint8(segs), 'seg')
+        else:
+            for fn, seg in zip(fn_list, seg_to_uint8(segs)):
+                write_image(fn, seg, self.seg_params)
+
+    def _write_archive(self, fn_list, arrs, kind):
+        with self.archive_lock:
+            for (archive_dir, pair), arr in zip(fn_list, arrs):
+                if archive_dir not in self.archives:
+                    self.archives[archive_dir] = ArchiveWriter(archive_dir, kind, self.archive_shard_size)
+                self.archives[archive_dir].add(pair[0], pair[1], arr)
+
+    def _put(self, func, args):
+        if self.threads:
+            # blocks when the queue is full
+            self.queue.put((func, args))
+        else:
+            func(*args)
+
+    def submit(self, id_list, img_dir, images, seg_dir=None, segs=None):
+        '''
+        id_list: list of (id_1, id_2) pairs. files are named "[id_1]_[id_2].[ext]".
+        images: (bsz, 3, h, w) CPU tensor in range (-1, 1)
+        segs: (bsz, h, w) CPU tensor of segmentation labels (optional)
+        the tensors should not be modified by the caller afterwards (model outputs are re-created in each test step).
+        '''
+        self._check_error()
+        fn_list = self._get_files(id_list, img_dir, self.image_ext)
+        self.files += fn_list
+        self._put(self._write_images, (fn_list, images))
+        if segs is not None:
+            fn_list = self._get_files(id_list, seg_dir, self.seg_ext)
+            self.files += fn_list
+            self._put(self._write_segs, (fn_list, segs))
+
+    def _get_files(self, id_list, output_dir, ext):
+        if self.archive_shard_size > 0:
+            # (archive dir, pair)
+            return [(output_dir, (id1, id2)) for id1, id2 in id_list]
+        else:
+            return [os.path.join(output_dir, '%s_%s%s' % (id1, id2, ext)) for id1, id2 in id_list]
+
+    def flush(self):
+        '''
+        block until all submitted batches are written
+        '''
+        self.queue.join()
+        self._check_error()
+
+    def verify(self):
+        '''
+        return the list of submitted files which are missing or empty (samples missing in the archives)
+        '''
+        if self.archive_shard_size > 0:
+            archives = dict([(archive_dir, ImageArchive(archive_dir)) for archive_dir in self.archives])
+            return ['%s: %s_%s' % (archive_dir, pair[0], pair[1]) for archive_dir, pair in self.files if pair not in archives[archive_dir]]
+        return [fn for fn in self.files if not (os.path.isfile(fn) and os.path.getsize(fn) > 0)]
+
+    def close(self):
+        '''
+        flush, stop the writer threads and verify the written files. return number of written files
+        '''
+        self.flush()
+        for _ in self.threads:
+            self.queue.put(None)
+        for t in self.threads:
+            t.join()
+        self.threads = []
+        for archive in self.archives.values():
+            archive.close()
+        missing = self.verify()
+        if missing:
+            raise IOError('%d of %d output files are missing or empty, e.g. %s' % (len(missing), len(self.files), missing[0]))
+        return len(self.files)
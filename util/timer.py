@@ -1,4 +1,7 @@
 import time
+import json
+import numpy as np
+from collections import OrderedDict, deque
 
 class Timer():
 	def __init__(self):
@@ -10,4 +13,117 @@ class Timer():
 	def toc(self):
 		t = time.time() - self._time
 		# print(t)
-		return t
\ No newline at end of file
+		return t
+
+
+class _Phase(object):
+	def __init__(self, profiler, name):
+		self.profiler = profiler
+		self.name = name
+
+	def __enter__(self):
+		self.t = self.profiler._time()
+
+	def __exit__(self, *args):
+		self.profiler.add(self.name, self.profiler._time() - self.t)
+
+
+class _NullPhase(object):
+	def __enter__(self):
+		pass
+
+	def __exit__(self, *args):
+		pass
+
+_null_phase = _NullPhase()
+
+
+class StepProfiler(object):
+	'''
+	Wall time of the phases of training steps (data, set_input, forward, each loss term, backward, optimizer step, logging).
+	Code is annotated with "with profiler.phase(name):". The time of a phase in one step is the sum over its occurrences,
+	and the rolling p50/p95 over the last "window" steps in which it occurred are reported. "step" is the time between two
+	calls of step().
+	When disabled, phase() returns a shared no-op context and iterate() returns the input iterable, so annotations cost
+	nothing. sync: call torch.cuda.synchronize() at phase boundaries, so that asynchronous CUDA kernels are counted in the
+	phase launching them (only when enabled).
+	'''
+	def __init__(self, enabled=True, sync=False, window=200):
+		self.enabled = enabled
+		self.sync = sync
+		self.window = window
+		self.phases = OrderedDict([('step', deque(maxlen=window))])
+		self.current = OrderedDict()
+		self.step_time = None
+		self.num_steps = 0
+
+	def _time(self):
+		if self.sync:
+			import torch
+			torch.cuda.synchronize()
+		return time.time()
+
+	def phase(self, name):
+		if not self.enabled:
+			return _null_phase
+		return _Phase(self, name)
+
+	def add(self, name, t):
+		self.current[name] = self.current.get(name, 0.) + t
+
+	def iterate(self, iterable, name='data'):
+		'''
+		record the time of waiting for each item of iterable (e.g. a data loader) as phase "name"
+		'''
+		if not self.enabled:
+			return iterable
+		return self._iterate(iterable, name)
+
+	def _iterate(self, iterable, name):
+		it = iter(iterable)
+		while True:
+			with self.phase(name):
+				try:
+					item = next(it)
+				except StopIteration:
+					return
+			yield item
+
+	def step(self):
+		'''
+		end of a training step
+		'''
+		if not self.enabled:
+			return
+		t = self._time()
+		if self.step_time is not None:
+			self.phases['step'].append(t - self.step_time)
+		self.step_time = t
+		for name, t_phase in self.current.items():
+			if name not in self.phases:
+				self.phases[name] = deque(maxlen=self.window)
+			self.phases[name].append(t_phase)
+		self.current = OrderedDict()
+		self.num_steps += 1
+
+	def summary(self):
+		'''
+		return OrderedDict: phase -> {count, mean, p50, p95} (times in ms) over the rolling window
+		'''
+		rst = OrderedDict()
+		for name, ts in self.phases.items():
+			if len(ts) > 0:
+				ts = np.array(ts) * 1000.
+				rst[name] = OrderedDict([('count', len(ts)), ('mean', float(ts.mean())), ('p50', float(np.percentile(ts, 50))), ('p95', float(np.percentile(ts, 95)))])
+		return rst
+
+	def format(self):
+		'''
+		one line of "phase: p50/p95" in ms
+		'''
+		return 'time p50/p95 (ms): ' + '  '.join(['%s: %.1f/%.1f' % (name, s['p50'], s['p95']) for name, s in self.summary().items()])
+
+	def dump(self, filename):
+		rst = OrderedDict([('num_steps', self.num_steps), ('window', self.window), ('sync', self.sync), ('phases', self.summary())])
+		with open(filename, 'w') as f:
+			json.dump(rst, f, indent=1)
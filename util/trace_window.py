@@ -0,0 +1,84 @@
+from __future__ import division, print_function
+
+import torch
+import os
+import signal
+
+# Operator-level trace of a window of training steps, with the autograd profiler (input shapes and memory recorded). The
+# window is set by --trace_steps a b (steps [a, b) counted by total_steps), or started on a running job by a signal:
+#
+#     kill -USR1 <pid>      # trace the next --trace_len steps
+#
+# Outputs are written to checkpoints/id/profile/:
+#     trace_[a]_[b].json    chrome trace (open in chrome://tracing or https://ui.perfetto.dev)
+#     ops_[a]_[b].txt       top operators by self time, grouped by input shapes
+#
+# Outside the window the only cost is an integer comparison per step.
+
+class TraceWindow(object):
+    def __init__(self, output_dir, start=-1, end=-1, length=20, row_limit=30, use_cuda=False, rank=None, signum=getattr(signal, 'SIGUSR1', None)):
+        self.output_dir = output_dir
+        self.start = start
+        self.end = end
+        self.length = length
+        self.row_limit = row_limit
+        self.use_cuda = use_cuda
+        self.suffix = '' if rank is None else '_rank%d' % rank
+        self.requested = False
+        self.prof = None
+        self.trace_start = None
+        if signum is not None:
+            signal.signal(signum, self._on_signal)
+
+    def _on_signal(self, signum, frame):
+        # only set a flag. the profiler is started at the next step boundary
+        self.requested = True
+
+    def step(self, step_num):
+        '''
+        call at the beginning of each training step
+        '''
+        if self.prof is not None:
+            if step_num >= self.trace_end:
+                self.stop(step_num)
+        elif step_num == self.start or self.requested:
+            self.requested = False
+            self.trace_end = self.end if step_num == self.start else step_num + self.length
+            self._start(step_num)
+
+    def _start(self, step_num):
+        try:
+            self.prof = torch.autograd.profiler.profile(use_cuda=self.use_cuda, record_shapes=True, profile_memory=True)
+        except TypeError:
+            # torch < 1.6
+            self.prof = torch.autograd.profiler.profile(use_cuda=self.use_cuda)
+        self.prof.__enter__()
+        self.trace_start = step_num
+        print('[TraceWindow] start tracing at step %d (until step %d)' % (step_num, self.trace_end))
+
+    def stop(self, step_num):
+        '''
+        stop tracing and export results. called by step() at the end of the window, or at the end of training
+        '''
+        if self.prof is None:
+            return
+        if self.use_cuda:
+            torch.cuda.synchronize()
+        self.prof.__exit__(None, None, None)
+        prof, self.prof = self.prof, None
+        if not os.path.isdir(self.output_dir):
+            os.makedirs(self.output_dir)
+        name = '%d_%d%s' % (self.trace_start, step_num, self.suffix)
+        fn_trace = os.path.join(self.output_dir, 'trace_%s.json' % name)
+        prof.export_chrome_trace(fn_trace)
+        sort_by = 'self_cuda_time_total' if self.use_cuda else 'self_cpu_time_total'
+        try:
+            table = prof.key_averages(group_by_input_shape=True).table(sort_by=sort_by, row_limit=self.row_limit)
+        except (TypeError, KeyError, AttributeError):
+            # torch < 1.2
+            table = prof.key_averages().table(sort_by=sort_by.replace('self_', ''))
+        fn_table = os.path.join(self.output_dir, 'ops_%s.txt' % name)
+        with open(fn_table, 'w') as f:
+            f.write('steps [%d, %d)\n' % (self.trace_start, step_num))
+            f.write(table)
+        print('[TraceWindow] steps [%d, %d) traced: %s, %s' % (self.trace_start, step_num, fn_trace, fn_table))
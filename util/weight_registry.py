@@ -0,0 +1,180 @@
+from __future__ import division, print_function
+
+import torch
+import os
+import json
+import hashlib
+import threading
+
+# Local registry of pretrained weights used by loss and feature networks (VGG19 for perceptual losses, ResNets for encoders,
+# Inception-v3 for IS/FID evaluation, see misc/inception_eval.py).
+# Weights are stored as state dicts in one directory (default: checkpoints/pretrained, or $WEIGHT_REGISTRY_DIR), with an
+# index file recording the sha256 checksum of each file:
+#
+#     checkpoints/pretrained/index.json
+#     checkpoints/pretrained/vgg19_features.pth
+#     checkpoints/pretrained/resnet18_conv.pth
+#
+# Only the parts of the torchvision models that are used are kept (e.g. the convolution layers of VGG19 are ~80MB, while the
+# full model with fc layers is ~550MB). Weights missing from the registry are downloaded from the torchvision model zoo
+# once and registered. To populate the registry in advance (e.g. on a machine with network access):
+#
+#     python -m util.weight_registry vgg19_features resnet18_conv
+#
+# Files are loaded with torch.load(mmap=True) when supported, so that weights are paged in from the page cache instead of
+# being copied. The checksum is computed when a file is registered, and verified when the file is first loaded in each
+# process (the time is included in the first VGG loss of scripts/benchmark_cold_start.py).
+
+_lock = threading.Lock()
+# path -> (size, mtime, inode) of files verified in this process. a file replaced after verification is verified again
+_verified = {}
+
+def _stat_key(path):
+    st = os.stat(path)
+    return (st.st_size, st.st_mtime, st.st_ino)
+
+def _vgg19_features(state_dict):
+    return {k[len('features.'):]: v for k, v in state_dict.items() if k.startswith('features.')}
+
+def _resnet_conv(state_dict):
+    return {k: v for k, v in state_dict.items() if not k.startswith('fc.')}
+
+def _inception_v3(state_dict):
+    return {k: v for k, v in state_dict.items() if not k.startswith('AuxLogits.')}
+
+# name -> (torchvision model name, function to select used parameters)
+SOURCES = {
+    'vgg19_features': ('vgg19', _vgg19_features),
+    'resnet18_conv': ('resnet18', _resnet_conv),
+    'resnet34_conv': ('resnet34', _resnet_conv),
+    'resnet50_conv': ('resnet50', _resnet_conv),
+    'resnet101_conv': ('resnet101', _resnet_conv),
+    'resnet152_conv': ('resnet152', _resnet_conv),
+    'inception_v3': ('inception_v3', _inception_v3),
+}
+
+
+def get_registry_dir():
+    return os.environ.get('WEIGHT_REGISTRY_DIR', os.path.join('checkpoints', 'pretrained'))
+
+
+def _load_index(registry_dir):
+    fn_index = os.path.join(registry_dir, 'index.json')
+    if not os.path.isfile(fn_index):
+        return {}
+    with open(fn_index, 'r') as f:
+        return json.load(f)
+
+
+def _save_index(index, registry_dir):
+    fn_index = os.path.join(registry_dir, 'index.json')
+    with open(fn_index + '.tmp', 'w') as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+    os.rename(fn_index + '.tmp', fn_index)
+
+
+def _sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1<<20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _torch_load(path):
+    try:
+        return torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+    except TypeError:
+        # torch < 2.1
+        return torch.load(path, map_location='cpu')
+
+
+def _fetch(name):
+    '''
+    download weights of a registered source from the torchvision model zoo, keeping the used parameters only.
+    '''
+    import torch.utils.model_zoo as model_zoo
+    import torchvision.models
+    arch, select = SOURCES[name]
+    try:
+        # torchvision >= 0.13
+        if arch == 'inception_v3':
+            url = torchvision.models.get_weight('Inception_V3_Weights.IMAGENET1K_V1').url
+        else:
+            url = torchvision.models.get_weight('%s_Weights.IMAGENET1K_V1' % arch.replace('resnet', 'ResNet').replace('vgg', 'VGG')).url
+    except AttributeError:
+        if arch.startswith('vgg'):
+            from torchvision.models.vgg import model_urls
+        elif arch == 'inception_v3':
+            from torchvision.models.inception import model_urls
+            arch = 'inception_v3_google'
+        else:
+            from torchvision.models.resnet import model_urls
+        url = model_urls[arch]
+    return select(model_zoo.load_url(url, map_location='cpu'))
+
+
+def register(name, state_dict, registry_dir=None):
+    '''
+    save state_dict as "[name].pth" in the registry and record its checksum
+    '''
+    registry_dir = registry_dir or get_registry_dir()
+    if not os.path.isdir(registry_dir):
+        os.makedirs(registry_dir)
+    fn = name + '.pth'
+    path = os.path.join(registry_dir, fn)
+    torch.save(state_dict, path + '.tmp')
+    os.rename(path + '.tmp', path)
+    with _lock:
+        index = _load_index(registry_dir)
+        index[name] = {'file': fn, 'sha256': _sha256(path), 'size': os.path.getsize(path)}
+        _save_index(index, registry_dir)
+        _verified[os.path.abspath(path)] = _stat_key(path)
+    print('[weight_registry] register %s (%.1f MB)' % (path, os.path.getsize(path) / 2.**20))
+    return path
+
+
+def load_state_dict(name, registry_dir=None):
+    '''
+    load a state dict from the registry (fetch and register it first if missing). the checksum is verified at the first
+    load of each file in a process. raise IOError if it does not match the index.
+    '''
+    registry_dir = registry_dir or get_registry_dir()
+    index = _load_index(registry_dir)
+    if name not in index:
+        if name not in SOURCES:
+            raise ValueError('"%s" is not in the weight registry %s' % (name, registry_dir))
+        print('[weight_registry] %s is not in %s, fetch it from the torchvision model zoo' % (name, registry_dir))
+        register(name, _fetch(name), registry_dir)
+        index = _load_index(registry_dir)
+    entry = index[name]
+    path = os.path.join(registry_dir, entry['file'])
+    stat_key = _stat_key(path)
+    if _verified.get(os.path.abspath(path)) != stat_key:
+        if _sha256(path) != entry['sha256']:
+            raise IOError('checksum mismatch for %s. remove it from %s to fetch it again' % (path, os.path.join(registry_dir, 'index.json')))
+        with _lock:
+            _verified[os.path.abspath(path)] = stat_key
+    return _torch_load(path)
+
+
+def verify(registry_dir=None):
+    '''
+    recompute checksums of all registered files. return a dict name -> True/False
+    '''
+    registry_dir = registry_dir or get_registry_dir()
+    index = _load_index(registry_dir)
+    return {name: os.path.isfile(os.path.join(registry_dir, entry['file'])) and _sha256(os.path.join(registry_dir, entry['file'])) == entry['sha256'] for name, entry in index.items()}
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='populate or verify the local weight registry (%s)' % get_registry_dir())
+    parser.add_argument('names', nargs='*', help='weights to fetch: %s' % ', '.join(sorted(SOURCES.keys())))
+    parser.add_argument('--verify', action='store_true', help='recompute checksums of all registered files')
+    args = parser.parse_args()
+    for name in args.names:
+        register(name, _fetch(name))
+    if args.verify:
+        for name, ok in sorted(verify().items()):
+            print('%-20s %s' % (name, 'ok' if ok else 'CORRUPTED'))